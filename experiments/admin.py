@@ -3,7 +3,9 @@ from django.contrib.admin.utils import unquote
 from django import forms
 from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.utils import timezone
+from datetime import timedelta
 from experiments.admin_utils import get_result_context
+from experiments.experiment_counters import ExperimentCounter
 from experiments.models import Experiment
 from experiments import conf
 from django.urls import path
@@ -38,7 +40,15 @@ class ExperimentAdmin(admin.ModelAdmin):
             ('Relevant Goals', {
                 'classes': ('collapse', 'hidden-relevant-goals'),
                 'fields': ('relevant_chi2_goals', 'relevant_mwu_goals'),
-            })
+            }),
+            ('Assignment', {
+                'classes': ('collapse',),
+                'fields': ('hashed_assignment', 'assignment_salt'),
+            }),
+            ('Counting', {
+                'classes': ('collapse',),
+                'fields': ('approximate_counts',),
+            }),
         )
 
     # --------------------------------------- Default alternative
@@ -106,6 +116,9 @@ class ExperimentAdmin(admin.ModelAdmin):
         experiment_urls = [
             path('set-alternative/', self.admin_site.admin_view(self.set_alternative_view), name='experiment_admin_set_alternative'),
             path('set-state/', self.admin_site.admin_view(self.set_state_view), name='experiment_admin_set_state'),
+            path('funnel/', self.admin_site.admin_view(self.funnel_view), name='experiment_admin_funnel'),
+            path('overlap/', self.admin_site.admin_view(self.overlap_view), name='experiment_admin_overlap'),
+            path('rollups/', self.admin_site.admin_view(self.rollups_view), name='experiment_admin_rollups'),
         ]
         return experiment_urls + super(ExperimentAdmin, self).get_urls()
 
@@ -155,5 +168,80 @@ class ExperimentAdmin(admin.ModelAdmin):
 
         return HttpResponse()
 
+    def funnel_view(self, request):
+        """
+        Returns how many participants of each alternative hit each of the goals in turn
+        """
+        if not request.user.has_perm('experiments.change_experiment'):
+            return HttpResponseForbidden()
+
+        try:
+            experiment = Experiment.objects.get(name=request.GET.get("experiment"))
+        except Experiment.DoesNotExist:
+            return HttpResponseBadRequest()
+        goals = [goal for goal in request.GET.get("goals", "").split(",") if goal]
+
+        try:
+            funnels = dict((alternative, ExperimentCounter().funnel(experiment, alternative, goals)) for alternative in experiment.alternatives)
+        except NotImplementedError as e:
+            return HttpResponseBadRequest(str(e))
+        return JsonResponse({
+            'goals': goals,
+            'alternatives': funnels,
+        })
+
+    def overlap_view(self, request):
+        """
+        Returns how many participants two experiments have in common, by pair of alternatives
+        """
+        if not request.user.has_perm('experiments.change_experiment'):
+            return HttpResponseForbidden()
+
+        experiments = Experiment.objects.in_bulk([request.GET.get("experiment"), request.GET.get("other")])
+        try:
+            experiment, other_experiment = experiments[request.GET.get("experiment")], experiments[request.GET.get("other")]
+        except KeyError:
+            return HttpResponseBadRequest()
+
+        try:
+            overlap = ExperimentCounter().overlap(experiment, other_experiment)
+        except NotImplementedError as e:
+            return HttpResponseBadRequest(str(e))
+        return JsonResponse({
+            'overlap': [
+                {'alternative': alternative, 'other_alternative': other_alternative, 'participants': participants}
+                for (alternative, other_alternative), participants in sorted(overlap.items())
+            ],
+        })
+
+    def rollups_view(self, request):
+        """
+        Returns the participants and goals of each rollup interval over the last days
+        """
+        if not request.user.has_perm('experiments.change_experiment'):
+            return HttpResponseForbidden()
+
+        try:
+            experiment = Experiment.objects.get(name=request.GET.get("experiment"))
+            days = int(request.GET.get("days", 30))
+        except (Experiment.DoesNotExist, ValueError):
+            return HttpResponseBadRequest()
+
+        end = timezone.now()
+        try:
+            rollups = ExperimentCounter().rollups(experiment, end - timedelta(days=days), end)
+        except NotImplementedError as e:
+            return HttpResponseBadRequest(str(e))
+        return JsonResponse({
+            'intervals': [
+                {
+                    'start': start.isoformat(),
+                    'participants': dict(results.participants),
+                    'goals': dict((goal, dict((alternative, count) for (alternative, alternative_goal), count in results.goals.items() if alternative_goal == goal)) for goal in conf.ALL_GOALS),
+                }
+                for start, results in rollups
+            ],
+        })
+
 admin.site.register(Experiment, ExperimentAdmin)
 
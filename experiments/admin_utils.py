@@ -120,12 +120,14 @@ def get_result_context(request, experiment):
         mwu_goals = [u'']
     relevant_goals = set(chi2_goals + mwu_goals)
 
+    snapshot = experiment_counter.snapshot(experiment, include_distributions=mwu_goals)
+
     alternatives = {}
     for alternative_name in experiment.alternatives.keys():
-        alternatives[alternative_name] = experiment_counter.participant_count(experiment, alternative_name)
+        alternatives[alternative_name] = snapshot.participant_count(alternative_name)
     alternatives = sorted(alternatives.items())
 
-    control_participants = experiment_counter.participant_count(experiment, conf.CONTROL_GROUP)
+    control_participants = snapshot.participant_count(conf.CONTROL_GROUP)
 
     results = {}
 
@@ -133,24 +135,24 @@ def get_result_context(request, experiment):
         show_mwu = goal in mwu_goals
 
         alternatives_conversions = {}
-        control_conversions = experiment_counter.goal_count(experiment, conf.CONTROL_GROUP, goal)
+        control_conversions = snapshot.goal_count(conf.CONTROL_GROUP, goal)
         control_conversion_rate = rate(control_conversions, control_participants)
 
         if show_mwu:
             mwu_histogram = {}
-            control_conversion_distribution = fixup_distribution(experiment_counter.goal_distribution(experiment, conf.CONTROL_GROUP, goal), control_participants)
+            control_conversion_distribution = fixup_distribution(snapshot.goal_distribution(conf.CONTROL_GROUP, goal), control_participants)
             control_average_goal_actions = average_actions(control_conversion_distribution)
             mwu_histogram['control'] = control_conversion_distribution
         else:
             control_average_goal_actions = None
         for alternative_name in experiment.alternatives.keys():
             if not alternative_name == conf.CONTROL_GROUP:
-                alternative_conversions = experiment_counter.goal_count(experiment, alternative_name, goal)
-                alternative_participants = experiment_counter.participant_count(experiment, alternative_name)
+                alternative_conversions = snapshot.goal_count(alternative_name, goal)
+                alternative_participants = snapshot.participant_count(alternative_name)
                 alternative_conversion_rate = rate(alternative_conversions, alternative_participants)
                 alternative_confidence = chi_squared_confidence(alternative_participants, alternative_conversions, control_participants, control_conversions)
                 if show_mwu:
-                    alternative_conversion_distribution = fixup_distribution(experiment_counter.goal_distribution(experiment, alternative_name, goal), alternative_participants)
+                    alternative_conversion_distribution = fixup_distribution(snapshot.goal_distribution(alternative_name, goal), alternative_participants)
                     alternative_average_goal_actions = average_actions(alternative_conversion_distribution)
                     alternative_distribution_confidence = mann_whitney_confidence(alternative_conversion_distribution, control_conversion_distribution)
                     mwu_histogram[alternative_name] = alternative_conversion_distribution
@@ -14,6 +14,12 @@ BUILT_IN_GOALS = (
 
 SESSION_LENGTH = getattr(settings, 'EXPERIMENTS_SESSION_LENGTH', 6)
 
+# The longest time, in hours, that the retention middleware waits before checking for a new visit
+RETENTION_CHECK_INTERVAL = getattr(settings, 'EXPERIMENTS_RETENTION_CHECK_INTERVAL', SESSION_LENGTH)
+
+# Record retention visits and cookie goals once the response has been sent
+RETENTION_DEFERRED = getattr(settings, 'EXPERIMENTS_RETENTION_DEFERRED', False)
+
 USER_GOALS = getattr(settings, 'EXPERIMENTS_GOALS', [])
 ALL_GOALS = tuple(chain(USER_GOALS, BUILT_IN_GOALS))
 
@@ -25,4 +31,56 @@ CONFIRM_HUMAN_SESSION_KEY = getattr(settings, 'EXPERIMENTS_CONFIRM_HUMAN_SESSION
 
 REDIS_GOALS_TTL = getattr(settings, 'EXPERIMENTS_REDIS_GOALS_TTL', 300)
 
+# The class storing participant and goal counters, see experiments.counters
+COUNTER_BACKEND = getattr(settings, 'EXPERIMENTS_COUNTER_BACKEND', 'experiments.counters.RedisCounters')
+
+# The SQL counter backend keeps up to this many increments in memory, for at most
+# this many seconds, before writing them in bulk. A size of 0 writes them straight away.
+SQL_COUNTER_BUFFER_SIZE = getattr(settings, 'EXPERIMENTS_SQL_COUNTER_BUFFER_SIZE', 100)
+SQL_COUNTER_BUFFER_SECONDS = getattr(settings, 'EXPERIMENTS_SQL_COUNTER_BUFFER_SECONDS', 1)
+
+# Counters are deleted this many keys at a time, pausing for this many seconds between batches.
+# Deleting in the background records the deletion in redis and carries it out in a thread.
+COUNTER_DELETE_BATCH_SIZE = getattr(settings, 'EXPERIMENTS_COUNTER_DELETE_BATCH_SIZE', 1000)
+COUNTER_DELETE_PAUSE = getattr(settings, 'EXPERIMENTS_COUNTER_DELETE_PAUSE', 0)
+COUNTER_DELETE_IN_BACKGROUND = getattr(settings, 'EXPERIMENTS_COUNTER_DELETE_IN_BACKGROUND', False)
+
+# Store participants in redis counters as integers, interned once, instead of their full identifiers.
+# This should be chosen before any experiment starts, as the two kinds of fields are counted separately.
+COMPACT_PARTICIPANT_IDS = getattr(settings, 'EXPERIMENTS_COMPACT_PARTICIPANT_IDS', False)
+
+# Also keep a bitmap of the participants in each redis counter, by interned id, for funnel and overlap reports
+COUNTER_BITMAPS = getattr(settings, 'EXPERIMENTS_COUNTER_BITMAPS', False)
+
+# Also count, for every interval of this many seconds, the participants added to each counter.
+# Each rollup interval expires this many seconds after a participant was last counted in it.
+COUNTER_ROLLUP_INTERVAL = getattr(settings, 'EXPERIMENTS_COUNTER_ROLLUP_INTERVAL', None)
+COUNTER_ROLLUP_TTL = getattr(settings, 'EXPERIMENTS_COUNTER_ROLLUP_TTL', 90 * 24 * 3600)
+
+# Aggregate counter writes in memory and send them from a background thread, every this many
+# seconds or once this many participants are waiting. Past the maximum, further writes are either
+# sent by the request that makes them ('flush') or dropped ('drop').
+COUNTER_WRITE_BEHIND = getattr(settings, 'EXPERIMENTS_COUNTER_WRITE_BEHIND', False)
+COUNTER_WRITE_BEHIND_SECONDS = getattr(settings, 'EXPERIMENTS_COUNTER_WRITE_BEHIND_SECONDS', 0.5)
+COUNTER_WRITE_BEHIND_SIZE = getattr(settings, 'EXPERIMENTS_COUNTER_WRITE_BEHIND_SIZE', 1000)
+COUNTER_WRITE_BEHIND_MAX_SIZE = getattr(settings, 'EXPERIMENTS_COUNTER_WRITE_BEHIND_MAX_SIZE', 100000)
+COUNTER_WRITE_BEHIND_OVERFLOW = getattr(settings, 'EXPERIMENTS_COUNTER_WRITE_BEHIND_OVERFLOW', 'flush')
+
+# Append counter writes that could not be sent to redis to files in this directory, one per process,
+# syncing them at most every this many seconds. They are replayed once redis is back, or with the
+# experiments_replay_spool command, this many spooled batches per transaction.
+COUNTER_SPOOL_DIR = getattr(settings, 'EXPERIMENTS_COUNTER_SPOOL_DIR', None)
+COUNTER_SPOOL_FSYNC_SECONDS = getattr(settings, 'EXPERIMENTS_COUNTER_SPOOL_FSYNC_SECONDS', 1)
+COUNTER_SPOOL_REPLAY_BATCH_SIZE = getattr(settings, 'EXPERIMENTS_COUNTER_SPOOL_REPLAY_BATCH_SIZE', 100)
+
+# Only use alternatives registered ahead of time (see the experiments_sync command), skipping
+# the check for new alternatives whenever an experiment is rendered or enrolled in
+STRICT_ALTERNATIVES = getattr(settings, 'EXPERIMENTS_STRICT_ALTERNATIVES', False)
+
+# Serve experiment lookups from a per process snapshot, invalidated through redis pub/sub
+CONFIG_SNAPSHOT = getattr(settings, 'EXPERIMENTS_CONFIG_SNAPSHOT', False)
+
+# Seconds before a snapshot is loaded again even if no change was published
+CONFIG_SNAPSHOT_TTL = getattr(settings, 'EXPERIMENTS_CONFIG_SNAPSHOT_TTL', 60)
+
 BOT_REGEX = re.compile("(Baidu|Gigabot|Googlebot|YandexBot|AhrefsBot|TVersity|libwww-perl|Yeti|lwp-trivial|msnbot|bingbot|facebookexternalhit|Twitterbot|Twitmunin|SiteUptime|TwitterFeed|Slurp|WordPress|ZIBB|ZyBorg)", re.IGNORECASE)
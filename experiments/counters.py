@@ -1,120 +1,1114 @@
+from asgiref.sync import sync_to_async
 from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
 
-from redis.exceptions import ConnectionError, ResponseError
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
 
-from experiments.redis_client import get_redis_client
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
 
+from experiments.redis_client import CircuitOpenError, get_async_redis_client, get_circuit_breaker, get_redis_client, sending
+from experiments import conf, spool
+
+logger = logging.getLogger('experiments')
 
 COUNTER_CACHE_KEY = 'experiments:participants:%s'
 COUNTER_FREQ_CACHE_KEY = 'experiments:freq:%s'
+COUNTER_UNIQUE_CACHE_KEY = 'experiments:unique:%s'
+COUNTER_BITMAP_CACHE_KEY = 'experiments:bitmap:%s'
+COUNTER_ROLLUP_CACHE_KEY = 'experiments:rollup:%s'
+# Each rollup bucket of a counter is a key of its own, so that old buckets expire
+COUNTER_ROLLUP_BUCKET_KEY = COUNTER_ROLLUP_CACHE_KEY + ':%s'
+COUNTER_KEY_PATTERNS = (COUNTER_CACHE_KEY, COUNTER_FREQ_CACHE_KEY, COUNTER_UNIQUE_CACHE_KEY, COUNTER_BITMAP_CACHE_KEY, COUNTER_ROLLUP_CACHE_KEY)
+
+# Deletions waiting to be carried out, a hash of key pattern to SCAN cursor
+DELETIONS_KEY = 'experiments:deletions'
+DELETIONS_LOCK_KEY = 'experiments:deletions:lock'
+
+# Marks a spooled batch of writes as replayed, for long enough to outlive any replay of its file
+SPOOL_REPLAYED_KEY = 'experiments:spool:replayed:%s'
+SPOOL_REPLAYED_TTL = 24 * 3600
+
+# Participant identifiers interned as dense integers, see conf.COMPACT_PARTICIPANT_IDS and conf.COUNTER_BITMAPS.
+# A hash of identifier to integer, and the last integer handed out.
+PARTICIPANT_IDS_KEY = 'experiments:participant_ids'
+PARTICIPANT_IDS_NEXT_KEY = 'experiments:participant_ids:next'
+# Interned identifiers are kept when counters are deleted, as other counters may use them, and are
+# removed by RedisCounters.prune_participant_ids. While it runs, the ids counted are added to a set.
+PARTICIPANT_IDS_PRUNE_LOCK_KEY = 'experiments:participant_ids:prune'
+PARTICIPANT_IDS_COUNTED_KEY = 'experiments:participant_ids:counted'
+
+# Sets participant_id to the participant's interned integer, if the counter hashes use them
+# (compact is true) or a bitmap is kept, handing one out on first use if create is true.
+# Sets participant to the field used for them in the counter hashes.
+PARTICIPANT_FIELD = """
+local participant_id = false
+if compact or bitmap then
+    participant_id = redis.call('HGET', KEYS[3], ARGV[1])
+    if not participant_id and create then
+        participant_id = redis.call('INCR', KEYS[4])
+        redis.call('HSET', KEYS[3], ARGV[1], participant_id)
+    end
+end
+local participant = ARGV[1]
+if compact then
+    participant = participant_id
+end
+"""
+
+# Bitmaps are split by participant id into chunks of BITMAP_CHUNK_SIZE ids, held in keys of
+# their own next to a set of the chunks in use, so that a bitmap only takes memory for the ids
+# of its participants rather than for every id handed out. A chunk is a set of offsets until it
+# holds more than BITMAP_SPARSE_SIZE participants, which Redis keeps as a small array of integers,
+# then a string of bits of at most BITMAP_CHUNK_SIZE / 8 bytes. Chunk keys are derived from the
+# bitmap key in the scripts, so they are not declared, which Redis Cluster would reject.
+BITMAP_CHUNK_SIZE = 65536
+BITMAP_SPARSE_SIZE = 512
+
+# Sets chunk to the key of the participant's chunk in the bitmap KEYS[5], index to its number
+# and offset to the participant's place in it.
+BITMAP_CHUNK = """
+local index = math.floor(tonumber(participant_id) / %(chunk_size)s)
+local chunk = KEYS[5] .. ':' .. index
+local offset = tonumber(participant_id) %% %(chunk_size)s
+""" % {'chunk_size': BITMAP_CHUNK_SIZE}
+
+# Increment a participant's count and move them between buckets of the frequency histogram
+# in a single atomic step. Also adds them to the bitmap, and counts them in the rollup
+# bucket if this is the first time they are counted.
+# KEYS: participant hash, frequency hash, participant ids, next participant id, set of the bitmap's chunks,
+# rollup bucket, participant ids counted during a prune.
+# ARGV: participant, count, 1 to use interned participant ids in the hashes, 1 to keep a bitmap,
+# 1 to count the participant in the rollup bucket, rollup TTL.
+INCREMENT_SCRIPT = """
+local create = true
+local compact = ARGV[3] == '1'
+local bitmap = ARGV[4] == '1'
+""" + PARTICIPANT_FIELD + """
+if participant_id and redis.call('EXISTS', KEYS[7]) == 1 then
+    redis.call('SADD', KEYS[7], participant_id)
+end
+local count = tonumber(ARGV[2])
+local new_value = redis.call('HINCRBY', KEYS[1], participant, count)
+if new_value > count then
+    redis.call('HINCRBY', KEYS[2], new_value - count, -1)
+elseif ARGV[5] == '1' then
+    redis.call('INCR', KEYS[6])
+    redis.call('EXPIRE', KEYS[6], ARGV[6])
+end
+redis.call('HINCRBY', KEYS[2], new_value, 1)
+if bitmap then""" + BITMAP_CHUNK + """
+    redis.call('SADD', KEYS[5], index)
+    if redis.call('TYPE', chunk).ok == 'string' then
+        redis.call('SETBIT', chunk, offset, 1)
+    elseif redis.call('SADD', chunk, offset) == 1 and redis.call('SCARD', chunk) > %(sparse_size)s then
+        local offsets = redis.call('SMEMBERS', chunk)
+        redis.call('DEL', chunk)
+        for i = 1, #offsets do
+            redis.call('SETBIT', chunk, offsets[i], 1)
+        end
+    end
+end
+return new_value
+""" % {'sparse_size': BITMAP_SPARSE_SIZE}
+
+# Remove a participant and their entry in the frequency histogram and the bitmap.
+# KEYS: participant hash, frequency hash, participant ids, next participant id, set of the bitmap's chunks.
+# ARGV: participant, 1 to use interned participant ids in the hashes, 1 to keep a bitmap.
+CLEAR_SCRIPT = """
+local create = false
+local compact = ARGV[2] == '1'
+local bitmap = ARGV[3] == '1'
+""" + PARTICIPANT_FIELD + """
+if not participant then
+    return false
+end
+local freq = redis.call('HGET', KEYS[1], participant)
+if freq then
+    redis.call('HDEL', KEYS[1], participant)
+    redis.call('HINCRBY', KEYS[2], freq, -1)
+end
+if bitmap and participant_id then""" + BITMAP_CHUNK + """
+    if redis.call('TYPE', chunk).ok == 'string' then
+        redis.call('SETBIT', chunk, offset, 0)
+    else
+        redis.call('SREM', chunk, offset)
+    end
+end
+return freq
+"""
+
+# Count the participants in the first bitmap, then in each intersection with the next one,
+# chunk by chunk. The intersection within a chunk is a list of offsets while it is sparse, and
+# is held in KEYS[1] while both sides are strings of bits.
+# KEYS: a key to hold the intersection while counting, sets of the bitmaps' chunks.
+INTERSECTION_SCRIPT = """
+local counts = {}
+for i = 2, #KEYS do
+    counts[i - 1] = 0
+end
+local chunks = redis.call('SMEMBERS', KEYS[2])
+for c = 1, #chunks do
+    local chunk = KEYS[2] .. ':' .. chunks[c]
+    local offsets = false
+    local bits = false
+    if redis.call('TYPE', chunk).ok == 'string' then
+        bits = chunk
+        counts[1] = counts[1] + redis.call('BITCOUNT', chunk)
+    else
+        offsets = redis.call('SMEMBERS', chunk)
+        counts[1] = counts[1] + #offsets
+    end
+    for i = 3, #KEYS do
+        local other = KEYS[i] .. ':' .. chunks[c]
+        local other_type = redis.call('TYPE', other).ok
+        if bits and other_type == 'string' then
+            redis.call('BITOP', 'AND', KEYS[1], bits, other)
+            bits = KEYS[1]
+            counts[i - 1] = counts[i - 1] + redis.call('BITCOUNT', bits)
+        else
+            local candidates = offsets
+            if bits then
+                candidates = other_type == 'set' and redis.call('SMEMBERS', other) or {}
+            end
+            local found = {}
+            for o = 1, #candidates do
+                local hit
+                if bits then
+                    hit = redis.call('GETBIT', bits, candidates[o]) == 1
+                elseif other_type == 'string' then
+                    hit = redis.call('GETBIT', other, candidates[o]) == 1
+                else
+                    hit = redis.call('SISMEMBER', other, candidates[o]) == 1
+                end
+                if hit then
+                    found[#found + 1] = candidates[o]
+                end
+            end
+            offsets, bits = found, false
+            counts[i - 1] = counts[i - 1] + #found
+        end
+    end
+end
+redis.call('DEL', KEYS[1])
+return counts
+"""
+
+# The offsets set in a chunk of a bitmap held as a string of bits.
+# KEYS: the chunk.
+CHUNK_OFFSETS_SCRIPT = """
+local bits = redis.call('GET', KEYS[1]) or ''
+local offsets = {}
+for i = 1, #bits do
+    local byte = string.byte(bits, i)
+    for position = 7, 0, -1 do
+        if byte % 2 == 1 then
+            offsets[#offsets + 1] = (i - 1) * 8 + position
+        end
+        byte = math.floor(byte / 2)
+    end
+end
+return offsets
+"""
+
+# Remove interned identifiers unless they still map to another id or were counted since the prune started.
+# KEYS: participant ids, participant ids counted during the prune.
+# ARGV: pairs of identifier and id.
+PRUNE_PARTICIPANT_IDS_SCRIPT = """
+local removed = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] and redis.call('SISMEMBER', KEYS[2], ARGV[i + 1]) == 0 then
+        removed = removed + redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+INCREMENT = 'increment'
+CLEAR = 'clear'
+ADD_UNIQUE = 'add_unique'
+
+_local = threading.local()
+
+
+class CounterBatch(object):
+    """Counter writes queued on this thread, sent when the batch is flushed"""
+
+    def __init__(self):
+        self.writes = []
+        self.depth = 0
+
+    def add(self, counters, writes):
+        self.writes.append((counters, writes))
+
+    def flush(self):
+        # Consecutive writes for the same backend are sent together, in the order they were made
+        runs = []
+        for counters, writes in self.writes:
+            if runs and type(runs[-1][0]) is type(counters):
+                runs[-1][1].extend(writes)
+            else:
+                runs.append((counters, list(writes)))
+        for counters, writes in runs:
+            counters._send(writes)
+
+
+def start_batch():
+    """Queue counter writes made on this thread until the matching end_batch call
+
+    Batches nest, only the outermost end_batch sends the queued writes. Reads are
+    still executed immediately and will not see writes that are waiting in the batch."""
+    batch = getattr(_local, 'batch', None)
+    if batch is None:
+        batch = _local.batch = CounterBatch()
+    batch.depth += 1
+    return batch
+
+
+def end_batch():
+    batch = getattr(_local, 'batch', None)
+    if batch is None:
+        return
+    batch.depth -= 1
+    if batch.depth <= 0:
+        _local.batch = None
+        batch.flush()
+
+
+def discard_batch():
+    """Drop any batch left open on this thread without sending its writes"""
+    _local.batch = None
+
+
+@contextmanager
+def batch():
+    start_batch()
+    try:
+        yield
+    finally:
+        end_batch()
+
+
+class WriteBehindBuffer(object):
+    """Counter writes of this process for one backend, aggregated in memory and sent by a thread
+
+    Increments of a participant in a counter are added up until they are sent, so that a
+    participant hitting a goal many times costs one write. A clear replaces what was waiting
+    for the participant. Writes are sent every conf.COUNTER_WRITE_BEHIND_SECONDS, or sooner
+    once conf.COUNTER_WRITE_BEHIND_SIZE participants are waiting, and when the process exits."""
+
+    def __init__(self, counters):
+        self.counters = counters
+        self.dropped = 0
+        self._lock = threading.Lock()
+        # Held while sending, so that writes taken from the buffer are sent in order
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._increments = {}
+        self._unique = set()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._increments) + len(self._unique)
+
+    def add(self, writes):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked, what was waiting is sent by the parent
+                self._reset()
+            overflow = len(self) >= conf.COUNTER_WRITE_BEHIND_MAX_SIZE
+            if overflow and conf.COUNTER_WRITE_BEHIND_OVERFLOW == 'drop':
+                self.dropped += len(writes)
+                return
+            if not overflow:
+                self._aggregate(writes)
+                if self._thread is None:
+                    self._start()
+                if len(self) >= conf.COUNTER_WRITE_BEHIND_SIZE:
+                    self._wake.set()
+        if overflow:
+            # Hold the request back rather than lose counts, the sender has fallen behind
+            self.flush()
+            self.counters._write(writes)
+
+    def _aggregate(self, writes):
+        for operation, key, participant_identifier, count in writes:
+            if operation == ADD_UNIQUE:
+                self._unique.add((key, participant_identifier))
+                continue
+            pair = (key, participant_identifier)
+            if operation == CLEAR:
+                self._increments[pair] = [True, 0]
+            else:
+                self._increments.setdefault(pair, [False, 0])[1] += count
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='experiments-counter-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        _install_exit_hooks()
+
+    def _run(self):
+        while True:
+            self._wake.wait(conf.COUNTER_WRITE_BEHIND_SECONDS)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Keep the thread alive, the backend should have handled its own errors
+                logger.exception('Could not send experiment counter writes')
+
+    def flush(self):
+        """Send the writes waiting in the buffer"""
+        with self._flush_lock:
+            with self._lock:
+                increments, unique, dropped = self._increments, self._unique, self.dropped
+                self._increments, self._unique, self.dropped = {}, set(), 0
+            if dropped:
+                logger.warning('Dropped %s experiment counter writes, the write-behind buffer was full', dropped)
+
+            writes = []
+            for (key, participant_identifier), (cleared, count) in increments.items():
+                if cleared:
+                    writes.append((CLEAR, key, participant_identifier, None))
+                if count:
+                    writes.append((INCREMENT, key, participant_identifier, count))
+            writes.extend((ADD_UNIQUE, key, participant_identifier, None) for key, participant_identifier in unique)
+            for start in range(0, len(writes), conf.COUNTER_WRITE_BEHIND_SIZE):
+                self.counters._write(writes[start:start + conf.COUNTER_WRITE_BEHIND_SIZE])
+
+
+_write_behind_lock = threading.Lock()
+_write_behind_buffers = {}
+
+
+def write_behind_buffer(counters):
+    """Return the write-behind buffer of this process for the backend of counters"""
+    backend = type(counters)
+    buffer = _write_behind_buffers.get(backend)
+    if buffer is None:
+        with _write_behind_lock:
+            buffer = _write_behind_buffers.get(backend)
+            if buffer is None:
+                buffer = _write_behind_buffers[backend] = WriteBehindBuffer(counters)
+    return buffer
+
+
+def flush_write_behind():
+    """Send the counter writes waiting in this process, e.g. from a server's worker exit hook"""
+    for buffer in list(_write_behind_buffers.values()):
+        try:
+            buffer.flush()
+        except Exception:
+            logger.warning('Could not send experiment counter writes', exc_info=True)
+
+
+_exit_hooks_installed = False
+
 
+def _install_exit_hooks():
+    # Registered once the first buffer starts, so that atexit runs this before the exit hooks
+    # of the backends, which are registered when they are imported. Processes ended by a signal
+    # they don't handle skip atexit, servers send the writes from their own worker exit hooks.
+    global _exit_hooks_installed
+    if _exit_hooks_installed:
+        return
+    _exit_hooks_installed = True
+    atexit.register(flush_write_behind)
 
-class Counters(object):
+
+def rollup_bucket(timestamp):
+    """Return the start of the rollup interval holding timestamp, or None if rollups are disabled"""
+    if not conf.COUNTER_ROLLUP_INTERVAL:
+        return None
+    return int(timestamp // conf.COUNTER_ROLLUP_INTERVAL * conf.COUNTER_ROLLUP_INTERVAL)
+
+
+def rollup_buckets(start, end):
+    """Return the starts of the rollup intervals between the timestamps start and end"""
+    first = rollup_bucket(start)
+    if first is None:
+        return []
+    return list(range(first, int(end) + 1, conf.COUNTER_ROLLUP_INTERVAL))
+
+
+_backends = {}
+
+
+def get_counters():
+    """Return the counters backend chosen by the EXPERIMENTS_COUNTER_BACKEND setting"""
+    path = conf.COUNTER_BACKEND
+    backend = _backends.get(path)
+    if backend is None:
+        backend = _backends[path] = import_string(path)
+    return backend()
+
+
+class BaseCounters(object):
+    """The interface of counter backends
+
+    A counter holds a count for each participant that has been added to it. get returns
+    the number of participants and get_frequencies a histogram of their counts. Backends
+    implement _write, which applies a list of (INCREMENT or CLEAR, key, participant_identifier,
+    count) writes in order, and the read and reset methods. Writes may be held back in a batch
+    or in the write-behind buffer (see EXPERIMENTS_COUNTER_WRITE_BEHIND), which reads don't see. Backends are expected to swallow
+    their storage errors, so that experiments never break the site."""
+
+    def increment(self, key, participant_identifier, count=1):
+        self.increment_many([(key, participant_identifier, count)])
+
+    def increment_many(self, increments):
+        """Apply (key, participant_identifier, count) increments"""
+        self._queue([(INCREMENT, key, participant_identifier, count) for key, participant_identifier, count in increments if count != 0])
+
+    def clear(self, key, participant_identifier):
+        self.clear_many([(key, participant_identifier)])
+
+    def clear_many(self, clears):
+        """Remove (key, participant_identifier) pairs"""
+        self._queue([(CLEAR, key, participant_identifier, None) for key, participant_identifier in clears])
+
+    def add_unique(self, key, participant_identifier):
+        self.add_unique_many([(key, participant_identifier)])
+
+    def add_unique_many(self, pairs):
+        """Add (key, participant_identifier) pairs to approximate counters, read with get_unique
+
+        Approximate counters only tell how many participants were added, they can't be cleared
+        and have no frequencies. Backends that can't count approximately count exactly."""
+        self._queue(self._unique_writes(pairs))
+
+    def _unique_writes(self, pairs):
+        return [(INCREMENT, key, participant_identifier, 1) for key, participant_identifier in pairs]
+
+    async def aincrement(self, key, participant_identifier, count=1):
+        await self.aincrement_many([(key, participant_identifier, count)])
+
+    async def aincrement_many(self, increments):
+        await self._asend([(INCREMENT, key, participant_identifier, count) for key, participant_identifier, count in increments if count != 0])
+
+    async def aclear(self, key, participant_identifier):
+        await self.aclear_many([(key, participant_identifier)])
+
+    async def aclear_many(self, clears):
+        await self._asend([(CLEAR, key, participant_identifier, None) for key, participant_identifier in clears])
+
+    async def aadd_unique(self, key, participant_identifier):
+        await self.aadd_unique_many([(key, participant_identifier)])
+
+    async def aadd_unique_many(self, pairs):
+        await self._asend(self._unique_writes(pairs))
+
+    def get_unique(self, key):
+        return self.get_unique_many([key])[key]
+
+    def get_unique_many(self, keys):
+        counts, frequencies = self.get_many(keys)
+        return counts
+
+    def _queue(self, writes):
+        if not writes:
+            return
+        batch = getattr(_local, 'batch', None)
+        if batch is not None:
+            batch.add(self, writes)
+        else:
+            self._send(writes)
+
+    def _send(self, writes):
+        if conf.COUNTER_WRITE_BEHIND:
+            write_behind_buffer(self).add(writes)
+        else:
+            self._write(writes)
+
+    async def _asend(self, writes):
+        # Batches belong to a thread, so writes made from coroutines are never batched
+        if not writes:
+            return
+        if conf.COUNTER_WRITE_BEHIND:
+            write_behind_buffer(self).add(writes)
+        else:
+            await self._awrite(writes)
+
+    def _write(self, writes):
+        raise NotImplementedError
+
+    async def _awrite(self, writes):
+        # Backends without an asyncio client write from the thread the async ORM uses, so
+        # that database backends share its connections
+        await sync_to_async(self._write)(writes)
+
+    def get(self, key):
+        counts, frequencies = self.get_many([key])
+        return counts[key]
+
+    def get_many(self, keys, frequency_keys=()):
+        """Read the counts for keys and the frequency histograms for frequency_keys
+
+        Returns a tuple of two dicts, mapping each key to its count and each frequency key to its histogram."""
+        raise NotImplementedError
+
+    def get_frequency(self, key, participant_identifier):
+        raise NotImplementedError
+
+    def get_frequencies(self, key):
+        counts, frequencies = self.get_many((), [key])
+        return frequencies[key]
+
+    def intersection_counts(self, keys):
+        """Return the number of participants in the first key, then in it and the second key, and so on
+
+        Not every backend can intersect counters, those that can't raise NotImplementedError."""
+        raise NotImplementedError
+
+    def get_rollups(self, keys, start, end):
+        """Return the number of participants added to each key in each rollup interval between start and end
+
+        start and end are timestamps. The result maps keys to {interval start: count}, with
+        intervals that have no participants left out. Backends without rollups raise NotImplementedError."""
+        raise NotImplementedError
+
+    def reset(self, key):
+        raise NotImplementedError
+
+    def reset_pattern(self, pattern_key):
+        raise NotImplementedError
+
+    def reset_prefix(self, key_prefix):
+        raise NotImplementedError
+
+
+class MemoryCounters(BaseCounters):
+    """Counters held in this process, shared by all instances and safe to use from several threads
+
+    Counts are lost when the process exits, so this is meant for tests and single process deployments."""
+
+    _lock = threading.Lock()
+    _counts = {}
+    _frequencies = {}
+    _rollups = {}
+
+    def _write(self, writes):
+        with self._lock:
+            for operation, key, participant_identifier, count in writes:
+                counts = self._counts.setdefault(key, {})
+                frequencies = self._frequencies.setdefault(key, {})
+                old_value = counts.get(participant_identifier)
+                if operation == INCREMENT:
+                    new_value = counts[participant_identifier] = (old_value or 0) + count
+                    self._move(frequencies, old_value, new_value)
+                    bucket = rollup_bucket(time.time())
+                    if old_value is None and bucket is not None:
+                        rollups = self._rollups.setdefault(key, {})
+                        rollups[bucket] = rollups.get(bucket, 0) + 1
+                elif old_value is not None:
+                    del counts[participant_identifier]
+                    self._move(frequencies, old_value, None)
+
+    async def _awrite(self, writes):
+        # Nothing to wait for
+        self._write(writes)
+
+    def _move(self, frequencies, old_value, new_value):
+        if old_value is not None:
+            frequencies[old_value] -= 1
+            if not frequencies[old_value]:
+                del frequencies[old_value]
+        if new_value is not None:
+            frequencies[new_value] = frequencies.get(new_value, 0) + 1
+
+    def get_many(self, keys, frequency_keys=()):
+        with self._lock:
+            counts = dict((key, len(self._counts.get(key, ()))) for key in keys)
+            frequencies = dict((key, dict(self._frequencies.get(key, {}))) for key in frequency_keys)
+        return counts, frequencies
+
+    def get_frequency(self, key, participant_identifier):
+        with self._lock:
+            return self._counts.get(key, {}).get(participant_identifier, 0)
+
+    def intersection_counts(self, keys):
+        with self._lock:
+            participants = set(self._counts.get(keys[0], ()))
+            counts = [len(participants)]
+            for key in keys[1:]:
+                participants.intersection_update(self._counts.get(key, ()))
+                counts.append(len(participants))
+        return counts
+
+    def get_rollups(self, keys, start, end):
+        buckets = set(rollup_buckets(start, end))
+        with self._lock:
+            return dict(
+                (key, dict((bucket, count) for bucket, count in self._rollups.get(key, {}).items() if bucket in buckets))
+                for key in keys
+            )
+
+    def _delete(self, matches):
+        with self._lock:
+            for key in [key for key in self._counts if matches(key)]:
+                del self._counts[key]
+                self._frequencies.pop(key, None)
+                self._rollups.pop(key, None)
+        return True
+
+    def reset(self, key):
+        return self._delete(lambda other_key: other_key == key)
+
+    def reset_pattern(self, pattern_key):
+        return self._delete(lambda key: fnmatchcase(key, pattern_key))
+
+    def reset_prefix(self, key_prefix):
+        self._delete(lambda key: key.startswith(key_prefix + ':'))
+
+
+class RedisCounters(BaseCounters):
+    """Counters stored in Redis hashes, the default backend"""
+
+    _has_unlink = True
 
     @cached_property
     def _redis(self):
         return get_redis_client()
 
-    def increment(self, key, participant_identifier, count=1):
-        if count == 0:
-            return
+    @cached_property
+    def _increment_script(self):
+        # Scripts are invoked with EVALSHA, falling back to loading them on NOSCRIPT
+        return self._redis.register_script(INCREMENT_SCRIPT)
+
+    @cached_property
+    def _clear_script(self):
+        return self._redis.register_script(CLEAR_SCRIPT)
+
+    @cached_property
+    def _intersection_script(self):
+        return self._redis.register_script(INTERSECTION_SCRIPT)
+
+    @cached_property
+    def _chunk_offsets_script(self):
+        return self._redis.register_script(CHUNK_OFFSETS_SCRIPT)
+
+    @cached_property
+    def _prune_participant_ids_script(self):
+        return self._redis.register_script(PRUNE_PARTICIPANT_IDS_SCRIPT)
+
+    def _write(self, writes):
+        with sending() as tracker:
+            try:
+                if len(writes) == 1:
+                    self._write_to(self._redis, *writes[0])
+                else:
+                    pipe = self._redis.pipeline(transaction=False)
+                    for write in writes:
+                        self._write_to(pipe, *write)
+                    pipe.execute()
+            except (ConnectionError, ResponseError, TimeoutError) as e:
+                self._write_failed(writes, e, tracker.sent)
+            else:
+                self._write_succeeded()
+
+    async def _awrite(self, writes):
+        with sending() as tracker:
+            try:
+                client = get_async_redis_client()
+                pipe = client.pipeline(transaction=False)
+                for write in writes:
+                    script, keys, args = self._command(*write)
+                    if script is None:
+                        pipe.pfadd(keys[0], *args)
+                    else:
+                        await _async_script(client, script)(keys=keys, args=args, client=pipe)
+                await pipe.execute()
+            except (ConnectionError, ResponseError, TimeoutError) as e:
+                self._write_failed(writes, e, tracker.sent)
+            else:
+                self._write_succeeded()
 
+    def _write_failed(self, writes, error, sent):
+        # Handle Redis failures gracefully, keeping the writes to replay if there is a spool.
+        # Writes that reached Redis before failing, e.g. with a timeout waiting for the reply,
+        # may have been applied and are not kept, so that a replay can't count them twice.
+        if isinstance(error, CircuitOpenError):
+            get_circuit_breaker().skipped(len(writes))
+        if not sent and not isinstance(error, ResponseError):
+            spool.append(writes)
+
+    def _write_succeeded(self):
+        if spool.is_open():
+            # Redis is back, replay what this process spooled in the meantime
+            spool.close()
+            start_replay()
+
+    def _command(self, operation, key, participant_identifier, count):
+        """Return the script (None for PFADD), keys and arguments that make a write"""
+        compact = 1 if conf.COMPACT_PARTICIPANT_IDS else 0
+        bitmap = 1 if conf.COUNTER_BITMAPS else 0
+        keys = [COUNTER_CACHE_KEY % key, COUNTER_FREQ_CACHE_KEY % key, PARTICIPANT_IDS_KEY, PARTICIPANT_IDS_NEXT_KEY, COUNTER_BITMAP_CACHE_KEY % key]
+        if operation == INCREMENT:
+            bucket = rollup_bucket(time.time())
+            keys.extend([COUNTER_ROLLUP_BUCKET_KEY % (key, bucket), PARTICIPANT_IDS_COUNTED_KEY])
+            return INCREMENT_SCRIPT, keys, [participant_identifier, count, compact, bitmap, 0 if bucket is None else 1, conf.COUNTER_ROLLUP_TTL]
+        elif operation == ADD_UNIQUE:
+            return None, [COUNTER_UNIQUE_CACHE_KEY % key], [participant_identifier]
+        return CLEAR_SCRIPT, keys, [participant_identifier, compact, bitmap]
+
+    def _write_to(self, client, operation, key, participant_identifier, count):
+        script, keys, args = self._command(operation, key, participant_identifier, count)
+        if script is None:
+            client.pfadd(keys[0], *args)
+        elif script is INCREMENT_SCRIPT:
+            # Maintain histogram of per-user counts in the same round trip
+            self._increment_script(keys=keys, args=args, client=client)
+        else:
+            # Remove the direct entry and its place in the histogram
+            self._clear_script(keys=keys, args=args, client=client)
+
+    def get(self, key):
         try:
             cache_key = COUNTER_CACHE_KEY % key
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            new_value = self._redis.hincrby(cache_key, participant_identifier, count)
+            return self._redis.hlen(cache_key)
+        except (ConnectionError, ResponseError, TimeoutError):
+            # Handle Redis failures gracefully
+            return 0
 
-            # Maintain histogram of per-user counts
-            if new_value > count:
-                self._redis.hincrby(freq_cache_key, new_value - count, -1)
-            self._redis.hincrby(freq_cache_key, new_value, 1)
-        except (ConnectionError, ResponseError):
+    def get_many(self, keys, frequency_keys=()):
+        # Everything is read in one pipeline
+        keys = list(keys)
+        frequency_keys = list(frequency_keys)
+        try:
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.hlen(COUNTER_CACHE_KEY % key)
+            for key in frequency_keys:
+                pipe.hgetall(COUNTER_FREQ_CACHE_KEY % key)
+            values = pipe.execute()
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
-            pass
+            return dict((key, 0) for key in keys), dict((key, {}) for key in frequency_keys)
 
-    def clear(self, key, participant_identifier):
+        counts = dict(zip(keys, values[:len(keys)]))
+        frequencies = dict(
+            (key, dict((int(k), int(v)) for (k, v) in histogram.items() if int(v) > 0))
+            for key, histogram in zip(frequency_keys, values[len(keys):])
+        )
+        return counts, frequencies
+
+    def _unique_writes(self, pairs):
+        # HyperLogLogs, counting with a standard error of 0.81% in at most 12kB per key
+        return [(ADD_UNIQUE, key, participant_identifier, None) for key, participant_identifier in pairs]
+
+    def get_unique_many(self, keys):
+        keys = list(keys)
         try:
-            # Remove the direct entry
-            cache_key = COUNTER_CACHE_KEY % key
-            pipe = self._redis.pipeline()
-            freq, _ = pipe.hget(cache_key, participant_identifier).hdel(cache_key, participant_identifier).execute()
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.pfcount(COUNTER_UNIQUE_CACHE_KEY % key)
+            return dict(zip(keys, pipe.execute()))
+        except (ConnectionError, ResponseError, TimeoutError):
+            # Handle Redis failures gracefully
+            return dict((key, 0) for key in keys)
 
-            # Remove from the histogram
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            self._redis.hincrby(freq_cache_key, freq or 0, -1)
-        except (ConnectionError, ResponseError):
+    def intersection_counts(self, keys):
+        # Computed in Redis from the bitmaps kept with EXPERIMENTS_COUNTER_BITMAPS
+        if not conf.COUNTER_BITMAPS:
+            raise NotImplementedError("Counters can only be intersected with EXPERIMENTS_COUNTER_BITMAPS")
+        keys = list(keys)
+        try:
+            destination = COUNTER_BITMAP_CACHE_KEY % ('intersection:%s' % uuid.uuid4().hex)
+            return self._intersection_script(keys=[destination] + [COUNTER_BITMAP_CACHE_KEY % key for key in keys])
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
-            pass
+            return [0] * len(keys)
 
-    def get(self, key):
+    def get_rollups(self, keys, start, end):
+        if not conf.COUNTER_ROLLUP_INTERVAL:
+            raise NotImplementedError("Counters only have rollups with EXPERIMENTS_COUNTER_ROLLUP_INTERVAL")
+        keys = list(keys)
+        buckets = rollup_buckets(start, end)
+        if not buckets:
+            return dict((key, {}) for key in keys)
         try:
-            cache_key = COUNTER_CACHE_KEY % key
-            return self._redis.hlen(cache_key)
-        except (ConnectionError, ResponseError):
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.mget([COUNTER_ROLLUP_BUCKET_KEY % (key, bucket) for bucket in buckets])
+            values = pipe.execute()
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
-            return 0
+            return dict((key, {}) for key in keys)
+        return dict(
+            (key, dict((bucket, int(count)) for bucket, count in zip(buckets, counts) if count))
+            for key, counts in zip(keys, values)
+        )
 
     def get_frequency(self, key, participant_identifier):
         try:
             cache_key = COUNTER_CACHE_KEY % key
+            if conf.COMPACT_PARTICIPANT_IDS:
+                participant_identifier = self._redis.hget(PARTICIPANT_IDS_KEY, participant_identifier)
+                if participant_identifier is None:
+                    return 0
             freq = self._redis.hget(cache_key, participant_identifier)
             return int(freq) if freq else 0
-        except (ConnectionError, ResponseError):
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
             return 0
 
     def get_frequencies(self, key):
         try:
             freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            # In some cases when there are concurrent updates going on, there can
-            # briefly be a negative result for some frequency count. We discard these
-            # as they shouldn't really affect the result, and they are about to become
-            # zero anyway.
+            # Histograms written before increments were scripted could briefly hold a
+            # negative result for some frequency count under concurrent updates. We
+            # discard these as they shouldn't really affect the result.
             return dict((int(k), int(v)) for (k, v) in self._redis.hgetall(freq_cache_key).items() if int(v) > 0)
-        except (ConnectionError, ResponseError):
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
             return dict()
 
     def reset(self, key):
         try:
-            cache_key = COUNTER_CACHE_KEY % key
-            self._redis.delete(cache_key)
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % key
-            self._redis.delete(freq_cache_key)
+            bitmap_key = COUNTER_BITMAP_CACHE_KEY % key
+            chunks = ['%s:%s' % (bitmap_key, index) for index in self._redis.smembers(bitmap_key)]
+            self._unlink(self._redis, [key_pattern % key for key_pattern in COUNTER_KEY_PATTERNS] + chunks)
+            # Rollup buckets expire COUNTER_ROLLUP_TTL after the end of their interval at the latest
+            now = time.time()
+            buckets = [COUNTER_ROLLUP_BUCKET_KEY % (key, bucket) for bucket in rollup_buckets(now - conf.COUNTER_ROLLUP_TTL - (conf.COUNTER_ROLLUP_INTERVAL or 0), now)]
+            for start in range(0, len(buckets), conf.COUNTER_DELETE_BATCH_SIZE):
+                self._unlink(self._redis, buckets[start:start + conf.COUNTER_DELETE_BATCH_SIZE])
             return True
-        except (ConnectionError, ResponseError):
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
             return False
 
     def reset_pattern(self, pattern_key):
         #similar to above, but can pass pattern as arg instead
+        matches = [key_pattern % pattern_key for key_pattern in COUNTER_KEY_PATTERNS]
+        matches += ['%s:*' % (key_pattern % pattern_key) for key_pattern in (COUNTER_BITMAP_CACHE_KEY, COUNTER_ROLLUP_CACHE_KEY)]
+        return self._delete_matching(matches)
+
+    def reset_prefix(self, key_prefix):
+        # Delete all data in redis for a given key prefix
+        self._delete_matching(["%s:*" % (key_pattern % key_prefix) for key_pattern in COUNTER_KEY_PATTERNS])
+
+    def _delete_matching(self, matches):
+        """Delete the keys matching any of the glob style patterns, without blocking Redis
+
+        Keys are found with SCAN and removed with UNLINK, which frees them in the background,
+        conf.COUNTER_DELETE_BATCH_SIZE at a time. With conf.COUNTER_DELETE_IN_BACKGROUND the
+        deletion is recorded in Redis and carried out by a thread, see run_deletions."""
         try:
-            cache_key = COUNTER_CACHE_KEY % pattern_key
-            for key in self._redis.keys(cache_key):
-                self._redis.delete(key)
-            freq_cache_key = COUNTER_FREQ_CACHE_KEY % pattern_key
-            for key in self._redis.keys(freq_cache_key):
-                self._redis.delete(key)
+            if conf.COUNTER_DELETE_IN_BACKGROUND:
+                self._redis.hset(DELETIONS_KEY, mapping=dict((match, 0) for match in matches))
+                start_deletions()
+            else:
+                for match in matches:
+                    cursor = 0
+                    while True:
+                        cursor = self._delete_batch(match, cursor)
+                        if not cursor:
+                            break
             return True
-        except (ConnectionError, ResponseError):
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
             return False
-     
-    def reset_prefix(self, key_prefix):
-        # Delete all data in redis for a given key prefix
-        from experiments.utils import grouper
-        
+
+    def _delete_batch(self, match, cursor):
+        # Returns the cursor to continue from, 0 once every matching key has been seen
+        cursor, keys = self._redis.scan(cursor, match=match, count=conf.COUNTER_DELETE_BATCH_SIZE)
+        if keys:
+            self._unlink(self._redis, keys)
+            if conf.COUNTER_DELETE_PAUSE:
+                # Leave room for other traffic between batches
+                time.sleep(conf.COUNTER_DELETE_PAUSE)
+        return int(cursor)
+
+    def _unlink(self, client, keys):
+        if RedisCounters._has_unlink:
+            try:
+                return client.unlink(*keys)
+            except ResponseError as e:
+                if 'unknown command' not in str(e).lower():
+                    raise
+                # UNLINK was added in Redis 4.0
+                RedisCounters._has_unlink = False
+        return client.delete(*keys)
+
+    def run_deletions(self):
+        """Carry out the deletions recorded in Redis, returning once there are none left
+
+        Progress is stored after every batch, so deletions interrupted by a restart carry on from
+        where they were. Only one process works on them at a time."""
+        lock_timeout = max(60, int(conf.COUNTER_DELETE_PAUSE * 10))
         try:
-            for key_pattern in [COUNTER_CACHE_KEY, COUNTER_FREQ_CACHE_KEY]:
-                match = "%s:*" % (key_pattern % key_prefix)
-                key_iter = self._redis.scan_iter(match)
-
-                # Delete keys in groups of 1000 to prevent problems with long
-                # running experiments having many participants
-                for keys in grouper(key_iter, 1000):
-                    # The last group will be padded with None to reach the specified batch
-                    # size, so these are filtered out here
-                    self._redis.delete(*filter(None, keys))
-        except (ConnectionError, ResponseError):
-            # Handle Redis failures gracefully
-            pass
+            if not self._redis.set(DELETIONS_LOCK_KEY, os.getpid(), nx=True, ex=lock_timeout):
+                return False
+            try:
+                while True:
+                    deletions = self._redis.hgetall(DELETIONS_KEY)
+                    if not deletions:
+                        return True
+                    for match, cursor in deletions.items():
+                        cursor = self._delete_batch(match, int(cursor))
+                        if cursor:
+                            self._redis.hset(DELETIONS_KEY, match, cursor)
+                        else:
+                            self._redis.hdel(DELETIONS_KEY, match)
+                        self._redis.expire(DELETIONS_LOCK_KEY, lock_timeout)
+            finally:
+                self._redis.delete(DELETIONS_LOCK_KEY)
+        except (ConnectionError, ResponseError, TimeoutError):
+            # Handle Redis failures gracefully, the deletions are picked up again on the next run
+            return False
+
+    def prune_participant_ids(self):
+        """Remove the interned participant identifiers that no counter uses any more, returning how many
+
+        Counter hashes and bitmaps are scanned for the ids they hold, conf.COUNTER_DELETE_BATCH_SIZE
+        keys at a time, and ids counted while the scan runs are kept. Returns None if another prune is
+        running or Redis failed."""
+        lock_timeout = max(60, int(conf.COUNTER_DELETE_PAUSE * 10))
+        try:
+            if not self._redis.set(PARTICIPANT_IDS_PRUNE_LOCK_KEY, os.getpid(), nx=True, ex=lock_timeout):
+                return None
+            try:
+                # Tracks the ids counted from now on, the set never being empty while the prune runs
+                self._redis.delete(PARTICIPANT_IDS_COUNTED_KEY)
+                self._redis.sadd(PARTICIPANT_IDS_COUNTED_KEY, '')
+                self._redis.expire(PARTICIPANT_IDS_COUNTED_KEY, lock_timeout)
+
+                def batches(items):
+                    batch = []
+                    for item in items:
+                        batch.append(item)
+                        if len(batch) >= conf.COUNTER_DELETE_BATCH_SIZE:
+                            yield batch
+                            batch = []
+                            self._redis.expire(PARTICIPANT_IDS_PRUNE_LOCK_KEY, lock_timeout)
+                            self._redis.expire(PARTICIPANT_IDS_COUNTED_KEY, lock_timeout)
+                            if conf.COUNTER_DELETE_PAUSE:
+                                # Leave room for other traffic between batches
+                                time.sleep(conf.COUNTER_DELETE_PAUSE)
+                    if batch:
+                        yield batch
+
+                used = set()
+                for keys in batches(self._redis.scan_iter(COUNTER_CACHE_KEY % '*', count=conf.COUNTER_DELETE_BATCH_SIZE)):
+                    for key in keys:
+                        # Fields are ids with conf.COMPACT_PARTICIPANT_IDS, identifiers otherwise
+                        used.update(field for field in self._redis.hkeys(key) if field.isdigit())
+                for bitmap_keys in batches(self._redis.scan_iter(COUNTER_BITMAP_CACHE_KEY % '*', count=conf.COUNTER_DELETE_BATCH_SIZE)):
+                    for bitmap_key in bitmap_keys:
+                        used.update(self._bitmap_ids(bitmap_key))
+
+                removed = 0
+                for pairs in batches(self._redis.hscan_iter(PARTICIPANT_IDS_KEY, count=conf.COUNTER_DELETE_BATCH_SIZE)):
+                    unused = [value for identifier, participant_id in pairs if participant_id not in used for value in (identifier, participant_id)]
+                    if unused:
+                        removed += self._prune_participant_ids_script(keys=[PARTICIPANT_IDS_KEY, PARTICIPANT_IDS_COUNTED_KEY], args=unused)
+                return removed
+            finally:
+                self._redis.delete(PARTICIPANT_IDS_COUNTED_KEY, PARTICIPANT_IDS_PRUNE_LOCK_KEY)
+        except (ConnectionError, ResponseError, TimeoutError):
+            # Handle Redis failures gracefully, nothing is removed that is still used
+            return None
+
+    def _bitmap_ids(self, bitmap_key):
+        # The ids in the chunks of a bitmap, or nothing if the key is one of the chunks
+        ids = []
+        if self._redis.type(bitmap_key) != 'set':
+            return ids
+        for index in self._redis.smembers(bitmap_key):
+            chunk = '%s:%s' % (bitmap_key, index)
+            chunk_type = self._redis.type(chunk)
+            if chunk_type == 'string':
+                offsets = self._chunk_offsets_script(keys=[chunk])
+            elif chunk_type == 'set':
+                offsets = self._redis.smembers(chunk)
+            else:
+                continue
+            ids.extend(str(int(index) * BITMAP_CHUNK_SIZE + int(offset)) for offset in offsets)
+        return ids
+
+    def replay_spool(self):
+        """Send the counter writes spooled while Redis was unavailable, see experiments.spool
+
+        Each spooled batch is applied in a transaction together with a marker, and batches with a
+        marker are skipped, so replaying again after an interruption doesn't count anything twice.
+        Returns the number of writes sent, or None if Redis failed before every file was replayed."""
+        replayed = 0
+        try:
+            for path, spool_file in spool.replayable_files():
+                batches = spool.read(spool_file)
+                for start in range(0, len(batches), conf.COUNTER_SPOOL_REPLAY_BATCH_SIZE):
+                    replayed += self._replay_batches(batches[start:start + conf.COUNTER_SPOOL_REPLAY_BATCH_SIZE])
+                os.remove(path)
+        except (ConnectionError, ResponseError, TimeoutError):
+            # Handle Redis failures gracefully, the rest is replayed on the next run
+            return None
+        return replayed
+
+    def _replay_batches(self, batches):
+        markers = [SPOOL_REPLAYED_KEY % batch_id for batch_id, writes in batches]
+        replayed = self._redis.mget(markers)
+        pipe = self._redis.pipeline(transaction=True)
+        sent = 0
+        for (batch_id, writes), marker, done in zip(batches, markers, replayed):
+            if done:
+                continue
+            for write in writes:
+                self._write_to(pipe, *write)
+            pipe.set(marker, 1, ex=SPOOL_REPLAYED_TTL)
+            sent += len(writes)
+        if sent:
+            pipe.execute()
+        return sent
+
+
+_async_scripts = {}
+
+
+def _async_script(client, source):
+    # Scripts are always called with a client, the one they were registered with doesn't matter
+    script = _async_scripts.get(source)
+    if script is None:
+        script = _async_scripts[source] = client.register_script(source)
+    return script
+
+
+_deletions_thread = None
+
+
+def start_deletions():
+    """Run the recorded deletions in a thread of this process, unless one is already running"""
+    global _deletions_thread
+    if _deletions_thread is not None and _deletions_thread.is_alive():
+        return
+    _deletions_thread = threading.Thread(target=RedisCounters().run_deletions, name='experiments-counter-deletions')
+    _deletions_thread.daemon = True
+    _deletions_thread.start()
+
+
+_replay_thread = None
+
+
+def start_replay():
+    """Replay the spooled counter writes in a thread of this process, unless one is already running"""
+    global _replay_thread
+    if _replay_thread is not None and _replay_thread.is_alive():
+        return
+    _replay_thread = threading.Thread(target=RedisCounters().replay_spool, name='experiments-counter-replay')
+    _replay_thread.daemon = True
+    _replay_thread.start()
+
+
+# The Redis backend was the only one before backends could be configured
+Counters = RedisCounters
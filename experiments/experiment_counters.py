@@ -1,48 +1,193 @@
 from experiments import counters, conf
+from experiments.dateutils import USE_TZ, timestamp_from_datetime, datetime_from_timestamp
+from collections import namedtuple
+from datetime import datetime, timezone
 import logging
 import json
 
+try:
+    from types import MappingProxyType
+except ImportError:  # Python < 3.3
+    MappingProxyType = dict
+
 PARTICIPANT_KEY = '%s:%s:participant'
 GOAL_KEY = '%s:%s:%s:goal'
 
 logger = logging.getLogger('experiments')
 
+class ExperimentResults(namedtuple('ExperimentResults', ['participants', 'goals', 'distributions'])):
+    """A read-only snapshot of an experiment's counters, as returned by ExperimentCounter.snapshot"""
+    __slots__ = ()
+
+    def participant_count(self, alternative):
+        return self.participants.get(alternative, 0)
+
+    def goal_count(self, alternative, goal):
+        return self.goals.get((alternative, goal), 0)
+
+    def goal_distribution(self, alternative, goal):
+        # A copy, so that callers can fix up the distribution without changing the snapshot
+        return dict(self.distributions.get((alternative, goal), {}))
+
+
 class ExperimentCounter(object):
     def __init__(self):
-        self.counters = counters.Counters()
+        self.counters = counters.get_counters()
+
+    def _is_approximate(self, experiment, goal=None):
+        # Goal distributions need each participant's count, so relevant MWU goals are always exact
+        return experiment.approximate_counts and (goal is None or goal not in experiment.mwu_goals)
 
     def increment_participant_count(self, experiment, alternative_name, participant_identifier):
         counter_key = PARTICIPANT_KEY % (experiment.name, alternative_name)
-        self.counters.increment(counter_key, participant_identifier)
+        if self._is_approximate(experiment):
+            self.counters.add_unique(counter_key, participant_identifier)
+        else:
+            self.counters.increment(counter_key, participant_identifier)
         logger.info(json.dumps({'type':'participant_add', 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
 
     def increment_goal_count(self, experiment, alternative_name, goal_name, participant_identifier, count=1):
         counter_key = GOAL_KEY % (experiment.name, alternative_name, goal_name)
-        self.counters.increment(counter_key, participant_identifier, count)
+        if self._is_approximate(experiment, goal_name):
+            self.counters.add_unique(counter_key, participant_identifier)
+        else:
+            self.counters.increment(counter_key, participant_identifier, count)
         logger.info(json.dumps({'type':'goal_hit', 'goal': goal_name, 'goal_count': count, 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
 
-    def remove_participant(self, experiment, alternative_name, participant_identifier):
+    async def aincrement_participant_count(self, experiment, alternative_name, participant_identifier):
         counter_key = PARTICIPANT_KEY % (experiment.name, alternative_name)
-        self.counters.clear(counter_key, participant_identifier)
+        if self._is_approximate(experiment):
+            await self.counters.aadd_unique(counter_key, participant_identifier)
+        else:
+            await self.counters.aincrement(counter_key, participant_identifier)
+        logger.info(json.dumps({'type':'participant_add', 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
+
+    async def aincrement_goal_count(self, experiment, alternative_name, goal_name, participant_identifier, count=1):
+        counter_key = GOAL_KEY % (experiment.name, alternative_name, goal_name)
+        if self._is_approximate(experiment, goal_name):
+            await self.counters.aadd_unique(counter_key, participant_identifier)
+        else:
+            await self.counters.aincrement(counter_key, participant_identifier, count)
+        logger.info(json.dumps({'type':'goal_hit', 'goal': goal_name, 'goal_count': count, 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
+
+    def remove_participant(self, experiment, alternative_name, participant_identifier):
+        """Remove the participant from the alternative's exact counters, approximate ones keep counting them"""
+        if not self._is_approximate(experiment):
+            counter_key = PARTICIPANT_KEY % (experiment.name, alternative_name)
+            self.counters.clear(counter_key, participant_identifier)
         logger.info(json.dumps({'type':'participant_remove', 'experiment': experiment.name, 'alternative': alternative_name, 'participant': participant_identifier}))
 
         # Remove goal records
         for goal_name in conf.ALL_GOALS:
-            counter_key = GOAL_KEY % (experiment.name, alternative_name, goal_name)
-            self.counters.clear(counter_key, participant_identifier)
+            if not self._is_approximate(experiment, goal_name):
+                counter_key = GOAL_KEY % (experiment.name, alternative_name, goal_name)
+                self.counters.clear(counter_key, participant_identifier)
 
     def participant_count(self, experiment, alternative):
+        if self._is_approximate(experiment):
+            return self.counters.get_unique(PARTICIPANT_KEY % (experiment.name, alternative))
         return self.counters.get(PARTICIPANT_KEY % (experiment.name, alternative))
 
     def goal_count(self, experiment, alternative, goal):
+        if self._is_approximate(experiment, goal):
+            return self.counters.get_unique(GOAL_KEY % (experiment.name, alternative, goal))
         return self.counters.get(GOAL_KEY % (experiment.name, alternative, goal))
 
     def participant_goal_frequencies(self, experiment, alternative, participant_identifier):
+        """Yield the participant's count of each goal that is counted exactly"""
         for goal in conf.ALL_GOALS:
+            if self._is_approximate(experiment, goal):
+                continue
             yield goal, self.counters.get_frequency(GOAL_KEY % (experiment.name, alternative, goal), participant_identifier)
 
     def goal_distribution(self, experiment, alternative, goal):
         return self.counters.get_frequencies(GOAL_KEY % (experiment.name, alternative, goal))
 
+    def snapshot(self, experiment, goals=None, include_distributions=False):
+        """Read the participant and goal counts for every alternative of the experiment in one go
+
+        goals defaults to all goals. include_distributions can be True to also read the goal
+        distributions of every goal, or a collection of the goals to read distributions for."""
+        if goals is None:
+            goals = conf.ALL_GOALS
+        if include_distributions is True:
+            distribution_goals = list(goals)
+        elif include_distributions:
+            distribution_goals = [goal for goal in goals if goal in include_distributions]
+        else:
+            distribution_goals = []
+
+        alternatives = list(experiment.alternatives.keys())
+        if conf.CONTROL_GROUP not in alternatives:
+            alternatives.append(conf.CONTROL_GROUP)
+
+        participant_keys = dict((PARTICIPANT_KEY % (experiment.name, alternative), alternative) for alternative in alternatives)
+        goal_keys = dict((GOAL_KEY % (experiment.name, alternative, goal), (alternative, goal)) for alternative in alternatives for goal in goals)
+        distribution_keys = dict((GOAL_KEY % (experiment.name, alternative, goal), (alternative, goal)) for alternative in alternatives for goal in distribution_goals)
+
+        count_keys = list(participant_keys) + list(goal_keys)
+        unique_keys = set(key for key in participant_keys if self._is_approximate(experiment))
+        unique_keys.update(key for key, (alternative, goal) in goal_keys.items() if self._is_approximate(experiment, goal))
+
+        counts, frequencies = self.counters.get_many([key for key in count_keys if key not in unique_keys], distribution_keys)
+        if unique_keys:
+            counts.update(self.counters.get_unique_many(unique_keys))
+
+        return ExperimentResults(
+            participants=MappingProxyType(dict((participant_keys[key], counts[key]) for key in participant_keys)),
+            goals=MappingProxyType(dict((goal_keys[key], counts[key]) for key in goal_keys)),
+            distributions=MappingProxyType(dict((distribution_keys[key], MappingProxyType(frequencies[key])) for key in distribution_keys)),
+        )
+
+    def rollups(self, experiment, start, end, goals=None):
+        """Return (interval start, ExperimentResults) for each rollup interval between the datetimes start and end
+
+        The results of an interval count the participants that joined each alternative, and reached
+        each goal for the first time, during it. Needs EXPERIMENTS_COUNTER_ROLLUP_INTERVAL, approximate
+        counts have no rollups."""
+        if goals is None:
+            goals = conf.ALL_GOALS
+        alternatives = list(experiment.alternatives.keys())
+        if conf.CONTROL_GROUP not in alternatives:
+            alternatives.append(conf.CONTROL_GROUP)
+
+        participant_keys = dict((PARTICIPANT_KEY % (experiment.name, alternative), alternative) for alternative in alternatives)
+        goal_keys = dict((GOAL_KEY % (experiment.name, alternative, goal), (alternative, goal)) for alternative in alternatives for goal in goals)
+
+        start, end = timestamp_from_datetime(start), timestamp_from_datetime(end)
+        rollups = self.counters.get_rollups(list(participant_keys) + list(goal_keys), start, end)
+
+        results = []
+        for bucket in counters.rollup_buckets(start, end):
+            if USE_TZ:
+                bucket_start = datetime.fromtimestamp(bucket, timezone.utc)
+            else:
+                bucket_start = datetime_from_timestamp(bucket)
+            results.append((bucket_start, ExperimentResults(
+                participants=MappingProxyType(dict((alternative, rollups[key].get(bucket, 0)) for key, alternative in participant_keys.items())),
+                goals=MappingProxyType(dict((alternative_goal, rollups[key].get(bucket, 0)) for key, alternative_goal in goal_keys.items())),
+                distributions=MappingProxyType({}),
+            )))
+        return results
+
+    def funnel(self, experiment, alternative, goals):
+        """Return the number of participants in the alternative, then of those that hit the first goal,
+        of those that hit the first two goals, and so on
+
+        Goals are counted regardless of the order they were hit in. Raises NotImplementedError if the
+        counters backend can't intersect counters."""
+        keys = [PARTICIPANT_KEY % (experiment.name, alternative)]
+        keys += [GOAL_KEY % (experiment.name, alternative, goal) for goal in goals]
+        return self.counters.intersection_counts(keys)
+
+    def overlap(self, experiment, other_experiment):
+        """Return the number of participants in both experiments, by pair of alternatives"""
+        overlap = {}
+        for alternative in experiment.alternatives:
+            for other_alternative in other_experiment.alternatives:
+                keys = [PARTICIPANT_KEY % (experiment.name, alternative), PARTICIPANT_KEY % (other_experiment.name, other_alternative)]
+                overlap[(alternative, other_alternative)] = self.counters.intersection_counts(keys)[-1]
+        return overlap
+
     def delete(self, experiment):
         self.counters.reset_pattern(experiment.name + "*")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.counters import RedisCounters, DELETIONS_KEY
+
+
+class Command(BaseCommand):
+    help = ("Carries out the counter deletions recorded with EXPERIMENTS_COUNTER_DELETE_IN_BACKGROUND, "
+            "continuing any that were interrupted")
+
+    def handle(self, *args, **options):
+        counters = RedisCounters()
+        pending = counters._redis.hlen(DELETIONS_KEY)
+        if not pending:
+            self.stdout.write("No counter deletions pending")
+            return
+        if not counters.run_deletions():
+            raise CommandError("Counter deletions are already running in another process, or redis is unavailable")
+        self.stdout.write("Deleted the counters matching %s patterns" % pending)
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.counters import RedisCounters
+
+
+class Command(BaseCommand):
+    help = ("Removes the participant identifiers interned with EXPERIMENTS_COMPACT_PARTICIPANT_IDS or "
+            "EXPERIMENTS_COUNTER_BITMAPS that no counter uses any more, e.g. after deleting experiments")
+
+    def handle(self, *args, **options):
+        removed = RedisCounters().prune_participant_ids()
+        if removed is None:
+            raise CommandError("Participant ids are already being pruned in another process, or redis is unavailable")
+        self.stdout.write("Removed %s participant ids" % removed)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from experiments.counters import RedisCounters
+from experiments import spool
+
+
+class Command(BaseCommand):
+    help = ("Sends the counter writes spooled to EXPERIMENTS_COUNTER_SPOOL_DIR while redis was unavailable, "
+            "skipping any that were already replayed")
+
+    def handle(self, *args, **options):
+        pending = len(spool.spool_files())
+        if not pending:
+            self.stdout.write("No spooled counter writes")
+            return
+        replayed = RedisCounters().replay_spool()
+        if replayed is None:
+            raise CommandError("Redis is unavailable, the spooled counter writes will be replayed on the next run")
+        left = len(spool.spool_files())
+        self.stdout.write("Replayed %s counter writes from %s spool files" % (replayed, pending - left))
+        if left:
+            self.stdout.write("%s spool files are still being written to or replayed by another process" % left)
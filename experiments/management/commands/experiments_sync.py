@@ -0,0 +1,213 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.template import engines, TemplateSyntaxError
+from django.template.backends.django import DjangoTemplates
+from django.template.base import Lexer
+from django.template.utils import get_app_template_dirs
+from django.apps import apps
+
+from experiments.manager import experiment_manager
+from experiments.models import Experiment
+from experiments.templatetags.experiments import _parse_token_contents
+from experiments import conf
+
+from concurrent.futures import ProcessPoolExecutor
+import ast
+import io
+import multiprocessing
+import os
+
+try:
+    from django.template.base import TokenType
+    TOKEN_BLOCK = TokenType.BLOCK
+except ImportError:  # Django < 2.1
+    from django.template.base import TOKEN_BLOCK
+
+
+class Command(BaseCommand):
+    help = ("Registers the experiments and alternatives used in templates (and optionally python code) "
+            "so that they don't have to be stored when first rendered")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--python', action='store_true',
+                            help="Also scan the python code of installed apps for participant(...).enroll calls")
+        parser.add_argument('--path', action='append', dest='paths', default=[],
+                            help="Another directory to scan (templates, or python code with --python), can be repeated")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Number of processes parsing files, defaults to the number of CPUs")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="List what would be registered without storing it")
+
+    def handle(self, *args, **options):
+        files = []
+        for directory in template_directories() + options['paths']:
+            files.extend((path, find_template_alternatives) for path in walk(directory))
+        if options['python']:
+            for directory in [app_config.path for app_config in apps.get_app_configs()] + options['paths']:
+                files.extend((path, find_python_alternatives) for path in walk(directory) if path.endswith('.py'))
+
+        found = scan_files(set(files), options['workers'])
+
+        for experiment_name, alternatives in sorted(found.items()):
+            self.stdout.write("%s: %s" % (experiment_name, ", ".join(sorted(alternatives))))
+
+        if options['dry_run'] or not found:
+            return
+
+        changed = sync_experiments(found)
+        self.stdout.write("Registered alternatives for %s experiments, %s changed" % (len(found), changed))
+
+
+def template_directories():
+    directories = []
+    for engine in engines.all():
+        if isinstance(engine, DjangoTemplates):
+            directories.extend(engine.engine.dirs)
+            if engine.engine.app_dirs:
+                directories.extend(get_app_template_dirs('templates'))
+    return [str(directory) for directory in directories]
+
+
+def scan_files(files, workers=None):
+    """Parse (path, parser) pairs, returning a mapping of experiment names to {alternative: weight}"""
+    paths = [path for path, find_alternatives in files]
+    parsers = [find_alternatives for path, find_alternatives in files]
+    found = {}
+
+    def merge(results):
+        for alternatives in results:
+            for experiment_name, alternative, weight in alternatives:
+                experiment_alternatives = found.setdefault(experiment_name, {})
+                if experiment_alternatives.get(alternative) is None:
+                    experiment_alternatives[alternative] = weight
+
+    context = _fork_context()
+    if workers == 1 or context is None:
+        merge(map(scan_file, paths, parsers))
+    else:
+        # Parsing is CPU bound, so it is spread over processes rather than threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            merge(executor.map(scan_file, paths, parsers, chunksize=16))
+    return found
+
+
+def _fork_context():
+    # Workers need Django's settings and apps, which only forked processes inherit. Processes
+    # that are spawned, the default on macOS and Windows and from Python 3.14 on Linux, start
+    # without them, so files are parsed in this process where processes can't be forked.
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
+def walk(directory):
+    for root, dirs, filenames in os.walk(directory):
+        for filename in filenames:
+            yield os.path.join(root, filename)
+
+
+def scan_file(path, find_alternatives):
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            source = f.read()
+    except (IOError, UnicodeDecodeError):
+        return []
+    return list(find_alternatives(source))
+
+
+def _literal(token):
+    if len(token) >= 2 and token[0] == token[-1] and token[0] in ('"', "'"):
+        return token[1:-1]
+    return None
+
+
+def _weight(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def find_template_alternatives(source):
+    """Yield (experiment name, alternative, weight) for the experiment tags in a template"""
+    for token in Lexer(source).tokenize():
+        if token.token_type != TOKEN_BLOCK:
+            continue
+        bits = token.split_contents()
+        if bits[0] == 'experiment':
+            try:
+                experiment_name, alternative, weight, user_variable = _parse_token_contents(bits)
+            except (ValueError, TemplateSyntaxError):
+                continue
+            yield experiment_name, alternative, _weight(weight)
+        elif bits[0] == 'experiment_enroll':
+            # Only string literals can be known ahead of time
+            arguments = bits[1:-2] if len(bits) > 2 and bits[-2] == 'as' else bits[1:]
+            names = [_literal(argument) for argument in arguments if '=' not in argument]
+            if names and all(names):
+                for alternative in names[1:] + [conf.CONTROL_GROUP]:
+                    yield names[0], alternative, None
+
+
+def find_python_alternatives(source):
+    """Yield (experiment name, alternative, weight) for the enroll calls with literal arguments in python code"""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'enroll'):
+            continue
+        arguments = list(node.args[:2])
+        keywords = dict((keyword.arg, keyword.value) for keyword in node.keywords)
+        for index, name in enumerate(('experiment_name', 'alternatives')):
+            if len(arguments) <= index and name in keywords:
+                arguments.append(keywords[name])
+        if len(arguments) != 2:
+            continue
+        try:
+            experiment_name, alternatives = ast.literal_eval(arguments[0]), ast.literal_eval(arguments[1])
+        except ValueError:
+            continue
+        if not isinstance(experiment_name, str):
+            continue
+        if isinstance(alternatives, dict):
+            alternatives = dict(alternatives)
+            alternatives.setdefault(conf.CONTROL_GROUP, 1)
+            for alternative, weight in alternatives.items():
+                yield experiment_name, alternative, _weight(weight)
+        elif isinstance(alternatives, (list, tuple)):
+            for alternative in list(alternatives) + [conf.CONTROL_GROUP]:
+                yield experiment_name, alternative, None
+
+
+def sync_experiments(found):
+    """Store the alternatives, a mapping of experiment names to {alternative: weight}, in one transaction
+
+    Returns the number of experiments that were created or changed."""
+    with transaction.atomic():
+        existing = Experiment.objects.select_for_update().in_bulk(list(found))
+        created = []
+        updated = []
+        for experiment_name, alternatives in found.items():
+            experiment = existing.get(experiment_name)
+            if experiment is None:
+                experiment = Experiment(name=experiment_name, alternatives={})
+                created.append(experiment)
+            changed = False
+            for alternative, weight in alternatives.items():
+                if alternative not in experiment.alternatives:
+                    experiment.alternatives[alternative] = {'enabled': True}
+                    changed = True
+                if weight is not None and 'weight' not in experiment.alternatives[alternative]:
+                    experiment.alternatives[alternative]['weight'] = weight
+                    changed = True
+            if changed and experiment_name in existing:
+                updated.append(experiment)
+
+        Experiment.objects.bulk_create(created)
+        Experiment.objects.bulk_update(updated, ['alternatives'])
+
+    if created or updated:
+        experiment_manager.reload()
+    return len(created) + len(updated)
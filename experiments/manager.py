@@ -1,7 +1,28 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from experiments.models import Experiment
+from experiments.redis_client import get_redis_client
+from experiments import conf
 from modeldict import ModelDict
 
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+
+import logging
+import os
+import threading
+import time
+
+try:
+    from types import MappingProxyType
+except ImportError:  # Python < 3.3
+    MappingProxyType = dict
+
+logger = logging.getLogger('experiments')
+
+CONFIG_CHANGED_CHANNEL = 'experiments:config_changed'
+
 
 class LazyAutoCreate(object):
     """
@@ -14,7 +35,50 @@ class LazyAutoCreate(object):
         return getattr(settings, 'EXPERIMENTS_AUTO_CREATE', True)
 
 
+class ExperimentSnapshot(object):
+    """All experiments as they were when the snapshot was loaded, by name
+
+    The experiments are shared by every thread and must not be changed in place, see
+    Experiment.ensure_alternatives_exist which replaces alternatives rather than changing them."""
+
+    def __init__(self, experiments):
+        self.experiments = MappingProxyType(dict((experiment.name, experiment) for experiment in experiments))
+        for experiment in self.experiments.values():
+            # Computed up front so that requests sharing the snapshot never have to
+            if experiment.alternatives:
+                experiment.cumulative_weights()
+        self.loaded_at = time.time()
+
+    def __contains__(self, experiment_name):
+        return experiment_name in self.experiments
+
+    def __getitem__(self, experiment_name):
+        return self.experiments[experiment_name]
+
+    def is_stale(self):
+        return time.time() - self.loaded_at > conf.CONFIG_SNAPSHOT_TTL
+
+
 class ExperimentManager(ModelDict):
+    def __init__(self, *args, **kwargs):
+        super(ExperimentManager, self).__init__(*args, **kwargs)
+        self._snapshot = None
+        # Changed by every invalidation, so that a snapshot loaded meanwhile isn't kept
+        self._snapshot_generation = 0
+        self._snapshot_lock = threading.Lock()
+        self._listener_pid = None
+        self._listener = None
+        self._listener_stopped = None
+        post_save.connect(self._config_changed, sender=self.model)
+        post_delete.connect(self._config_changed, sender=self.model)
+
+    def __getitem__(self, key):
+        if conf.CONFIG_SNAPSHOT:
+            snapshot = self.snapshot()
+            if key in snapshot:
+                return snapshot[key]
+        return super(ExperimentManager, self).__getitem__(key)
+
     def get_experiment(self, experiment_name):
         # Helper that uses self[...] so that the experiment is auto created where desired
         try:
@@ -22,5 +86,108 @@ class ExperimentManager(ModelDict):
         except KeyError:
             return None
 
+    async def aget_experiment(self, experiment_name):
+        """The async counterpart of get_experiment
+
+        Experiments are served straight from the snapshot with EXPERIMENTS_CONFIG_SNAPSHOT,
+        otherwise, or while the snapshot is being loaded, they are looked up from a thread."""
+        snapshot = self._snapshot
+        if conf.CONFIG_SNAPSHOT and snapshot is not None and not snapshot.is_stale() and experiment_name in snapshot:
+            return snapshot[experiment_name]
+        return await sync_to_async(self.get_experiment)(experiment_name)
+
+    def snapshot(self):
+        """Return the snapshot of all experiments held by this process, loading it if needed
+
+        The snapshot is replaced as a whole when any experiment changes, in this process
+        through model signals and in other processes through a Redis pub/sub channel."""
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.is_stale():
+            self._start_listener()
+            with self._snapshot_lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.is_stale():
+                    generation = self._snapshot_generation
+                    snapshot = ExperimentSnapshot(self.model._default_manager.all())
+                    if generation == self._snapshot_generation:
+                        self._snapshot = snapshot
+        return snapshot
+
+    def invalidate_snapshot(self):
+        self._snapshot_generation += 1
+        self._snapshot = None
+
+    def reload(self):
+        """Make every process load experiments again after changes that don't send model signals, such as bulk updates"""
+        self._populate(reset=True)
+        self._publish_change('*')
+
+    def _config_changed(self, sender, instance, using=None, **kwargs):
+        self._publish_change(instance.name, using)
+
+    def _publish_change(self, experiment_name, using=None):
+        if not conf.CONFIG_SNAPSHOT:
+            return
+        # Until the change is committed, processes reloading their snapshot would still read the old data
+        transaction.on_commit(lambda: self._changed(experiment_name), using=using)
+
+    def _changed(self, experiment_name):
+        self.invalidate_snapshot()
+        try:
+            get_redis_client().publish(CONFIG_CHANGED_CHANNEL, experiment_name)
+        except (ConnectionError, ResponseError, TimeoutError):
+            # Other processes will pick the change up once their snapshot expires
+            pass
+
+    def _start_listener(self):
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+        with self._snapshot_lock:
+            if self._listener_pid == pid:
+                return
+            self._listener_pid = pid
+            # A snapshot inherited from the parent process may have missed changes
+            self.invalidate_snapshot()
+            self._listener_stopped = threading.Event()
+            self._listener = threading.Thread(target=self._listen, args=(self._listener_stopped,), name='experiments-config-listener')
+            self._listener.daemon = True
+            self._listener.start()
+
+    def stop_listener(self):
+        """Stop listening for changes made by other processes, it's started again by the next snapshot"""
+        with self._snapshot_lock:
+            listener, stopped = self._listener, self._listener_stopped
+            self._listener = self._listener_stopped = self._listener_pid = None
+            # Changes made while nobody listens would be missed
+            self.invalidate_snapshot()
+        if listener is not None:
+            stopped.set()
+            listener.join()
+
+    def _listen(self, stopped):
+        reconnecting = False
+        while not stopped.is_set():
+            pubsub = None
+            try:
+                pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CONFIG_CHANGED_CHANNEL)
+                if reconnecting:
+                    # Changes may have been published while we weren't listening
+                    self.invalidate_snapshot()
+                while not stopped.is_set():
+                    # Polled rather than blocking on listen, which would time out with EXPERIMENTS_REDIS_SOCKET_TIMEOUT
+                    message = pubsub.get_message(timeout=1)
+                    if message is not None and message['type'] == 'message':
+                        self.invalidate_snapshot()
+            except Exception:
+                # The listener must keep running, or this process would only see changes once its snapshot expires
+                logger.warning('Lost connection to the experiments config channel, retrying', exc_info=True)
+                reconnecting = True
+                stopped.wait(1)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
 
 experiment_manager = ExperimentManager(Experiment, key='name', value='value', instances=True, auto_create=LazyAutoCreate())
@@ -1,4 +1,10 @@
-from experiments.utils import participant
+from experiments.utils import aparticipant, participant, NEXT_VISIT_CHECK_SESSION_KEY
+from experiments.dateutils import now, timestamp_from_datetime
+from experiments import counters, conf
+
+from asgiref.sync import sync_to_async
+
+import logging
 
 try:
     # for Django >= 1.10
@@ -7,23 +13,127 @@ except ImportError:
     # for Django < 1.10
     MiddlewareMixin = object
 
+logger = logging.getLogger('experiments')
+
 
 def is_ajax(request):
     return request.META.get('HTTP_X_REQUESTED_WITH') == 'XMLHttpRequest'
 
 
 class ExperimentsRetentionMiddleware(MiddlewareMixin):
+    """
+    Records retention visits, and the goal named by the experiments_goal cookie, for page views.
+    Under ASGI this is done with the async participant API. With EXPERIMENTS_RETENTION_DEFERRED
+    it's done when the response is closed, once it has been sent, instead of before it's returned.
+    """
     def process_response(self, request, response):
-        # Don't track, failed pages, ajax requests, logged out users or widget impressions.
-        # We detect widgets by relying on the fact that they are flagged as being embedable
-        if response.status_code != 200 or is_ajax(request) or getattr(response, 'xframe_options_exempt', False):
+        if not self._is_tracked(request, response):
+            return response
+
+        session = getattr(request, 'session', None)
+        current_time = timestamp_from_datetime(now())
+        check_visit = session is None or session.get(NEXT_VISIT_CHECK_SESSION_KEY, 0) <= current_time
+        goal_name = request.COOKIES.get('experiments_goal')
+        if not check_visit and not goal_name:
             return response
 
         experiment_user = participant(request)
-        experiment_user.visit()
+        if conf.RETENTION_DEFERRED:
+            self._defer(experiment_user, session, response, current_time, check_visit, goal_name)
+            return response
+
+        if check_visit:
+            self._set_next_check(session, current_time, experiment_user.visit())
+        if goal_name:
+            experiment_user.goal(goal_name)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        if not self._is_tracked(request, response):
+            return response
+
+        session = getattr(request, 'session', None)
+        if not self._has_async_api(request, session):
+            # Before Django 5.1 the user and the session can only be loaded synchronously
+            return await sync_to_async(self.process_response)(request, response)
 
-        # record cookie goal
+        current_time = timestamp_from_datetime(now())
+        check_visit = session is None or await session.aget(NEXT_VISIT_CHECK_SESSION_KEY, 0) <= current_time
         goal_name = request.COOKIES.get('experiments_goal')
-        participant(request).goal(goal_name)
+        if not check_visit and not goal_name:
+            return response
+
+        experiment_user = await aparticipant(request)
+        if conf.RETENTION_DEFERRED:
+            self._defer(experiment_user, session, response, current_time, check_visit, goal_name)
+            return response
+
+        if check_visit:
+            self._set_next_check(session, current_time, await experiment_user.avisit())
+        if goal_name:
+            await experiment_user.agoal(goal_name)
+        return response
+
+    def _is_tracked(self, request, response):
+        # Don't track, failed pages, ajax requests, logged out users or widget impressions.
+        # We detect widgets by relying on the fact that they are flagged as being embedable
+        return response.status_code == 200 and not is_ajax(request) and not getattr(response, 'xframe_options_exempt', False)
+
+    def _has_async_api(self, request, session):
+        if not hasattr(request, 'auser'):
+            return False
+        return session is None or all(hasattr(session, name) for name in ('aget', 'akeys', 'asave'))
+
+    def _set_next_check(self, session, current_time, next_visit):
+        # Most page views are within a visit that has already been recorded, these can be
+        # skipped without looking at the participant's enrollments
+        if session is not None:
+            next_check = current_time + conf.RETENTION_CHECK_INTERVAL * 60 * 60
+            next_visit = timestamp_from_datetime(next_visit) if next_visit else None
+            session[NEXT_VISIT_CHECK_SESSION_KEY] = min(next_visit, next_check) if next_visit else next_check
 
+    def _defer(self, experiment_user, session, response, current_time, check_visit, goal_name):
+        if check_visit:
+            # The session is saved before the response is sent, so the next check can't wait
+            # for the visit to tell when the next one is due
+            self._set_next_check(session, current_time, None)
+
+        def record():
+            try:
+                with counters.batch():
+                    if check_visit:
+                        experiment_user.visit()
+                    if goal_name:
+                        experiment_user.goal(goal_name)
+            except Exception:
+                # Django ignores errors raised while closing a response
+                logger.exception('Could not record experiments retention visit')
+
+        close = response.close
+
+        def record_and_close():
+            # Closed by the server once the response has been sent, under ASGI from a thread.
+            # Recorded first, as closing the response closes the database connections.
+            response.close = close
+            record()
+            close()
+
+        response.close = record_and_close
+
+
+class ExperimentsCounterBatchMiddleware(MiddlewareMixin):
+    """
+    Sends all counter writes made while handling a request together, in one pipeline with Redis.
+    It should be placed above any other experiments middleware so that their writes
+    are included in the batch.
+    """
+    def process_request(self, request):
+        # A batch can only be left open by a request that failed before the response
+        # was processed, its writes are dropped rather than attributed to this request
+        counters.discard_batch()
+        counters.start_batch()
+
+    def process_response(self, request, response):
+        counters.end_batch()
         return response
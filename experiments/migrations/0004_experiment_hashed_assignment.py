@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0003_alter_experiment_alternatives_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='experiment',
+            name='assignment_salt',
+            field=models.CharField(blank=True, default='', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='experiment',
+            name='hashed_assignment',
+            field=models.BooleanField(default=False, help_text='Choose alternatives from a hash of the participant instead of at random'),
+        ),
+    ]
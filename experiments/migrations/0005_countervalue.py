@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0004_experiment_hashed_assignment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CounterValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255)),
+                ('participant_identifier', models.CharField(max_length=255)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key', 'count'], name='experiments_key_59bbc1_idx')],
+                'unique_together': {('key', 'participant_identifier')},
+            },
+        ),
+    ]
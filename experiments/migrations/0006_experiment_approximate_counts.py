@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('experiments', '0005_countervalue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='experiment',
+            name='approximate_counts',
+            field=models.BooleanField(default=False, help_text='Count participants and goals other than the relevant MWU goals approximately, using far less memory'),
+        ),
+    ]
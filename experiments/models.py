@@ -1,16 +1,23 @@
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
 
+from bisect import bisect_right
+import hashlib
 import random
 import json
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python < 3.10
+    from collections import Mapping
 try:
     from django.db.models import JSONField
 except ImportError:  # Django < 3.1
     from jsonfield import JSONField
 
-from experiments.counters import Counters
+from experiments.counters import get_counters
 from experiments.dateutils import now
 from experiments import conf
 
@@ -19,6 +26,10 @@ CONTROL_STATE = 0
 ENABLED_STATE = 1
 TRACK_STATE = 3
 
+# The alternatives this process has stored, by experiment name, start date (which tells an
+# experiment apart from one deleted and created again with the same name) and alternative name
+_registered_alternatives = {}
+
 STATES = (
     (CONTROL_STATE, 'Default/Control'),
     (ENABLED_STATE, 'Enabled'),
@@ -35,9 +46,19 @@ class Experiment(models.Model):
 
     state = models.IntegerField(default=CONTROL_STATE, choices=STATES)
 
+    hashed_assignment = models.BooleanField(default=False, help_text="Choose alternatives from a hash of the participant instead of at random")
+    assignment_salt = models.CharField(max_length=128, default="", blank=True)
+
+    approximate_counts = models.BooleanField(default=False, help_text="Count participants and goals other than the relevant MWU goals approximately, using far less memory")
+
     start_date = models.DateTimeField(default=now, blank=True, null=True, db_index=True)
     end_date = models.DateTimeField(blank=True, null=True)
 
+    def __setattr__(self, name, value):
+        if name == 'alternatives':
+            self.__dict__.pop('_cumulative_weights', None)
+        super(Experiment, self).__setattr__(name, value)
+
     def is_displaying_alternatives(self):
         if self.state == CONTROL_STATE:
             return False
@@ -59,13 +80,82 @@ class Experiment(models.Model):
             raise Exception("Invalid experiment state %s!" % self.state)
 
     def ensure_alternative_exists(self, alternative, weight=None):
-        if alternative not in self.alternatives:
-            self.alternatives[alternative] = {}
-            self.alternatives[alternative]['enabled'] = True
-            self.save()
-        if weight is not None and 'weight' not in self.alternatives[alternative]:
-            self.alternatives[alternative]['weight'] = float(weight)
-            self.save()
+        self.ensure_alternatives_exist({alternative: weight})
+
+    def ensure_alternatives_exist(self, alternatives):
+        """Store any of the alternatives that are new, or that have been given their first weight
+
+        alternatives is either a list of names or a mapping of names to weights (which may be None).
+        All of the changes are merged into the stored alternatives with one update, so this can be
+        used to register alternatives ahead of time as well as when they are first rendered."""
+        missing = self._missing_alternatives(alternatives)
+        if missing:
+            self._store_alternatives(missing)
+
+    async def aensure_alternatives_exist(self, alternatives):
+        """The async counterpart of ensure_alternatives_exist, storing new alternatives from a thread"""
+        missing = self._missing_alternatives(alternatives)
+        if missing:
+            await sync_to_async(self._store_alternatives)(missing)
+
+    def _missing_alternatives(self, alternatives):
+        if not isinstance(alternatives, Mapping):
+            alternatives = dict.fromkeys(alternatives)
+
+        missing = {}
+        updated = None
+        for alternative, weight in alternatives.items():
+            if self._has_alternative(alternative, weight):
+                continue
+            registered = _registered_alternatives.get((self.name, self.start_date, alternative))
+            if registered is not None and (weight is None or 'weight' in registered):
+                # Already stored by this process, only this instance is out of date
+                if updated is None:
+                    updated = dict(self.alternatives)
+                updated[alternative] = dict(registered)
+                continue
+            missing[alternative] = weight
+        if updated is not None:
+            # Replaced rather than changed in place, as the instance may be shared by threads
+            self.alternatives = updated
+        return missing
+
+    def _has_alternative(self, alternative, weight):
+        return alternative in self.alternatives and (weight is None or 'weight' in self.alternatives[alternative])
+
+    def _store_alternatives(self, alternatives):
+        with transaction.atomic():
+            try:
+                stored = Experiment.objects.select_for_update().only('alternatives').get(pk=self.pk).alternatives
+            except Experiment.DoesNotExist:
+                stored = None
+
+            merged = dict((name, dict(details)) for name, details in (stored or {}).items())
+            for name, details in self.alternatives.items():
+                merged.setdefault(name, dict(details))
+
+            changed = stored is None
+            for alternative, weight in alternatives.items():
+                if alternative not in merged:
+                    merged[alternative] = {'enabled': True}
+                    changed = True
+                if weight is not None and 'weight' not in merged[alternative]:
+                    merged[alternative]['weight'] = float(weight)
+                    changed = True
+
+            self.alternatives = merged
+            if stored is None:
+                self.save()
+            elif changed:
+                # Another process may have stored the same alternatives while we waited for the lock
+                self.save(update_fields=['alternatives'])
+
+        for alternative in alternatives:
+            _registered_alternatives[(self.name, self.start_date, alternative)] = dict(merged[alternative])
+
+    @property
+    def mwu_goals(self):
+        return [goal for goal in (self.relevant_mwu_goals or "").replace(" ", "").split(",") if goal]
 
     @property
     def default_alternative(self):
@@ -81,11 +171,68 @@ class Experiment(models.Model):
             elif 'default' in alternative_conf:
                 del alternative_conf['default']
 
+    def alternatives_changed(self):
+        """Forget the cached weights, to be called after changing alternatives in place"""
+        self.__dict__.pop('_cumulative_weights', None)
+
+    def cumulative_weights(self):
+        """Return the alternatives, sorted by name, and their cumulative weights
+
+        Alternatives are weighted equally unless all of them have a weight. The result is
+        cached until alternatives is assigned again or alternatives_changed is called."""
+        current = self.alternatives
+        cached = self.__dict__.get('_cumulative_weights')
+        # Kept with the alternatives it was computed from, in case another thread replaced them meanwhile
+        if cached is None or cached[0] is not current:
+            # Sorted so that every process sees the alternatives in the same order
+            alternatives = sorted(current.items())
+            weighted = all('weight' in details for name, details in alternatives)
+            cumulative = []
+            upto = 0
+            for name, details in alternatives:
+                upto += details['weight'] if weighted else 1
+                cumulative.append(upto)
+            cached = self.__dict__['_cumulative_weights'] = (current, tuple(name for name, details in alternatives), tuple(cumulative))
+        return cached[1:]
+
+    def _alternative_at(self, position):
+        names, cumulative = self.cumulative_weights()
+        if not names:
+            # No alternative registered yet, e.g. with EXPERIMENTS_STRICT_ALTERNATIVES
+            return conf.CONTROL_GROUP
+        index = bisect_right(cumulative, position * cumulative[-1])
+        return names[min(index, len(names) - 1)]
+
     def random_alternative(self):
-        if all('weight' in alt for alt in self.alternatives.values()):
-            return weighted_choice([(name, details['weight']) for name, details in self.alternatives.items()])
+        return self._alternative_at(random.random())
+
+    def random_alternatives(self, count):
+        """Choose count alternatives at random, for enrolling many participants at once"""
+        names, cumulative = self.cumulative_weights()
+        if not names:
+            return [conf.CONTROL_GROUP] * count
+        return random.choices(names, cum_weights=cumulative, k=count)
+
+    def hashed_alternative(self, participant_identifier):
+        """Choose an alternative for the participant from a stable hash of their identifier
+
+        The same participant always gets the same alternative (for as long as the alternatives
+        don't change), and alternatives are weighted in the same way as random_alternative."""
+        value = '%s:%s:%s' % (self.name, self.assignment_salt, participant_identifier)
+        digest = hashlib.sha1(value.encode('utf-8')).hexdigest()
+        return self._alternative_at(int(digest[:15], 16) / float(16 ** 15))
+
+    def choose_alternatives(self, participant_identifiers):
+        """Choose alternatives for many participants at once, for offline enrollment jobs
+
+        Returns a mapping of participant identifiers to alternatives, hashed or random
+        depending on the experiment's assignment."""
+        participant_identifiers = list(participant_identifiers)
+        if self.hashed_assignment:
+            alternatives = [self.hashed_alternative(identifier) for identifier in participant_identifiers]
         else:
-            return random.choice(list(self.alternatives))
+            alternatives = self.random_alternatives(len(participant_identifiers))
+        return dict(zip(participant_identifiers, alternatives))
 
     def __unicode__(self):
         return self.name
@@ -108,11 +255,13 @@ class Experiment(models.Model):
         return json.dumps(self.to_dict(), cls=DjangoJSONEncoder)
     
     def reset_counters(self):
-        Counters().reset_prefix(self.name)
+        get_counters().reset_prefix(self.name)
     
     def delete(self, reset_counters=True, *args, **kwargs):
         if reset_counters:
             self.reset_counters()
+        for key in [key for key in _registered_alternatives if key[0] == self.name]:
+            _registered_alternatives.pop(key, None)
         return super(Experiment, self).delete(*args, **kwargs)
 
 
@@ -142,11 +291,15 @@ class Enrollment(models.Model):
             return u'%s - %s' % (self.session_key, self.experiment)
 
 
-def weighted_choice(choices):
-    total = sum(w for c, w in choices)
-    r = random.uniform(0, total)
-    upto = 0
-    for c, w in choices:
-        upto += w
-        if upto >= r:
-            return c
+class CounterValue(models.Model):
+    """A participant's count in a counter, as stored by experiments.sql_counters.SQLCounters"""
+    key = models.CharField(max_length=255)
+    participant_identifier = models.CharField(max_length=255)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('key', 'participant_identifier'),)
+        indexes = [models.Index(fields=['key', 'count'])]
+
+    def __unicode__(self):
+        return u'%s - %s: %s' % (self.key, self.participant_identifier, self.count)
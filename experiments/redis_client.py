@@ -1,16 +1,338 @@
 from django.conf import settings
 import redis
-from redis.sentinel import Sentinel
+import redis.asyncio
+from redis.asyncio.sentinel import Sentinel as AsyncSentinel, SentinelManagedConnection as AsyncSentinelManagedConnection
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
+from redis.sentinel import Sentinel, SentinelManagedConnection
+
+from contextlib import contextmanager
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+import weakref
+
+logger = logging.getLogger('experiments')
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_circuit_breaker = None
+# By event loop, as asyncio connections can't be shared between loops
+_async_clients = weakref.WeakKeyDictionary()
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling Redis while the circuit breaker is open"""
+
+
+class Sending(object):
+    """Whether a command was sent to Redis in a sending() block"""
+
+    def __init__(self):
+        self.sent = False
+
+
+_sending = contextvars.ContextVar('experiments_redis_sending', default=None)
+
+
+@contextmanager
+def sending():
+    """Tell whether this thread or task sent any command to Redis in the block
+
+    A command that failed after it was sent may still have been applied, one that failed
+    to connect or was rejected by the circuit breaker has not."""
+    tracker = Sending()
+    token = _sending.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _sending.reset(token)
+
+
+def _marked_sent(method):
+    # Marks the command as sent just before sending it, as sending can fail half way through
+    def send(*args, **kwargs):
+        tracker = _sending.get()
+        if tracker is not None:
+            tracker.sent = True
+        return method(*args, **kwargs)
+    return send
+
+
+class CircuitBreaker(object):
+    """Fails Redis calls at once while Redis is unhealthy, instead of waiting for each one to time out
+
+    The breaker opens after failure_threshold connection errors or timeouts in a row. While it is
+    open calls raise CircuitOpenError, until reset_timeout seconds have passed and one thread is
+    let through to try Redis again (half-open). Its success closes the breaker, a failure opens
+    it again. trips, rejected and skipped_writes count how often it opened, how many calls it
+    failed and how many counter writes were lost to them."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.skipped_writes = 0
+        self._opened_at = None
+        self._trial_thread = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self._trial_thread == threading.current_thread().ident:
+                return True
+            # A trial that never finished is given up on after reset_timeout too
+            if time.time() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._opened_at = time.time()
+                self._trial_thread = threading.current_thread().ident
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info('Redis is responding again, closing the experiments circuit breaker')
+            self.state = CLOSED
+            self.failures = 0
+            self._trial_thread = None
+
+    def skipped(self, writes):
+        with self._lock:
+            self.skipped_writes += writes
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    self.trips += 1
+                    logger.warning('Opening the experiments circuit breaker after %s Redis failures', self.failures)
+                self.state = OPEN
+                self._opened_at = time.time()
+                self._trial_thread = None
+
+
+class CircuitBreakerConnectionMixin(object):
+    """Reports the outcome of every Redis call to the circuit breaker, and fails calls while it is open
+
+    Also records sent commands for sending(), whether or not there is a circuit breaker."""
+
+    def __init__(self, circuit_breaker=None, **kwargs):
+        self.circuit_breaker = circuit_breaker
+        super(CircuitBreakerConnectionMixin, self).__init__(**kwargs)
+
+    def _call(self, method, *args, **kwargs):
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return method(*args, **kwargs)
+        if not breaker.allow():
+            raise CircuitOpenError('Redis calls are failing, skipping them for now')
+        try:
+            result = method(*args, **kwargs)
+        except CircuitOpenError:
+            raise
+        except (ConnectionError, TimeoutError):
+            breaker.failure()
+            raise
+        return result
+
+    def connect(self):
+        return self._call(super(CircuitBreakerConnectionMixin, self).connect)
+
+    def send_packed_command(self, *args, **kwargs):
+        return self._call(_marked_sent(super(CircuitBreakerConnectionMixin, self).send_packed_command), *args, **kwargs)
+
+    def read_response(self, *args, **kwargs):
+        try:
+            response = self._call(super(CircuitBreakerConnectionMixin, self).read_response, *args, **kwargs)
+        except ResponseError:
+            # An error reply, but Redis did answer
+            self._succeeded()
+            raise
+        self._succeeded()
+        return response
+
+    def _succeeded(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.success()
+
+
+class CircuitBreakerConnection(CircuitBreakerConnectionMixin, redis.Connection):
+    pass
+
+
+class CircuitBreakerSentinelConnection(CircuitBreakerConnectionMixin, SentinelManagedConnection):
+    pass
+
+
+class AsyncCircuitBreakerConnectionMixin(object):
+    """The asyncio counterpart of CircuitBreakerConnectionMixin, sharing the same circuit breaker"""
+
+    def __init__(self, circuit_breaker=None, **kwargs):
+        self.circuit_breaker = circuit_breaker
+        super(AsyncCircuitBreakerConnectionMixin, self).__init__(**kwargs)
+
+    async def _call(self, method, *args, **kwargs):
+        breaker = self.circuit_breaker
+        if breaker is None:
+            return await method(*args, **kwargs)
+        if not breaker.allow():
+            raise CircuitOpenError('Redis calls are failing, skipping them for now')
+        try:
+            return await method(*args, **kwargs)
+        except CircuitOpenError:
+            raise
+        except (ConnectionError, TimeoutError):
+            breaker.failure()
+            raise
+
+    async def connect(self):
+        return await self._call(super(AsyncCircuitBreakerConnectionMixin, self).connect)
+
+    async def send_packed_command(self, *args, **kwargs):
+        return await self._call(_marked_sent(super(AsyncCircuitBreakerConnectionMixin, self).send_packed_command), *args, **kwargs)
+
+    async def read_response(self, *args, **kwargs):
+        try:
+            response = await self._call(super(AsyncCircuitBreakerConnectionMixin, self).read_response, *args, **kwargs)
+        except ResponseError:
+            # An error reply, but Redis did answer
+            self._succeeded()
+            raise
+        self._succeeded()
+        return response
+
+    def _succeeded(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.success()
+
+
+class AsyncCircuitBreakerConnection(AsyncCircuitBreakerConnectionMixin, redis.asyncio.Connection):
+    pass
+
+
+class AsyncCircuitBreakerSentinelConnection(AsyncCircuitBreakerConnectionMixin, AsyncSentinelManagedConnection):
+    pass
+
 
 def get_redis_client():
+    """Return the Redis client shared by the whole process
+
+    The client and its connection pool are created on first use, and again in a
+    forked child so that connections are never shared between processes."""
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _client = _create_redis_client()
+                _client_pid = pid
+    return _client
+
+
+def get_async_redis_client():
+    """Return the asyncio Redis client of the running event loop, for async views
+
+    It is configured like the client returned by get_redis_client, and shares its circuit breaker."""
+    loop = asyncio.get_running_loop()
+    pid = os.getpid()
+    client, client_pid = _async_clients.get(loop, (None, None))
+    if client is None or client_pid != pid:
+        client = _create_async_redis_client()
+        _async_clients[loop] = (client, pid)
+    return client
+
+
+def get_circuit_breaker():
+    """Return the circuit breaker of the shared client, or None if EXPERIMENTS_REDIS_CIRCUIT_BREAKER_FAILURES is None"""
+    get_redis_client()
+    return _circuit_breaker
+
+
+def reset_redis_client():
+    """Discard the shared client, the next call to get_redis_client will read the settings again"""
+    global _client, _client_pid, _circuit_breaker
+
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.connection_pool.disconnect()
+        _client = None
+        _client_pid = None
+        _circuit_breaker = None
+        # Connections of other event loops can only be closed from their loop, they are left to be collected
+        _async_clients.clear()
+
+
+def _connection_options():
+    return {
+        'password': getattr(settings, 'EXPERIMENTS_REDIS_PASSWORD', None),
+        'db': getattr(settings, 'EXPERIMENTS_REDIS_DB', 0),
+        'encoding': "utf-8",
+        'decode_responses': True,
+        'socket_timeout': getattr(settings, 'EXPERIMENTS_REDIS_SOCKET_TIMEOUT', None),
+        'socket_connect_timeout': getattr(settings, 'EXPERIMENTS_REDIS_SOCKET_CONNECT_TIMEOUT', None),
+    }
+
+
+def _create_redis_client():
+    global _circuit_breaker
+
+    options = _connection_options()
+    failure_threshold = getattr(settings, 'EXPERIMENTS_REDIS_CIRCUIT_BREAKER_FAILURES', 5)
+    if failure_threshold is None:
+        _circuit_breaker = None
+    else:
+        _circuit_breaker = CircuitBreaker(failure_threshold, getattr(settings, 'EXPERIMENTS_REDIS_CIRCUIT_BREAKER_RESET_SECONDS', 10))
+        options['circuit_breaker'] = _circuit_breaker
+
     if getattr(settings, 'EXPERIMENTS_REDIS_SENTINELS', None):
+        # The sentinel managed pool looks up the master when connecting, and again
+        # after a connection error so that failovers are picked up
+        options['connection_class'] = CircuitBreakerSentinelConnection
         sentinel = Sentinel(settings.EXPERIMENTS_REDIS_SENTINELS, socket_timeout=settings.EXPERIMENTS_REDIS_SENTINELS_TIMEOUT)
-        host, port = sentinel.discover_master(settings.EXPERIMENTS_REDIS_MASTER_NAME)
-    else:
-        host = getattr(settings, 'EXPERIMENTS_REDIS_HOST', 'localhost')
-        port = getattr(settings, 'EXPERIMENTS_REDIS_PORT', 6379)
+        return sentinel.master_for(settings.EXPERIMENTS_REDIS_MASTER_NAME, **options)
+
+    host = getattr(settings, 'EXPERIMENTS_REDIS_HOST', 'localhost')
+    port = getattr(settings, 'EXPERIMENTS_REDIS_PORT', 6379)
+
+    options['connection_class'] = CircuitBreakerConnection
+    pool = redis.ConnectionPool(host=host, port=port, **options)
+    return redis.Redis(connection_pool=pool)
+
+
+def _create_async_redis_client():
+    options = _connection_options()
+    breaker = get_circuit_breaker()
+    if breaker is not None:
+        options['circuit_breaker'] = breaker
+
+    if getattr(settings, 'EXPERIMENTS_REDIS_SENTINELS', None):
+        options['connection_class'] = AsyncCircuitBreakerSentinelConnection
+        sentinel = AsyncSentinel(settings.EXPERIMENTS_REDIS_SENTINELS, socket_timeout=settings.EXPERIMENTS_REDIS_SENTINELS_TIMEOUT)
+        return sentinel.master_for(settings.EXPERIMENTS_REDIS_MASTER_NAME, **options)
 
-    password = getattr(settings, 'EXPERIMENTS_REDIS_PASSWORD', None)
-    db = getattr(settings, 'EXPERIMENTS_REDIS_DB', 0)
+    host = getattr(settings, 'EXPERIMENTS_REDIS_HOST', 'localhost')
+    port = getattr(settings, 'EXPERIMENTS_REDIS_PORT', 6379)
 
-    return redis.Redis(host=host, port=port, password=password, db=db, encoding="utf-8", decode_responses=True)
+    options['connection_class'] = AsyncCircuitBreakerConnection
+    pool = redis.asyncio.ConnectionPool(host=host, port=port, **options)
+    return redis.asyncio.Redis(connection_pool=pool)
@@ -0,0 +1,136 @@
+"""Counter writes that could not be sent to Redis, kept in local files until they are replayed
+
+Each process appends to its own JSON lines file in EXPERIMENTS_COUNTER_SPOOL_DIR, one line per
+batch of writes, and holds a lock on it for as long as it writes to it. Files that nobody holds
+a lock on (closed once Redis is back, or left by a process that exited) can be replayed, see
+RedisCounters.replay_spool."""
+from contextlib import contextmanager
+import fcntl
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from experiments import conf
+
+logger = logging.getLogger('experiments')
+
+SPOOL_SUFFIX = '.jsonl'
+
+_lock = threading.Lock()
+_file = None
+_file_pid = None
+_synced_at = 0
+
+
+def append(writes):
+    """Record writes that could not be sent, returns False if there is no spool to record them in"""
+    global _synced_at
+
+    if not conf.COUNTER_SPOOL_DIR:
+        return False
+    line = json.dumps({'id': uuid.uuid4().hex, 'writes': list(writes)}, separators=(',', ':')) + '\n'
+    try:
+        with _lock:
+            spool_file = _open()
+            spool_file.write(line)
+            spool_file.flush()
+            # Syncing is batched, a crash of the process loses nothing once the line is flushed
+            if time.time() - _synced_at >= conf.COUNTER_SPOOL_FSYNC_SECONDS:
+                os.fsync(spool_file.fileno())
+                _synced_at = time.time()
+    except (IOError, OSError):
+        logger.exception('Could not spool %s experiment counter writes', len(writes))
+        return False
+    return True
+
+
+def _open():
+    global _file, _file_pid
+
+    pid = os.getpid()
+    if _file is not None and _file_pid != pid:
+        # Inherited from the parent process, which keeps writing to it
+        _file.close()
+        _file = None
+    if _file is None:
+        if not os.path.isdir(conf.COUNTER_SPOOL_DIR):
+            os.makedirs(conf.COUNTER_SPOOL_DIR)
+        name = 'counters-%s-%s-%s%s' % (socket.gethostname(), pid, uuid.uuid4().hex[:8], SPOOL_SUFFIX)
+        _file = open(os.path.join(conf.COUNTER_SPOOL_DIR, name), 'a')
+        # Held until the file is closed, so that it isn't replayed while it's written to
+        fcntl.flock(_file.fileno(), fcntl.LOCK_EX)
+        _file_pid = pid
+    return _file
+
+
+def is_open():
+    """Whether this process has spooled writes since its spool file was last closed"""
+    return _file is not None and _file_pid == os.getpid()
+
+
+def close():
+    """Stop appending to the spool file of this process, so that it can be replayed"""
+    global _file
+
+    with _lock:
+        if is_open():
+            try:
+                _file.flush()
+                os.fsync(_file.fileno())
+            finally:
+                _file.close()
+        _file = None
+
+
+def spool_files():
+    if not conf.COUNTER_SPOOL_DIR:
+        return []
+    return sorted(glob.glob(os.path.join(conf.COUNTER_SPOOL_DIR, '*' + SPOOL_SUFFIX)))
+
+
+def replayable_files():
+    """Yield the spool files that can be replayed, each locked until the next one is asked for"""
+    for path in spool_files():
+        with _locked(path) as spool_file:
+            if spool_file is not None:
+                yield path, spool_file
+
+
+@contextmanager
+def _locked(path):
+    try:
+        spool_file = open(path)
+    except (IOError, OSError):
+        # Replayed and removed in the meantime
+        yield None
+        return
+    with spool_file:
+        try:
+            fcntl.flock(spool_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            # Being written to, or replayed by another process
+            yield None
+            return
+        if not os.path.exists(path):
+            # Names are never reused, so the file was replayed while we waited for it
+            yield None
+            return
+        yield spool_file
+
+
+def read(spool_file):
+    """Return the (batch id, writes) pairs in a spool file"""
+    batches = []
+    for line in spool_file:
+        try:
+            batch = json.loads(line)
+        except ValueError:
+            # The last line is cut short if the process died while writing it
+            continue
+        batches.append((batch['id'], [tuple(write) for write in batch['writes']]))
+    return batches
@@ -0,0 +1,208 @@
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import Count, F
+
+from fnmatch import fnmatchcase
+import atexit
+import logging
+import threading
+import time
+
+from experiments.counters import BaseCounters, INCREMENT
+from experiments.models import CounterValue
+from experiments import conf
+
+logger = logging.getLogger('experiments')
+
+# Rows per INSERT statement, keeping below SQLite's limit on query parameters
+UPSERT_BATCH_SIZE = 300
+
+
+class SQLCounters(BaseCounters):
+    """Counters stored in the database, one CounterValue row per participant in a counter
+
+    Counts are read with indexed aggregate queries. The frequency histogram is grouped from the
+    rows rather than stored, so that there is no row that every increment of a counter updates.
+    Increments are added up in a buffer shared by the process and written with bulk upserts,
+    see EXPERIMENTS_SQL_COUNTER_BUFFER_SIZE. A timer writes buffers that aren't filled in time,
+    and reads write the buffer first. The buffer is never written in the caller's transaction,
+    where a rollback would lose everyone's increments: within one it is left to the timer's thread."""
+
+    _buffer_lock = threading.Lock()
+    _buffer = {}
+    _buffer_started = None
+    _buffer_timer = None
+
+    def _write(self, writes):
+        cls = type(self)
+        flush = False
+        clears = []
+        with cls._buffer_lock:
+            for operation, key, participant_identifier, count in writes:
+                if operation == INCREMENT:
+                    pair = (key, participant_identifier)
+                    cls._buffer[pair] = cls._buffer.get(pair, 0) + count
+                else:
+                    # Buffered increments are cleared with the row, later ones are buffered after the delete
+                    cls._buffer.pop((key, participant_identifier), None)
+                    clears.append((key, participant_identifier))
+            if cls._buffer_started is None:
+                cls._buffer_started = time.time()
+            if len(cls._buffer) >= conf.SQL_COUNTER_BUFFER_SIZE or time.time() - cls._buffer_started >= conf.SQL_COUNTER_BUFFER_SECONDS:
+                flush = True
+            elif cls._buffer_timer is None:
+                cls._start_timer(conf.SQL_COUNTER_BUFFER_SECONDS)
+
+        if clears:
+            self._delete_pairs(clears)
+        if flush:
+            self.flush()
+
+    @classmethod
+    def _start_timer(cls, interval):
+        # Called holding _buffer_lock
+        if cls._buffer_timer is not None:
+            cls._buffer_timer.cancel()
+        cls._buffer_timer = threading.Timer(interval, cls._flush_on_timer)
+        cls._buffer_timer.daemon = True
+        cls._buffer_timer.start()
+
+    @classmethod
+    def flush(cls):
+        """Write the buffered increments of this process
+
+        Within a transaction they are written by the timer's thread right away instead, so reads
+        made in the transaction may not include them yet."""
+        if connections[router.db_for_write(CounterValue)].in_atomic_block:
+            with cls._buffer_lock:
+                # Unless a timer is already writing it right away
+                if cls._buffer and (cls._buffer_timer is None or cls._buffer_timer.interval):
+                    cls._start_timer(0)
+            return
+        cls._flush_buffer()
+
+    @classmethod
+    def _flush_buffer(cls):
+        with cls._buffer_lock:
+            increments = cls._buffer
+            cls._buffer = {}
+            cls._buffer_started = None
+            timer, cls._buffer_timer = cls._buffer_timer, None
+        if timer is not None:
+            timer.cancel()
+        if increments:
+            cls._upsert(sorted((key, participant_identifier, count) for (key, participant_identifier), count in increments.items() if count))
+
+    @classmethod
+    def _flush_on_timer(cls):
+        try:
+            cls._flush_buffer()
+        finally:
+            # The timer's thread has a database connection of its own
+            connections.close_all()
+
+    @classmethod
+    def _upsert(cls, rows):
+        # Rows are sorted so that concurrent upserts lock them in the same order
+        using = router.db_for_write(CounterValue)
+        connection = connections[using]
+        try:
+            with transaction.atomic(using=using):
+                for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+                    cls._upsert_rows(connection, rows[start:start + UPSERT_BATCH_SIZE])
+        except DatabaseError:
+            # Counters must never break the request
+            logger.exception('Could not write %s experiment counter increments', len(rows))
+
+    @classmethod
+    def _upsert_rows(cls, connection, rows):
+        opts = CounterValue._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        key, participant_identifier, count = [qn(opts.get_field(name).column) for name in ('key', 'participant_identifier', 'count')]
+        insert = "INSERT INTO %s (%s, %s, %s) VALUES %s" % (table, key, participant_identifier, count, ", ".join(["(%s, %s, %s)"] * len(rows)))
+        params = [value for row in rows for value in row]
+
+        if connection.vendor in ('postgresql', 'sqlite'):
+            sql = "%s ON CONFLICT (%s, %s) DO UPDATE SET %s = %s.%s + EXCLUDED.%s" % (insert, key, participant_identifier, count, table, count, count)
+        elif connection.vendor == 'mysql':
+            sql = "%s ON DUPLICATE KEY UPDATE %s = %s + VALUES(%s)" % (insert, count, count, count)
+        else:
+            for key_value, participant_value, count_value in rows:
+                values = CounterValue.objects.using(connection.alias).filter(key=key_value, participant_identifier=participant_value)
+                if not values.update(count=F('count') + count_value):
+                    CounterValue.objects.using(connection.alias).create(key=key_value, participant_identifier=participant_value, count=count_value)
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    def _delete_pairs(self, pairs):
+        by_key = {}
+        for key, participant_identifier in pairs:
+            by_key.setdefault(key, []).append(participant_identifier)
+        try:
+            with transaction.atomic(using=router.db_for_write(CounterValue)):
+                for key, participant_identifiers in by_key.items():
+                    CounterValue.objects.filter(key=key, participant_identifier__in=participant_identifiers).delete()
+        except DatabaseError:
+            # Counters must never break the request
+            logger.exception('Could not clear experiment counters')
+
+    def get(self, key):
+        self.flush()
+        return CounterValue.objects.filter(key=key).count()
+
+    def get_many(self, keys, frequency_keys=()):
+        self.flush()
+        keys = list(keys)
+        frequency_keys = list(frequency_keys)
+
+        counts = dict((key, 0) for key in keys)
+        if keys:
+            for row in CounterValue.objects.filter(key__in=keys).values('key').annotate(participants=Count('*')).order_by():
+                counts[row['key']] = row['participants']
+
+        frequencies = dict((key, {}) for key in frequency_keys)
+        if frequency_keys:
+            for row in CounterValue.objects.filter(key__in=frequency_keys).values('key', 'count').annotate(participants=Count('*')).order_by():
+                frequencies[row['key']][row['count']] = row['participants']
+        return counts, frequencies
+
+    def get_frequency(self, key, participant_identifier):
+        self.flush()
+        return CounterValue.objects.filter(key=key, participant_identifier=participant_identifier).values_list('count', flat=True).first() or 0
+
+    def intersection_counts(self, keys):
+        self.flush()
+        participants = CounterValue.objects.filter(key=keys[0])
+        counts = [participants.count()]
+        for key in keys[1:]:
+            participants = participants.filter(participant_identifier__in=CounterValue.objects.filter(key=key).values('participant_identifier'))
+            counts.append(participants.count())
+        return counts
+
+    def reset(self, key):
+        self.flush()
+        CounterValue.objects.filter(key=key).delete()
+        return True
+
+    def reset_pattern(self, pattern_key):
+        self.flush()
+        keys = [key for key in CounterValue.objects.values_list('key', flat=True).distinct() if fnmatchcase(key, pattern_key)]
+        CounterValue.objects.filter(key__in=keys).delete()
+        return True
+
+    def reset_prefix(self, key_prefix):
+        self.flush()
+        CounterValue.objects.filter(key__startswith=key_prefix + ':').delete()
+
+
+def _flush_at_exit():
+    try:
+        SQLCounters.flush()
+    except Exception:
+        # The database may already be unavailable while the interpreter shuts down
+        logger.warning('Could not write experiment counters at exit', exc_info=True)
+
+
+atexit.register(_flush_at_exit)
@@ -33,9 +33,10 @@ class ExperimentNode(template.Node):
         self.user_variable = user_variable
 
     def render(self, context):
-        experiment = experiment_manager.get_experiment(self.experiment_name)
-        if experiment:
-            experiment.ensure_alternative_exists(self.alternative, self.weight)
+        if not conf.STRICT_ALTERNATIVES:
+            experiment = experiment_manager.get_experiment(self.experiment_name)
+            if experiment:
+                experiment.ensure_alternative_exists(self.alternative, self.weight)
 
         # Get User object
         if self.user_variable:
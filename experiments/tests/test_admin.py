@@ -3,10 +3,14 @@ import json
 
 from django.contrib.auth.models import User, Permission
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
 
+from experiments.admin_utils import get_result_context
+from experiments.conf import VISIT_PRESENT_COUNT_GOAL
+from experiments.experiment_counters import ExperimentCounter
 from experiments.models import Experiment, CONTROL_STATE, ENABLED_STATE
 from experiments.utils import participant
+from mock import patch
 
 
 class AdminTestCase(TestCase):
@@ -77,3 +81,87 @@ class AdminTestCase(TestCase):
 
         self.assertEqual(400, self.client.post(reverse('admin:experiment_admin_set_state'), {}).status_code)
         self.assertEqual(400, self.client.post(reverse('admin:experiment_admin_set_alternative'), {}).status_code)
+
+    def test_result_context(self):
+        experiment = Experiment.objects.create(name='test_result_context', state=ENABLED_STATE, alternatives={'control': {}, 'other': {}}, relevant_mwu_goals=VISIT_PRESENT_COUNT_GOAL)
+        experiment_counter = ExperimentCounter()
+        try:
+            experiment_counter.increment_participant_count(experiment, 'control', 'fred')
+            experiment_counter.increment_participant_count(experiment, 'other', 'barney')
+            experiment_counter.increment_participant_count(experiment, 'other', 'wilma')
+            experiment_counter.increment_goal_count(experiment, 'other', VISIT_PRESENT_COUNT_GOAL, 'wilma', 3)
+
+            request = RequestFactory().get('/')
+            request.user = User.objects.create_superuser(username='user', email='deleted@mixcloud.com', password='pass')
+            context = get_result_context(request, experiment)
+
+            self.assertEqual(context['alternatives'], [('control', 1), ('other', 2)])
+            self.assertEqual(context['control_participants'], 1)
+            goal_results = context['results'][VISIT_PRESENT_COUNT_GOAL]
+            other = dict(goal_results['alternatives'])['other']
+            self.assertEqual(other['conversions'], 1)
+            self.assertEqual(other['conversion_rate'], 50.0)
+            self.assertEqual(other['average_goal_actions'], 1.5)
+        finally:
+            experiment_counter.delete(experiment)
+
+    @patch('experiments.conf.COUNTER_BITMAPS', True)
+    def test_funnel_and_overlap(self):
+        experiment = Experiment.objects.create(name='test_funnel', state=ENABLED_STATE, alternatives={'control': {}, 'other': {}})
+        other_experiment = Experiment.objects.create(name='test_funnel_other', state=ENABLED_STATE, alternatives={'control': {}})
+        experiment_counter = ExperimentCounter()
+        User.objects.create_superuser(username='user', email='deleted@mixcloud.com', password='pass')
+        self.client.login(username='user', password='pass')
+        try:
+            for participant_identifier in ('fred', 'barney', 'wilma'):
+                experiment_counter.increment_participant_count(experiment, 'other', participant_identifier)
+            experiment_counter.increment_participant_count(other_experiment, 'control', 'wilma')
+            experiment_counter.increment_goal_count(experiment, 'other', 'goal1', 'fred')
+            experiment_counter.increment_goal_count(experiment, 'other', 'goal1', 'wilma')
+            experiment_counter.increment_goal_count(experiment, 'other', 'goal2', 'wilma')
+            experiment_counter.increment_goal_count(experiment, 'other', 'goal2', 'barney')
+
+            response = self.client.get(reverse('admin:experiment_admin_funnel'), {'experiment': 'test_funnel', 'goals': 'goal1,goal2'})
+            self.assertEqual(json.loads(response.content.decode('utf-8')), {
+                'goals': ['goal1', 'goal2'],
+                'alternatives': {'control': [0, 0, 0], 'other': [3, 2, 1]},
+            })
+
+            response = self.client.get(reverse('admin:experiment_admin_overlap'), {'experiment': 'test_funnel', 'other': 'test_funnel_other'})
+            self.assertEqual(json.loads(response.content.decode('utf-8')), {'overlap': [
+                {'alternative': 'control', 'other_alternative': 'control', 'participants': 0},
+                {'alternative': 'other', 'other_alternative': 'control', 'participants': 1},
+            ]})
+        finally:
+            experiment_counter.delete(experiment)
+            experiment_counter.delete(other_experiment)
+
+    def test_funnel_needs_bitmaps(self):
+        Experiment.objects.create(name='test_funnel', state=ENABLED_STATE, alternatives={'control': {}})
+        User.objects.create_superuser(username='user', email='deleted@mixcloud.com', password='pass')
+        self.client.login(username='user', password='pass')
+        response = self.client.get(reverse('admin:experiment_admin_funnel'), {'experiment': 'test_funnel', 'goals': 'goal1'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rollups(self):
+        experiment = Experiment.objects.create(name='test_rollups', state=ENABLED_STATE, alternatives={'control': {}, 'blue': {}})
+        User.objects.create_superuser(username='user', email='deleted@mixcloud.com', password='pass')
+        self.client.login(username='user', password='pass')
+        experiment_counter = ExperimentCounter()
+        with patch('experiments.conf.COUNTER_ROLLUP_INTERVAL', 86400):
+            try:
+                experiment_counter.increment_participant_count(experiment, 'blue', 'fred')
+                response = self.client.get(reverse('admin:experiment_admin_rollups'), {'experiment': 'test_rollups', 'days': '2'})
+            finally:
+                experiment_counter.delete(experiment)
+        self.assertEqual(response.status_code, 200)
+        intervals = json.loads(response.content.decode('utf-8'))['intervals']
+        self.assertEqual(len(intervals), 3)
+        self.assertEqual(intervals[-1]['participants'], {'blue': 1, 'control': 0})
+
+    def test_rollups_need_interval(self):
+        Experiment.objects.create(name='test_rollups', state=ENABLED_STATE, alternatives={'control': {}})
+        User.objects.create_superuser(username='user', email='deleted@mixcloud.com', password='pass')
+        self.client.login(username='user', password='pass')
+        response = self.client.get(reverse('admin:experiment_admin_rollups'), {'experiment': 'test_rollups'})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+
+from io import StringIO
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from experiments.models import Experiment
+from experiments import conf, counters, spool
+from experiments.utils import participant
+from mock import patch
+
+TEMPLATE = """{% load experiments %}
+{% experiment sync_experiment blue weight=2 %}blue{% endexperiment %}
+{% experiment sync_experiment red %}red{% endexperiment %}
+{% experiment_enroll "sync_enrolled" "left" "right" as alternative %}
+{% experiment_enroll variable_name "ignored" as alternative %}
+"""
+
+PYTHON = """
+def view(request):
+    participant(request).enroll('sync_python', ['one', 'two'])
+    participant(request).enroll(experiment_name='sync_weighted', alternatives={'heavy': 3})
+"""
+
+
+class ExperimentsSyncTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'page.html'), 'w') as f:
+            f.write(TEMPLATE)
+        with open(os.path.join(self.directory, 'views.py'), 'w') as f:
+            f.write(PYTHON)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def call_command(self, *args):
+        out = StringIO()
+        call_command('experiments_sync', '--path', self.directory, stdout=out, *args)
+        return out.getvalue()
+
+    def test_registers_template_alternatives(self):
+        self.call_command()
+        experiment = Experiment.objects.get(name='sync_experiment')
+        self.assertEqual(experiment.alternatives, {'blue': {'enabled': True, 'weight': 2.0}, 'red': {'enabled': True}})
+        self.assertEqual(set(Experiment.objects.get(name='sync_enrolled').alternatives), {'left', 'right', 'control'})
+        self.assertFalse(Experiment.objects.filter(name='variable_name').exists())
+        self.assertFalse(Experiment.objects.filter(name='sync_python').exists())
+
+    def test_registers_python_alternatives(self):
+        self.call_command('--python')
+        self.assertEqual(set(Experiment.objects.get(name='sync_python').alternatives), {'one', 'two', 'control'})
+        self.assertEqual(Experiment.objects.get(name='sync_weighted').alternatives['heavy'], {'enabled': True, 'weight': 3.0})
+
+    def test_merges_with_stored_alternatives(self):
+        Experiment.objects.create(name='sync_experiment', alternatives={'blue': {'enabled': False, 'weight': 5}, 'green': {'enabled': True}})
+        self.call_command()
+        experiment = Experiment.objects.get(name='sync_experiment')
+        self.assertEqual(experiment.alternatives, {
+            'blue': {'enabled': False, 'weight': 5},
+            'green': {'enabled': True},
+            'red': {'enabled': True},
+        })
+
+    def test_scans_in_process_without_fork(self):
+        with patch('multiprocessing.get_all_start_methods', return_value=['spawn', 'forkserver']), \
+                patch('experiments.management.commands.experiments_sync.ProcessPoolExecutor') as executor:
+            self.call_command()
+        executor.assert_not_called()
+        self.assertTrue(Experiment.objects.filter(name='sync_experiment').exists())
+
+    def test_dry_run_stores_nothing(self):
+        out = self.call_command('--dry-run', '--workers', '1')
+        self.assertIn('sync_experiment: blue, red', out)
+        self.assertFalse(Experiment.objects.filter(name='sync_experiment').exists())
+
+
+class StrictAlternativesTestCase(TestCase):
+    @patch('experiments.conf.STRICT_ALTERNATIVES', True)
+    def test_enroll_does_not_store_alternatives(self):
+        Experiment.objects.create(name='strict_experiment', state=1, alternatives={'control': {'enabled': True}})
+        with patch.object(Experiment, 'ensure_alternatives_exist') as ensure_alternatives_exist:
+            participant(session={}).enroll('strict_experiment', ['unregistered'])
+        ensure_alternatives_exist.assert_not_called()
+        self.assertEqual(set(Experiment.objects.get(name='strict_experiment').alternatives), {'control'})
+
+
+class DeleteCountersTestCase(TestCase):
+    def test_runs_pending_deletions(self):
+        redis_counters = counters.RedisCounters()
+        redis_counters.increment('delete_command_test:alt:participant', 'fred')
+        redis_counters._redis.hset(counters.DELETIONS_KEY, 'experiments:participants:delete_command_test:*', 0)
+        out = StringIO()
+        call_command('experiments_delete_counters', stdout=out)
+        self.assertIn('1 patterns', out.getvalue())
+        self.assertEqual(redis_counters.get('delete_command_test:alt:participant'), 0)
+        redis_counters.reset('delete_command_test:alt:participant')
+
+
+class PruneParticipantIdsTestCase(TestCase):
+    @patch.object(conf, 'COMPACT_PARTICIPANT_IDS', True)
+    def test_prunes_unused_ids(self):
+        redis_counters = counters.RedisCounters()
+        redis_counters.increment('prune_command_test', 'prune_command:fred')
+        redis_counters.reset('prune_command_test')
+        out = StringIO()
+        call_command('experiments_prune_participant_ids', stdout=out)
+        self.assertIn('Removed', out.getvalue())
+        self.assertIsNone(redis_counters._redis.hget(counters.PARTICIPANT_IDS_KEY, 'prune_command:fred'))
+
+
+class ReplaySpoolTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = patch.object(conf, 'COUNTER_SPOOL_DIR', directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def call_command(self):
+        out = StringIO()
+        call_command('experiments_replay_spool', stdout=out)
+        return out.getvalue()
+
+    def test_replays_spooled_writes(self):
+        self.assertIn('No spooled counter writes', self.call_command())
+        spool.append([(counters.INCREMENT, 'replay_command_test', 'fred', 2)])
+        spool.close()
+        self.assertIn('Replayed 1 counter writes from 1 spool files', self.call_command())
+        redis_counters = counters.RedisCounters()
+        self.assertEqual(redis_counters.get_frequency('replay_command_test', 'fred'), 2)
+        redis_counters.reset('replay_command_test')
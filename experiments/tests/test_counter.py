@@ -1,18 +1,38 @@
 from __future__ import absolute_import
 
 from unittest import TestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
 
-from experiments import counters
-from experiments.experiment_counters import ExperimentCounter
-from experiments.models import Experiment
+from asgiref.sync import async_to_sync
+from django.db import DatabaseError, connection, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TransactionTestCase
+
+from experiments import counters, conf, spool
+from experiments.dateutils import datetime_from_timestamp, timestamp_from_datetime
+from experiments.experiment_counters import ExperimentCounter, PARTICIPANT_KEY
+from experiments.middleware import ExperimentsCounterBatchMiddleware
+from experiments.models import Experiment, CounterValue
+from experiments.redis_client import CircuitBreakerConnection
+from experiments.sql_counters import SQLCounters
 from mock import patch
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
 
 TEST_KEY = 'CounterTestCase'
 
 
-class CounterTestCase(TestCase):
+class CounterTests(object):
+    backend = None
+
     def setUp(self):
-        self.counters = counters.Counters()
+        patcher = patch.object(conf, 'COUNTER_BACKEND', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.counters = counters.get_counters()
         self.counters.reset(TEST_KEY)
         self.assertEqual(self.counters.get(TEST_KEY), 0)
 
@@ -62,9 +82,48 @@ class CounterTestCase(TestCase):
         self.assertEqual(self.counters.get(TEST_KEY), 1)
         self.assertEqual(self.counters.get_frequencies(TEST_KEY), {2: 1})
     
+    def test_increment_by_count(self):
+        self.counters.increment(TEST_KEY, 'fred', 3)
+        self.counters.increment(TEST_KEY, 'fred', 2)
+        self.counters.increment(TEST_KEY, 'barney', 5)
+        self.assertEqual(self.counters.get_frequency(TEST_KEY, 'fred'), 5)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {5: 2})
+
+    def test_clear_missing_value(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.clear(TEST_KEY, 'barney')
+
+        self.assertEqual(self.counters.get(TEST_KEY), 1)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1})
+
+    def test_get_many(self):
+        self.counters.increment(TEST_KEY, 'fred', 2)
+        self.counters.increment(TEST_KEY + '_other', 'fred')
+        self.assertEqual(self.counters.get_many([TEST_KEY, TEST_KEY + '_other'], [TEST_KEY]),
+                         ({TEST_KEY: 1, TEST_KEY + '_other': 1}, {TEST_KEY: {2: 1}}))
+        self.counters.reset(TEST_KEY + '_other')
+
+    def test_increment_many(self):
+        self.counters.increment_many([(TEST_KEY, 'fred', 1), (TEST_KEY, 'barney', 2), (TEST_KEY, 'fred', 0)])
+        self.counters.clear_many([(TEST_KEY, 'barney')])
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1})
+
+    def test_async_writes(self):
+        async def write():
+            await self.counters.aincrement(TEST_KEY, 'fred', 2)
+            await self.counters.aincrement_many([(TEST_KEY, 'barney', 1), (TEST_KEY, 'wilma', 1)])
+            await self.counters.aclear(TEST_KEY, 'barney')
+            await self.counters.aadd_unique(TEST_KEY + '_unique', 'wilma')
+        async_to_sync(write)()
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {2: 1, 1: 1})
+        self.assertEqual(self.counters.get_unique(TEST_KEY + '_unique'), 1)
+        self.counters.reset(TEST_KEY + '_unique')
+
     def test_reset_all(self):
         experiment = Experiment.objects.create(name='reset_test')
         other_experiment = Experiment.objects.create(name='reset_test_other')
+        self.addCleanup(experiment.delete)
+        self.addCleanup(other_experiment.delete)
         experiment_counter = ExperimentCounter()
 
         for exp in [experiment, other_experiment]:
@@ -86,10 +145,637 @@ class CounterTestCase(TestCase):
         self.assertEqual(experiment_counter.participant_count(other_experiment, 'alt'), 1)
         self.assertEqual(experiment_counter.participant_count(other_experiment, 'control'), 3)
         self.assertEqual(experiment_counter.goal_count(other_experiment, 'control', 'goal1'), 1)
-        
+
+    def test_intersection_counts(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.increment(TEST_KEY, 'barney')
+        self.counters.increment(TEST_KEY + '_goal', 'barney')
+        self.assertEqual(self.counters.intersection_counts([TEST_KEY, TEST_KEY + '_goal']), [2, 1])
+        self.counters.reset(TEST_KEY + '_goal')
+
+
+class CounterTestCase(CounterTests, TestCase):
+    backend = 'experiments.counters.RedisCounters'
+
+    def test_intersection_counts(self):
+        with self.assertRaises(NotImplementedError):
+            self.counters.intersection_counts([TEST_KEY, TEST_KEY + '_goal'])
+
+    def test_clear_missing_value_leaves_histogram(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.clear(TEST_KEY, 'barney')
+        self.assertEqual(self.counters._redis.hgetall(counters.COUNTER_FREQ_CACHE_KEY % TEST_KEY), {'1': '1'})
 
     @patch('experiments.counters.Counters._redis')
     def test_should_return_tuple_if_failing(self, patched__redis):
         patched__redis.side_effect = Exception
 
         self.assertEqual(self.counters.get_frequencies(TEST_KEY), dict())
+
+
+class CompactParticipantIdCounterTestCase(CounterTestCase):
+    def setUp(self):
+        patcher = patch.object(conf, 'COMPACT_PARTICIPANT_IDS', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(CompactParticipantIdCounterTestCase, self).setUp()
+
+    def test_fields_are_interned(self):
+        self.counters.increment(TEST_KEY, 'session:fred', 2)
+        self.counters.increment(TEST_KEY + '_other', 'session:fred')
+        participant_id = self.counters._redis.hget(counters.PARTICIPANT_IDS_KEY, 'session:fred')
+        self.assertTrue(participant_id.isdigit())
+        self.assertEqual(self.counters._redis.hgetall(counters.COUNTER_CACHE_KEY % TEST_KEY), {participant_id: '2'})
+        self.assertEqual(self.counters._redis.hgetall(counters.COUNTER_CACHE_KEY % (TEST_KEY + '_other')), {participant_id: '1'})
+        self.counters.reset(TEST_KEY + '_other')
+
+    def test_clear_does_not_intern(self):
+        self.counters.clear(TEST_KEY, 'session:never_seen')
+        self.assertIsNone(self.counters._redis.hget(counters.PARTICIPANT_IDS_KEY, 'session:never_seen'))
+        self.assertEqual(self.counters.get_frequency(TEST_KEY, 'session:never_seen'), 0)
+
+
+class BitmapCounterTestCase(CounterTests, TestCase):
+    backend = 'experiments.counters.RedisCounters'
+
+    def setUp(self):
+        patcher = patch.object(conf, 'COUNTER_BITMAPS', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(BitmapCounterTestCase, self).setUp()
+
+    def test_intersection_with_cleared_participant(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.increment(TEST_KEY, 'barney')
+        self.counters.increment(TEST_KEY + '_goal', 'barney', 3)
+        self.counters.increment(TEST_KEY + '_goal', 'wilma')
+        self.counters.clear(TEST_KEY + '_goal', 'wilma')
+        self.assertEqual(self.counters.intersection_counts([TEST_KEY, TEST_KEY + '_goal']), [2, 1])
+        self.assertEqual(len(list(self.counters._redis.scan_iter(counters.COUNTER_BITMAP_CACHE_KEY % 'intersection:*'))), 0)
+        self.counters.reset(TEST_KEY + '_goal')
+
+    def test_sparse_and_dense_chunks(self):
+        goal_key = TEST_KEY + '_goal'
+        self.counters.increment_many([(TEST_KEY, 'participant%s' % i, 1) for i in range(1100)])
+        self.counters.increment_many([(goal_key, 'participant%s' % i, 1) for i in range(0, 1100, 3)])
+        # A participant in a chunk of their own
+        self.counters._redis.incrby(counters.PARTICIPANT_IDS_NEXT_KEY, counters.BITMAP_CHUNK_SIZE)
+        self.counters.increment(TEST_KEY, 'late')
+        self.counters.increment(goal_key, 'late')
+
+        def chunk_types(key):
+            bitmap_key = counters.COUNTER_BITMAP_CACHE_KEY % key
+            return set(self.counters._redis.type('%s:%s' % (bitmap_key, index)) for index in self.counters._redis.smembers(bitmap_key))
+        self.assertEqual(chunk_types(TEST_KEY), {'string', 'set'})
+        self.assertEqual(chunk_types(goal_key), {'set'})
+
+        self.assertEqual(self.counters.intersection_counts([TEST_KEY, goal_key]), [1101, 368])
+        self.assertEqual(self.counters.intersection_counts([goal_key, TEST_KEY]), [368, 368])
+        self.counters.clear(TEST_KEY, 'participant0')
+        self.counters.clear(goal_key, 'participant3')
+        self.assertEqual(self.counters.intersection_counts([TEST_KEY, TEST_KEY, goal_key, TEST_KEY]), [1100, 1100, 366, 366])
+
+        self.counters.reset(goal_key)
+        self.counters.reset(TEST_KEY)
+        self.assertEqual(list(self.counters._redis.scan_iter(counters.COUNTER_BITMAP_CACHE_KEY % (TEST_KEY + '*'))), [])
+
+
+class MemoryCounterTestCase(CounterTests, TestCase):
+    backend = 'experiments.counters.MemoryCounters'
+
+    def test_threads_share_counters(self):
+        threads = [threading.Thread(target=self.counters.increment, args=(TEST_KEY, 'fred')) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counters.get_counters().get_frequencies(TEST_KEY), {10: 1})
+
+
+class SQLCounterTestCase(CounterTests, TransactionTestCase):
+    backend = 'experiments.sql_counters.SQLCounters'
+
+    def test_increments_are_buffered(self):
+        with patch.object(conf, 'SQL_COUNTER_BUFFER_SIZE', 10), patch.object(conf, 'SQL_COUNTER_BUFFER_SECONDS', 60):
+            self.counters.increment(TEST_KEY, 'fred')
+            self.counters.increment(TEST_KEY, 'fred', 2)
+            self.assertFalse(CounterValue.objects.filter(key=TEST_KEY).exists())
+            self.assertEqual(self.counters.get_frequency(TEST_KEY, 'fred'), 3)
+            self.assertEqual(CounterValue.objects.get(key=TEST_KEY).count, 3)
+
+    def test_buffer_written_in_time(self):
+        with patch.object(conf, 'SQL_COUNTER_BUFFER_SECONDS', 0.05), patch.object(SQLCounters, '_upsert') as upsert:
+            self.counters.increment(TEST_KEY, 'fred')
+            for _ in range(50):
+                if upsert.called:
+                    break
+                time.sleep(0.02)
+        upsert.assert_called_once_with([(TEST_KEY, 'fred', 1)])
+
+    def test_buffer_written_when_full(self):
+        with patch.object(conf, 'SQL_COUNTER_BUFFER_SIZE', 2), patch.object(conf, 'SQL_COUNTER_BUFFER_SECONDS', 60):
+            self.counters.increment(TEST_KEY, 'fred')
+            self.counters.increment(TEST_KEY, 'barney')
+            self.assertEqual(CounterValue.objects.filter(key=TEST_KEY).count(), 2)
+
+    def test_buffer_written_outside_transaction(self):
+        with patch.object(conf, 'SQL_COUNTER_BUFFER_SIZE', 1):
+            try:
+                with transaction.atomic():
+                    self.counters.increment(TEST_KEY, 'fred')
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+            for _ in range(50):
+                if CounterValue.objects.filter(key=TEST_KEY).exists():
+                    break
+                time.sleep(0.02)
+        self.assertEqual(CounterValue.objects.get(key=TEST_KEY).count, 1)
+
+    def test_upsert_adds_to_stored_count(self):
+        with patch.object(conf, 'SQL_COUNTER_BUFFER_SIZE', 0):
+            self.counters.increment(TEST_KEY, 'fred', 2)
+            with self.assertNumQueries(3):
+                # The upsert, in a transaction of its own
+                self.counters.increment_many([(TEST_KEY, 'fred', 3), (TEST_KEY, 'barney', 1)])
+        self.assertEqual(dict(CounterValue.objects.filter(key=TEST_KEY).values_list('participant_identifier', 'count')), {'fred': 5, 'barney': 1})
+
+    def test_upsert_without_on_conflict(self):
+        with patch.object(conf, 'SQL_COUNTER_BUFFER_SIZE', 0), patch.object(connection, 'vendor', 'other'):
+            self.counters.increment(TEST_KEY, 'fred', 2)
+            self.counters.increment_many([(TEST_KEY, 'fred', 3), (TEST_KEY, 'barney', 1)])
+        self.assertEqual(dict(CounterValue.objects.filter(key=TEST_KEY).values_list('participant_identifier', 'count')), {'fred': 5, 'barney': 1})
+
+    def test_clear_drops_buffered_increments(self):
+        with patch.object(conf, 'SQL_COUNTER_BUFFER_SIZE', 10), patch.object(conf, 'SQL_COUNTER_BUFFER_SECONDS', 60):
+            self.counters.increment(TEST_KEY, 'fred')
+            self.counters.clear(TEST_KEY, 'fred')
+            self.counters.increment(TEST_KEY, 'fred')
+            self.assertEqual(self.counters.get_frequency(TEST_KEY, 'fred'), 1)
+
+    def tearDown(self):
+        SQLCounters.flush()
+        super(SQLCounterTestCase, self).tearDown()
+
+
+class CounterBatchTests(object):
+    backend = None
+
+    def setUp(self):
+        patcher = patch.object(conf, 'COUNTER_BACKEND', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.counters = counters.get_counters()
+        self.counters.reset(TEST_KEY)
+
+    def tearDown(self):
+        counters.discard_batch()
+        self.counters.reset(TEST_KEY)
+
+    def test_writes_are_sent_at_end_of_batch(self):
+        with counters.batch():
+            self.counters.increment(TEST_KEY, 'fred')
+            self.counters.increment(TEST_KEY, 'fred')
+            self.counters.increment(TEST_KEY, 'barney')
+            self.assertEqual(self.counters.get(TEST_KEY), 0)
+        self.assertEqual(self.counters.get(TEST_KEY), 2)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1, 2: 1})
+
+    def test_nested_batches_are_sent_by_outermost(self):
+        with counters.batch():
+            with counters.batch():
+                self.counters.increment(TEST_KEY, 'fred')
+            self.assertEqual(self.counters.get(TEST_KEY), 0)
+            self.counters.clear(TEST_KEY, 'fred')
+            self.counters.increment(TEST_KEY, 'barney')
+        self.assertEqual(self.counters.get(TEST_KEY), 1)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1})
+
+    def test_middleware_sends_writes_with_response(self):
+        middleware = ExperimentsCounterBatchMiddleware(lambda request: HttpResponse())
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        self.counters.increment(TEST_KEY, 'fred')
+        self.assertEqual(self.counters.get(TEST_KEY), 0)
+        middleware.process_response(request, HttpResponse())
+        self.assertEqual(self.counters.get(TEST_KEY), 1)
+
+
+class CounterBatchTestCase(CounterBatchTests, TestCase):
+    backend = 'experiments.counters.RedisCounters'
+
+
+class MemoryCounterBatchTestCase(CounterBatchTests, TestCase):
+    backend = 'experiments.counters.MemoryCounters'
+
+
+class SQLCounterBatchTestCase(CounterBatchTests, TransactionTestCase):
+    backend = 'experiments.sql_counters.SQLCounters'
+
+
+class WriteBehindTests(object):
+    backend = None
+
+    def setUp(self):
+        for name, value in [('COUNTER_BACKEND', self.backend), ('COUNTER_WRITE_BEHIND', True), ('COUNTER_WRITE_BEHIND_SECONDS', 60)]:
+            patcher = patch.object(conf, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.counters = counters.get_counters()
+        self.buffer = counters.write_behind_buffer(self.counters)
+        self.counters.reset(TEST_KEY)
+
+    def tearDown(self):
+        self.buffer.flush()
+        self.counters.reset(TEST_KEY)
+
+    def test_increments_are_aggregated(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.increment(TEST_KEY, 'fred', 2)
+        self.counters.increment(TEST_KEY, 'barney')
+        self.assertEqual(len(self.buffer), 2)
+        self.assertEqual(self.counters.get(TEST_KEY), 0)
+        counters.flush_write_behind()
+        self.assertEqual(self.counters.get(TEST_KEY), 2)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1, 3: 1})
+
+    def test_clear_replaces_waiting_increments(self):
+        self.counters._write([(counters.INCREMENT, TEST_KEY, 'fred', 5)])
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.clear(TEST_KEY, 'fred')
+        self.counters.increment(TEST_KEY, 'fred', 2)
+        self.buffer.flush()
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {2: 1})
+
+    def test_batches_go_through_buffer(self):
+        with counters.batch():
+            self.counters.increment(TEST_KEY, 'fred')
+        self.assertEqual(len(self.buffer), 1)
+        self.buffer.flush()
+        self.assertEqual(self.counters.get(TEST_KEY), 1)
+
+    def test_thread_sends_writes_once_buffer_fills(self):
+        with patch.object(conf, 'COUNTER_WRITE_BEHIND_SIZE', 2):
+            self.counters.increment(TEST_KEY, 'fred')
+            self.counters.increment(TEST_KEY, 'barney')
+            for attempt in range(100):
+                if self.counters.get(TEST_KEY) == 2:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(self.counters.get(TEST_KEY), 2)
+
+    @patch.object(conf, 'COUNTER_WRITE_BEHIND_MAX_SIZE', 1)
+    def test_full_buffer_is_flushed_by_caller(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.increment(TEST_KEY, 'barney')
+        self.assertEqual(self.counters.get(TEST_KEY), 2)
+        self.assertEqual(len(self.buffer), 0)
+
+    @patch.object(conf, 'COUNTER_WRITE_BEHIND_MAX_SIZE', 1)
+    @patch.object(conf, 'COUNTER_WRITE_BEHIND_OVERFLOW', 'drop')
+    def test_full_buffer_drops_writes(self):
+        self.counters.increment(TEST_KEY, 'fred')
+        self.counters.increment(TEST_KEY, 'barney')
+        self.assertEqual(self.buffer.dropped, 1)
+        self.buffer.flush()
+        self.assertEqual(self.counters.get(TEST_KEY), 1)
+        self.assertEqual(self.buffer.dropped, 0)
+
+
+class WriteBehindTestCase(WriteBehindTests, TestCase):
+    backend = 'experiments.counters.RedisCounters'
+
+
+class MemoryWriteBehindTestCase(WriteBehindTests, TestCase):
+    backend = 'experiments.counters.MemoryCounters'
+
+
+class ExperimentCounterSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name='snapshot_test', alternatives={'control': {}, 'alt': {}})
+        self.experiment_counter = ExperimentCounter()
+
+        self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+        self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'wilma')
+        self.experiment_counter.increment_participant_count(self.experiment, 'control', 'barney')
+        self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal1', 'fred', 2)
+        self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal1', 'wilma')
+        self.experiment_counter.increment_goal_count(self.experiment, 'control', 'goal2', 'barney')
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+        self.experiment.delete()
+
+    def test_snapshot_matches_counters(self):
+        snapshot = self.experiment_counter.snapshot(self.experiment, goals=['goal1', 'goal2'], include_distributions=['goal1'])
+        for alternative in ('alt', 'control'):
+            self.assertEqual(snapshot.participant_count(alternative), self.experiment_counter.participant_count(self.experiment, alternative))
+            for goal in ('goal1', 'goal2'):
+                self.assertEqual(snapshot.goal_count(alternative, goal), self.experiment_counter.goal_count(self.experiment, alternative, goal))
+        self.assertEqual(snapshot.goal_distribution('alt', 'goal1'), {1: 1, 2: 1})
+        self.assertEqual(snapshot.goal_distribution('control', 'goal2'), {})
+
+    def test_snapshot_is_read_only(self):
+        snapshot = self.experiment_counter.snapshot(self.experiment, goals=['goal1'], include_distributions=True)
+        distribution = snapshot.goal_distribution('alt', 'goal1')
+        distribution[0] = 10
+        self.assertEqual(snapshot.goal_distribution('alt', 'goal1'), {1: 1, 2: 1})
+        with self.assertRaises(TypeError):
+            snapshot.participants['alt'] = 0
+
+    def test_snapshot_reads_in_one_round_trip(self):
+        with patch.object(self.experiment_counter.counters._redis, 'pipeline', wraps=self.experiment_counter.counters._redis.pipeline) as pipeline:
+            self.experiment_counter.snapshot(self.experiment, include_distributions=True)
+        self.assertEqual(pipeline.call_count, 1)
+
+
+class ApproximateCountsTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name='approximate_test', alternatives={'control': {}, 'alt': {}}, approximate_counts=True, relevant_mwu_goals='goal2')
+        self.experiment_counter = ExperimentCounter()
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+        self.experiment.delete()
+
+    def test_counts_unique_participants(self):
+        for participant_identifier in ('fred', 'wilma', 'fred'):
+            self.experiment_counter.increment_participant_count(self.experiment, 'alt', participant_identifier)
+            self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal1', participant_identifier)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, 'alt'), 2)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'alt', 'goal1'), 2)
+
+        redis = self.experiment_counter.counters._redis
+        self.assertFalse(redis.exists(counters.COUNTER_CACHE_KEY % 'approximate_test:alt:participant'))
+        self.assertFalse(redis.exists(counters.COUNTER_CACHE_KEY % 'approximate_test:alt:goal1:goal'))
+
+    def test_mwu_goals_are_exact(self):
+        self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal2', 'fred', 2)
+        self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal2', 'wilma')
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, 'alt', 'goal2'), 2)
+        self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, 'alt', 'goal2'), {1: 1, 2: 1})
+
+    def test_snapshot(self):
+        self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+        self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal1', 'fred')
+        self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal2', 'fred', 3)
+        snapshot = self.experiment_counter.snapshot(self.experiment, goals=['goal1', 'goal2'], include_distributions=['goal2'])
+        self.assertEqual(snapshot.participant_count('alt'), 1)
+        self.assertEqual(snapshot.goal_count('alt', 'goal1'), 1)
+        self.assertEqual(snapshot.goal_count('alt', 'goal2'), 1)
+        self.assertEqual(snapshot.goal_distribution('alt', 'goal2'), {3: 1})
+
+    def test_delete_resets_approximate_counts(self):
+        self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+        self.experiment_counter.delete(self.experiment)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, 'alt'), 0)
+
+
+class SpoolTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = patch.object(conf, 'COUNTER_SPOOL_DIR', directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(spool.close)
+        self.counters = counters.RedisCounters()
+        self.counters.reset(TEST_KEY)
+
+    def tearDown(self):
+        self.counters.reset(TEST_KEY)
+
+    def spool_writes(self):
+        with patch.object(counters.RedisCounters, '_write_to', side_effect=ConnectionError):
+            self.counters.increment(TEST_KEY, 'fred')
+            self.counters.increment_many([(TEST_KEY, 'fred', 1), (TEST_KEY, 'barney', 1)])
+
+    def test_failed_writes_are_spooled(self):
+        self.spool_writes()
+        self.assertTrue(spool.is_open())
+        self.assertEqual(len(spool.spool_files()), 1)
+        self.assertEqual(self.counters.get(TEST_KEY), 0)
+
+        # Still being written to
+        self.assertEqual(self.counters.replay_spool(), 0)
+        spool.close()
+        self.assertEqual(self.counters.replay_spool(), 3)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1, 2: 1})
+        self.assertEqual(spool.spool_files(), [])
+
+    def test_replay_is_idempotent(self):
+        self.spool_writes()
+        spool.close()
+        path = spool.spool_files()[0]
+        shutil.copy(path, path + '.copy')
+        self.counters.replay_spool()
+        os.rename(path + '.copy', path)
+        self.assertEqual(self.counters.replay_spool(), 0)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 1, 2: 1})
+
+    def test_replayed_once_redis_is_back(self):
+        self.spool_writes()
+        self.counters.increment(TEST_KEY, 'wilma')
+        self.assertFalse(spool.is_open())
+        counters._replay_thread.join(5)
+        self.assertEqual(self.counters.get_frequencies(TEST_KEY), {1: 2, 2: 1})
+
+    def test_writes_failing_to_connect_are_spooled(self):
+        with patch.object(CircuitBreakerConnection, 'connect', side_effect=ConnectionError):
+            self.counters.increment(TEST_KEY, 'fred')
+        self.assertEqual(len(spool.spool_files()), 1)
+
+    def test_writes_sent_before_failing_are_not_spooled(self):
+        def time_out_after_sending(client, *write):
+            self.counters._redis.ping()
+            raise TimeoutError
+        with patch.object(counters.RedisCounters, '_write_to', side_effect=time_out_after_sending):
+            self.counters.increment(TEST_KEY, 'fred')
+        self.assertFalse(spool.is_open())
+        self.assertEqual(spool.spool_files(), [])
+
+    def test_truncated_line_is_skipped(self):
+        self.spool_writes()
+        spool.close()
+        with open(spool.spool_files()[0], 'a') as f:
+            f.write('{"id": "cut short", "wri')
+        self.assertEqual(self.counters.replay_spool(), 3)
+
+
+class CounterDeletionTestCase(TestCase):
+    def setUp(self):
+        self.counters = counters.RedisCounters()
+        for i in range(25):
+            self.counters.increment('deletion_test:%s:participant' % i, 'fred')
+
+    def tearDown(self):
+        self.counters._redis.delete(counters.DELETIONS_KEY, counters.DELETIONS_LOCK_KEY)
+        self.counters.reset_prefix('deletion_test')
+
+    def remaining(self):
+        return len(list(self.counters._redis.scan_iter('experiments:*:deletion_test:*')))
+
+    @patch.object(conf, 'COUNTER_DELETE_BATCH_SIZE', 10)
+    def test_reset_prefix_unlinks_in_batches(self):
+        with patch.object(self.counters._redis, 'keys') as keys, patch.object(self.counters._redis, 'unlink', wraps=self.counters._redis.unlink) as unlink:
+            self.counters.reset_prefix('deletion_test')
+        keys.assert_not_called()
+        self.assertTrue(unlink.called)
+        self.assertEqual(self.remaining(), 0)
+
+    def test_reset_pattern(self):
+        self.assertTrue(self.counters.reset_pattern('deletion_test:1*'))
+        self.assertEqual(self.remaining(), 28)
+
+    def test_falls_back_to_delete(self):
+        with patch.object(self.counters._redis, 'unlink', side_effect=ResponseError("unknown command 'UNLINK'")), \
+                patch.object(counters.RedisCounters, '_has_unlink', True):
+            self.counters.reset_prefix('deletion_test')
+            self.assertFalse(counters.RedisCounters._has_unlink)
+        self.assertEqual(self.remaining(), 0)
+
+    @patch.object(conf, 'COUNTER_DELETE_IN_BACKGROUND', True)
+    @patch.object(conf, 'COUNTER_DELETE_BATCH_SIZE', 10)
+    def test_background_deletion_resumes(self):
+        with patch.object(counters, 'start_deletions') as start_deletions:
+            self.counters.reset_prefix('deletion_test')
+        start_deletions.assert_called_once_with()
+        self.assertEqual(self.remaining(), 50)
+
+        # An interrupted run leaves its progress behind
+        match = 'experiments:participants:deletion_test:*'
+        self.counters._redis.hset(counters.DELETIONS_KEY, match, self.counters._delete_batch(match, 0))
+        self.assertTrue(self.counters.run_deletions())
+        self.assertEqual(self.remaining(), 0)
+        self.assertFalse(self.counters._redis.exists(counters.DELETIONS_KEY))
+
+    def test_only_one_run_at_a_time(self):
+        self.counters._redis.hset(counters.DELETIONS_KEY, 'experiments:participants:deletion_test:*', 0)
+        self.counters._redis.set(counters.DELETIONS_LOCK_KEY, 1)
+        self.assertFalse(self.counters.run_deletions())
+        self.assertEqual(self.remaining(), 50)
+
+
+class PruneParticipantIdsTestCase(TestCase):
+    def setUp(self):
+        self.counters = counters.RedisCounters()
+        self.keys = [TEST_KEY + '_pruned', TEST_KEY + '_kept']
+
+    def tearDown(self):
+        for key in self.keys:
+            self.counters.reset(key)
+
+    def participant_id(self, identifier):
+        return self.counters._redis.hget(counters.PARTICIPANT_IDS_KEY, identifier)
+
+    @patch.object(conf, 'COMPACT_PARTICIPANT_IDS', True)
+    def test_ids_of_deleted_counters_are_removed(self):
+        self.counters.increment(self.keys[0], 'prune:gone')
+        self.counters.increment(self.keys[0], 'prune:kept')
+        self.counters.increment(self.keys[1], 'prune:kept')
+        self.counters.reset(self.keys[0])
+        kept_id = self.participant_id('prune:kept')
+
+        self.assertGreaterEqual(self.counters.prune_participant_ids(), 1)
+        self.assertIsNone(self.participant_id('prune:gone'))
+        self.assertEqual(self.participant_id('prune:kept'), kept_id)
+        self.assertEqual(self.counters.get_frequency(self.keys[1], 'prune:kept'), 1)
+
+    @patch.object(conf, 'COUNTER_BITMAPS', True)
+    def test_ids_in_bitmaps_are_kept(self):
+        # More participants than a sparse chunk holds, so that the chunk is a string of bits
+        self.counters.increment_many([(self.keys[1], 'prune:participant%s' % i, 1) for i in range(counters.BITMAP_SPARSE_SIZE + 10)])
+        self.counters.increment(self.keys[0], 'prune:gone')
+        self.counters.reset(self.keys[0])
+
+        self.counters.prune_participant_ids()
+        self.assertIsNone(self.participant_id('prune:gone'))
+        self.assertTrue(all(self.participant_id('prune:participant%s' % i) for i in range(counters.BITMAP_SPARSE_SIZE + 10)))
+
+    @patch.object(conf, 'COMPACT_PARTICIPANT_IDS', True)
+    def test_ids_counted_while_pruning_are_kept(self):
+        self.counters.increment(self.keys[0], 'prune:revived')
+        self.counters.reset(self.keys[0])
+        revived_id = self.participant_id('prune:revived')
+        hscan_iter = self.counters._redis.hscan_iter
+
+        def count_during_prune(*args, **kwargs):
+            self.counters.increment(self.keys[1], 'prune:revived')
+            return hscan_iter(*args, **kwargs)
+        with patch.object(self.counters._redis, 'hscan_iter', side_effect=count_during_prune):
+            self.counters.prune_participant_ids()
+        self.assertEqual(self.participant_id('prune:revived'), revived_id)
+        self.assertFalse(self.counters._redis.exists(counters.PARTICIPANT_IDS_COUNTED_KEY))
+
+    def test_only_one_prune_at_a_time(self):
+        self.counters._redis.set(counters.PARTICIPANT_IDS_PRUNE_LOCK_KEY, 1)
+        self.addCleanup(self.counters._redis.delete, counters.PARTICIPANT_IDS_PRUNE_LOCK_KEY)
+        self.assertIsNone(self.counters.prune_participant_ids())
+
+
+@patch.object(conf, 'COUNTER_ROLLUP_INTERVAL', 3600)
+class RollupTestCase(TestCase):
+    backend = 'experiments.counters.RedisCounters'
+
+    def setUp(self):
+        patcher = patch.object(conf, 'COUNTER_BACKEND', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.experiment = Experiment.objects.create(name='rollup_test', alternatives={'control': {}, 'alt': {}})
+        self.experiment_counter = ExperimentCounter()
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+        self.experiment.delete()
+
+    def test_participants_counted_in_interval_they_joined(self):
+        with patch('experiments.counters.time.time', return_value=7200 * 1000 + 10):
+            self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+            self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal1', 'fred')
+        with patch('experiments.counters.time.time', return_value=7200 * 1000 + 3600):
+            self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+            self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'wilma')
+            self.experiment_counter.increment_goal_count(self.experiment, 'alt', 'goal1', 'fred', 2)
+
+        rollups = self.experiment_counter.rollups(self.experiment, datetime_from_timestamp(7200 * 1000), datetime_from_timestamp(7200 * 1000 + 7200), goals=['goal1'])
+        self.assertEqual([timestamp_from_datetime(start) for start, results in rollups], [7200 * 1000 + i * 3600 for i in range(3)])
+        self.assertEqual([results.participant_count('alt') for start, results in rollups], [1, 1, 0])
+        self.assertEqual([results.goal_count('alt', 'goal1') for start, results in rollups], [1, 0, 0])
+        self.assertEqual(rollups[0][1].participant_count('control'), 0)
+
+
+    def test_rollups_expire(self):
+        with patch.object(conf, 'COUNTER_ROLLUP_TTL', 600):
+            self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+        key = counters.COUNTER_ROLLUP_BUCKET_KEY % (PARTICIPANT_KEY % (self.experiment.name, 'alt'), counters.rollup_bucket(time.time()))
+        self.assertTrue(0 < counters.RedisCounters()._redis.ttl(key) <= 600)
+
+    def test_buckets_expire_separately(self):
+        redis = counters.RedisCounters()._redis
+        key = PARTICIPANT_KEY % (self.experiment.name, 'alt')
+        with patch('experiments.counters.time.time', return_value=7200 * 1000 + 10):
+            self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+        redis.expire(counters.COUNTER_ROLLUP_BUCKET_KEY % (key, 7200 * 1000), 100)
+        with patch('experiments.counters.time.time', return_value=7200 * 1000 + 3600):
+            self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'wilma')
+        self.assertTrue(0 < redis.ttl(counters.COUNTER_ROLLUP_BUCKET_KEY % (key, 7200 * 1000)) <= 100)
+
+    def test_reset_deletes_buckets(self):
+        redis = counters.RedisCounters()._redis
+        key = PARTICIPANT_KEY % (self.experiment.name, 'alt')
+        self.experiment_counter.increment_participant_count(self.experiment, 'alt', 'fred')
+        counters.RedisCounters().reset(key)
+        self.assertFalse(redis.exists(counters.COUNTER_ROLLUP_BUCKET_KEY % (key, counters.rollup_bucket(time.time()))))
+
+
+class MemoryRollupTestCase(RollupTestCase):
+    backend = 'experiments.counters.MemoryCounters'
+
+    def test_rollups_expire(self):
+        pass
+
+    def test_buckets_expire_separately(self):
+        pass
+
+    def test_reset_deletes_buckets(self):
+        pass
@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+
+import time
+
+from django.db import transaction
+from django.test import TransactionTestCase
+
+from experiments import conf
+from experiments.manager import experiment_manager, ExperimentSnapshot, CONFIG_CHANGED_CHANNEL
+from experiments.models import Experiment, ENABLED_STATE
+from experiments.redis_client import get_redis_client
+from mock import patch
+
+
+@patch.object(conf, 'CONFIG_SNAPSHOT', True)
+class ExperimentSnapshotTestCase(TransactionTestCase):
+    # Changes are published once committed
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name='snapshot_experiment', state=ENABLED_STATE)
+        experiment_manager.invalidate_snapshot()
+
+    def tearDown(self):
+        experiment_manager.stop_listener()
+
+    def test_lookups_do_not_query(self):
+        experiment_manager.snapshot()
+        with self.assertNumQueries(0):
+            self.assertEqual(experiment_manager.get_experiment('snapshot_experiment').state, ENABLED_STATE)
+
+    def test_snapshot_replaced_on_change(self):
+        snapshot = experiment_manager.snapshot()
+        self.experiment.ensure_alternative_exists('alt')
+        self.assertIsNot(experiment_manager.snapshot(), snapshot)
+        self.assertIn('alt', experiment_manager.get_experiment('snapshot_experiment').alternatives)
+
+    def test_missing_experiment_is_auto_created(self):
+        experiment_manager.snapshot()
+        self.assertIsNotNone(experiment_manager.get_experiment('snapshot_experiment_new'))
+        self.assertIn('snapshot_experiment_new', experiment_manager.snapshot())
+
+    def test_new_alternatives_replace_shared_ones(self):
+        experiment = experiment_manager.get_experiment('snapshot_experiment')
+        self.assertIs(experiment_manager.get_experiment('snapshot_experiment'), experiment)
+        alternatives = experiment.alternatives
+        experiment.ensure_alternatives_exist(['alt'])
+        self.assertNotIn('alt', alternatives)
+        self.assertIn('alt', experiment.alternatives)
+
+    def test_change_published_once_committed(self):
+        snapshot = experiment_manager.snapshot()
+        with transaction.atomic():
+            self.experiment.ensure_alternative_exists('alt')
+            self.assertIs(experiment_manager.snapshot(), snapshot)
+        self.assertIsNot(experiment_manager.snapshot(), snapshot)
+
+    def test_snapshot_loaded_during_invalidation_is_not_kept(self):
+        def load(experiments):
+            experiment_manager.invalidate_snapshot()
+            return ExperimentSnapshot(experiments)
+        with patch('experiments.manager.ExperimentSnapshot', side_effect=load):
+            experiment_manager.snapshot()
+        self.assertIsNone(experiment_manager._snapshot)
+
+    def test_snapshot_expires(self):
+        snapshot = experiment_manager.snapshot()
+        with patch.object(conf, 'CONFIG_SNAPSHOT_TTL', -1):
+            self.assertIsNot(experiment_manager.snapshot(), snapshot)
+
+    def test_invalidated_by_other_processes(self):
+        experiment_manager.snapshot()
+        # Give the listener a moment to subscribe
+        for _ in range(50):
+            if get_redis_client().pubsub_numsub(CONFIG_CHANGED_CHANNEL)[0][1]:
+                break
+            time.sleep(0.02)
+
+        get_redis_client().publish(CONFIG_CHANGED_CHANNEL, 'snapshot_experiment')
+        for _ in range(50):
+            if experiment_manager._snapshot is None:
+                break
+            time.sleep(0.02)
+        self.assertIsNone(experiment_manager._snapshot)
@@ -2,7 +2,10 @@ from __future__ import absolute_import
 
 from unittest import TestCase
 
-from experiments.models import Experiment, Counters
+from django.test import TestCase as DjangoTestCase
+
+from experiments.counters import Counters
+from experiments.models import Experiment
 from mock import patch
 
 
@@ -18,3 +21,81 @@ class ExperimentModelTestCase(TestCase):
         experiment = Experiment.objects.create(name='test_experiment')
         experiment.delete(reset_counters=False)
         reset_prefix_mock.assert_not_called()
+
+
+class EnsureAlternativesTestCase(DjangoTestCase):
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name='test_alternatives')
+
+    def test_new_alternatives_stored_together(self):
+        with patch.object(Experiment, 'save', wraps=self.experiment.save) as save:
+            self.experiment.ensure_alternatives_exist({'control': 1, 'alt1': 2, 'alt2': None})
+        self.assertEqual(save.call_count, 1)
+        self.assertEqual(Experiment.objects.get(name='test_alternatives').alternatives, {
+            'control': {'enabled': True, 'weight': 1.0},
+            'alt1': {'enabled': True, 'weight': 2.0},
+            'alt2': {'enabled': True},
+        })
+
+    def test_existing_alternatives_not_stored(self):
+        self.experiment.ensure_alternatives_exist(['control', 'alt1'])
+        with self.assertNumQueries(0):
+            self.experiment.ensure_alternatives_exist(['control', 'alt1'])
+            self.experiment.ensure_alternative_exists('alt1')
+
+    def test_weight_added_to_existing_alternative(self):
+        self.experiment.ensure_alternative_exists('alt1')
+        self.experiment.ensure_alternative_exists('alt1', 5)
+        self.assertEqual(Experiment.objects.get(name='test_alternatives').alternatives, {'alt1': {'enabled': True, 'weight': 5.0}})
+
+    def test_merges_alternatives_stored_elsewhere(self):
+        other = Experiment.objects.get(name='test_alternatives')
+        other.ensure_alternative_exists('alt1')
+        self.experiment.ensure_alternative_exists('alt2')
+        self.assertEqual(set(Experiment.objects.get(name='test_alternatives').alternatives), {'alt1', 'alt2'})
+
+    def test_out_of_date_instance_not_stored(self):
+        stale = Experiment.objects.get(name='test_alternatives')
+        self.experiment.ensure_alternative_exists('alt1', 1)
+        with self.assertNumQueries(0):
+            stale.ensure_alternative_exists('alt1', 1)
+        self.assertEqual(stale.alternatives, {'alt1': {'enabled': True, 'weight': 1.0}})
+
+
+class AlternativeChoiceTestCase(TestCase):
+    def test_cumulative_weights(self):
+        experiment = Experiment(name='test_choice', alternatives={'control': {'weight': 1}, 'alt1': {'weight': 3}})
+        self.assertEqual(experiment.cumulative_weights(), (('alt1', 'control'), (3, 4)))
+
+    def test_equal_weights_unless_all_weighted(self):
+        experiment = Experiment(name='test_choice', alternatives={'control': {'weight': 1}, 'alt1': {}})
+        self.assertEqual(experiment.cumulative_weights(), (('alt1', 'control'), (1, 2)))
+
+    def test_weights_forgotten_when_alternatives_change(self):
+        experiment = Experiment(name='test_choice', alternatives={'control': {}})
+        self.assertEqual(experiment.random_alternative(), 'control')
+        experiment.alternatives = {'alt1': {}}
+        self.assertEqual(experiment.random_alternative(), 'alt1')
+        experiment.alternatives['alt1']['weight'] = 0
+        experiment.alternatives['alt2'] = {'weight': 1}
+        experiment.alternatives_changed()
+        self.assertEqual(set(experiment.random_alternatives(50)), {'alt2'})
+
+    def test_zero_weight_never_chosen(self):
+        experiment = Experiment(name='test_choice', alternatives={'control': {'weight': 1}, 'alt1': {'weight': 0}, 'alt2': {'weight': 1}})
+        self.assertEqual(set(experiment.random_alternative() for i in range(100)), {'control', 'alt2'})
+        self.assertEqual(set(experiment.random_alternatives(100)), {'control', 'alt2'})
+
+    def test_control_without_alternatives(self):
+        experiment = Experiment(name='test_choice', alternatives={})
+        self.assertEqual(experiment.random_alternative(), 'control')
+        self.assertEqual(experiment.hashed_alternative('user:1'), 'control')
+        self.assertEqual(experiment.random_alternatives(3), ['control'] * 3)
+
+    def test_choose_alternatives(self):
+        experiment = Experiment(name='test_choice', alternatives={'control': {}, 'alt1': {}}, hashed_assignment=True)
+        identifiers = ['user:%s' % i for i in range(20)]
+        chosen = experiment.choose_alternatives(identifiers)
+        self.assertEqual(chosen, dict((identifier, experiment.hashed_alternative(identifier)) for identifier in identifiers))
+        experiment.hashed_assignment = False
+        self.assertEqual(set(experiment.choose_alternatives(identifiers)), set(identifiers))
@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from django.test import override_settings
+from redis.exceptions import ConnectionError
+
+from experiments.counters import RedisCounters
+from experiments.redis_client import CircuitBreaker, CircuitOpenError, get_circuit_breaker, get_redis_client, reset_redis_client, CLOSED, OPEN, HALF_OPEN
+from mock import patch
+
+
+class RedisClientTestCase(TestCase):
+    def tearDown(self):
+        reset_redis_client()
+
+    def test_client_is_shared(self):
+        self.assertIs(get_redis_client(), get_redis_client())
+
+    def test_new_client_after_fork(self):
+        client = get_redis_client()
+        with patch('experiments.redis_client.os.getpid', return_value=-1):
+            self.assertIsNot(get_redis_client(), client)
+
+    def test_reset_reads_settings_again(self):
+        client = get_redis_client()
+        reset_redis_client()
+        with override_settings(EXPERIMENTS_REDIS_DB=1):
+            other_client = get_redis_client()
+            self.assertIsNot(other_client, client)
+            self.assertEqual(other_client.connection_pool.connection_kwargs['db'], 1)
+
+    @override_settings(EXPERIMENTS_REDIS_SOCKET_TIMEOUT=0.5, EXPERIMENTS_REDIS_SOCKET_CONNECT_TIMEOUT=0.1)
+    def test_socket_timeouts(self):
+        reset_redis_client()
+        connection_kwargs = get_redis_client().connection_pool.connection_kwargs
+        self.assertEqual(connection_kwargs['socket_timeout'], 0.5)
+        self.assertEqual(connection_kwargs['socket_connect_timeout'], 0.1)
+
+    @override_settings(EXPERIMENTS_REDIS_SENTINELS=[('localhost', 26379)], EXPERIMENTS_REDIS_SENTINELS_TIMEOUT=0.1, EXPERIMENTS_REDIS_MASTER_NAME='mymaster')
+    def test_sentinel_managed_master(self):
+        reset_redis_client()
+        client = get_redis_client()
+        self.assertEqual(client.connection_pool.service_name, 'mymaster')
+
+
+class CircuitBreakerTestCase(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    def test_opens_after_failures_in_a_row(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.trips, 1)
+        self.assertEqual(self.breaker.rejected, 1)
+
+    def test_half_open_lets_one_call_through(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        with patch('experiments.redis_client.time.time', return_value=self.breaker._opened_at + 10):
+            self.assertTrue(self.breaker.allow())
+            self.assertEqual(self.breaker.state, HALF_OPEN)
+            self.assertTrue(self.breaker.allow())
+            with patch('experiments.redis_client.threading.current_thread') as current_thread:
+                current_thread.return_value.ident = -1
+                self.assertFalse(self.breaker.allow())
+
+            self.breaker.failure()
+            self.assertEqual(self.breaker.state, OPEN)
+            self.assertFalse(self.breaker.allow())
+
+        with patch('experiments.redis_client.time.time', return_value=self.breaker._opened_at + 10):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breaker.trips, 1)
+
+
+class UnavailableRedisTestCase(TestCase):
+    def setUp(self):
+        settings = override_settings(EXPERIMENTS_REDIS_PORT=1, EXPERIMENTS_REDIS_CIRCUIT_BREAKER_FAILURES=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        reset_redis_client()
+
+    def tearDown(self):
+        reset_redis_client()
+
+    def test_calls_fail_fast_once_open(self):
+        client = get_redis_client()
+        for attempt in range(2):
+            with self.assertRaises(ConnectionError) as raised:
+                client.get('key')
+            self.assertNotIsInstance(raised.exception, CircuitOpenError)
+        with self.assertRaises(CircuitOpenError):
+            client.get('key')
+        self.assertEqual(get_circuit_breaker().trips, 1)
+
+    def test_skipped_counter_writes(self):
+        counters = RedisCounters()
+        for attempt in range(3):
+            counters.increment('key', 'fred')
+        self.assertEqual(counters.get('key'), 0)
+        self.assertEqual(get_circuit_breaker().skipped_writes, 1)
+
+    def test_breaker_can_be_disabled(self):
+        with override_settings(EXPERIMENTS_REDIS_CIRCUIT_BREAKER_FAILURES=None):
+            reset_redis_client()
+            self.assertIsNone(get_circuit_breaker())
+            for attempt in range(3):
+                with self.assertRaises(ConnectionError) as raised:
+                    get_redis_client().get('key')
+                self.assertNotIsInstance(raised.exception, CircuitOpenError)
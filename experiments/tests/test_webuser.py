@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 
+from asgiref.sync import async_to_sync, sync_to_async
 from datetime import timedelta
+from unittest import skipUnless
+
+import django
 from django.http import HttpResponse
 
 from django.test import TestCase
@@ -17,7 +21,7 @@ from experiments.models import Experiment, ENABLED_STATE, Enrollment
 from experiments.conf import CONTROL_GROUP, VISIT_PRESENT_COUNT_GOAL, VISIT_NOT_PRESENT_COUNT_GOAL
 from experiments.redis_client import get_redis_client
 from experiments.signal_handlers import transfer_enrollments_to_user
-from experiments.utils import participant
+from experiments.utils import aparticipant, participant, NEXT_VISIT_CHECK_SESSION_KEY
 
 from mock import patch
 
@@ -292,3 +296,378 @@ class DefaultAlternativeTestCase(TestCase):
         experiment.set_default_alternative('alt1')
         experiment.save()
         self.assertEqual('alt1', participant(session=DatabaseSession()).enroll('test_default', ['alt1', 'alt2']))
+
+
+class HashedAssignmentTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name='hashed_experiment', state=ENABLED_STATE, hashed_assignment=True)
+        self.experiment_counter = ExperimentCounter()
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    def test_alternative_is_stable(self):
+        self.experiment.ensure_alternative_exists(CONTROL_GROUP)
+        self.experiment.ensure_alternative_exists('alt1')
+        alternatives = set(self.experiment.hashed_alternative('session:%s' % i) for i in range(100))
+        self.assertEqual(alternatives, {CONTROL_GROUP, 'alt1'})
+        for i in range(100):
+            self.assertEqual(self.experiment.hashed_alternative('session:%s' % i), self.experiment.hashed_alternative('session:%s' % i))
+
+    def test_alternative_follows_weights(self):
+        self.experiment.ensure_alternative_exists(CONTROL_GROUP, 1)
+        self.experiment.ensure_alternative_exists('alt1', 0)
+        self.assertEqual(set(self.experiment.hashed_alternative('user:%s' % i) for i in range(100)), {CONTROL_GROUP})
+
+    def test_salt_changes_alternatives(self):
+        self.experiment.ensure_alternative_exists(CONTROL_GROUP)
+        self.experiment.ensure_alternative_exists('alt1')
+        before = [self.experiment.hashed_alternative('session:%s' % i) for i in range(100)]
+        self.experiment.assignment_salt = 'rerun'
+        self.assertNotEqual(before, [self.experiment.hashed_alternative('session:%s' % i) for i in range(100)])
+
+    def test_enroll_records_exposure_once(self):
+        request = request_factory.get('/')
+        request.session = DatabaseSession()
+        request.user = AnonymousUser()
+        experiment_user = participant(request)
+
+        self.assertEqual(experiment_user.get_alternative(self.experiment.name), CONTROL_GROUP)
+        alternative = experiment_user.enroll(self.experiment.name, ['alt1', 'alt2'])
+        self.assertEqual(alternative, Experiment.objects.get(name=self.experiment.name).hashed_alternative(experiment_user._participant_identifier()))
+        self.assertEqual(Enrollment.objects.get(experiment=self.experiment).alternative, alternative)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(experiment_user.enroll(self.experiment.name, ['alt1', 'alt2']), alternative)
+            self.assertEqual(participant(session=request.session).get_alternative(self.experiment.name), alternative)
+
+    def test_exposure_of_recreated_experiment_is_ignored(self):
+        session = DatabaseSession()
+        experiment_user = participant(session=session)
+        experiment_user.confirm_human()
+        alternative = experiment_user.enroll(self.experiment.name, ['alt1', 'alt2'])
+        self.experiment.delete()
+        self.experiment = Experiment.objects.create(name='hashed_experiment', state=ENABLED_STATE, hashed_assignment=True)
+
+        self.assertEqual(participant(session=session).enroll(self.experiment.name, ['alt1', 'alt2']), alternative)
+        self.assertEqual(Enrollment.objects.get(experiment=self.experiment).alternative, alternative)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, alternative), 1)
+
+    def test_exposure_of_restarted_experiment_is_ignored(self):
+        session = DatabaseSession()
+        alternative = participant(session=session).enroll(self.experiment.name, ['alt1', 'alt2'])
+        Enrollment.objects.filter(experiment=self.experiment).delete()
+        self.experiment.start_date += timedelta(days=1)
+        self.experiment.save()
+
+        self.assertEqual(participant(session=session).enroll(self.experiment.name, ['alt1', 'alt2']), alternative)
+        self.assertEqual(Enrollment.objects.get(experiment=self.experiment).alternative, alternative)
+
+    def test_exposure_looked_up_without_session_marker(self):
+        user = get_user_model().objects.create(username='brian')
+        alternative = participant(user=user).enroll(self.experiment.name, ['alt1'])
+        self.assertEqual(participant(user=user).get_alternative(self.experiment.name), alternative)
+
+    def test_stored_enrollment_wins_over_hash(self):
+        self.experiment.ensure_alternatives_exist(['alt1', 'alt2'])
+        session = DatabaseSession()
+        experiment_user = participant(session=session)
+        experiment_user.confirm_human()
+        hashed = self.experiment.hashed_alternative(experiment_user._participant_identifier())
+        other = 'alt2' if hashed != 'alt2' else 'alt1'
+
+        experiment_user.set_alternative(self.experiment.name, other)
+        self.assertEqual(experiment_user.get_alternative(self.experiment.name), other)
+        self.assertEqual(participant(session=session).enroll(self.experiment.name, ['alt1', 'alt2']), other)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, other), 1)
+
+        user = get_user_model().objects.create(username='brian')
+        participant(user=user).incorporate(participant(session=session))
+        self.assertEqual(participant(user=user).get_alternative(self.experiment.name), other)
+
+    def test_force_alternative(self):
+        experiment_user = participant(session=DatabaseSession())
+        self.assertEqual(experiment_user.enroll(self.experiment.name, ['alt1'], force_alternative='forced'), 'forced')
+        self.assertEqual(experiment_user.get_alternative(self.experiment.name), 'forced')
+
+
+class EnrollmentPrefetchTestCase(TestCase):
+    def setUp(self):
+        self.experiments = [Experiment.objects.create(name='prefetch_%s' % i, state=ENABLED_STATE) for i in range(3)]
+        self.experiment_counter = ExperimentCounter()
+        self.user = get_user_model().objects.create(username='brian')
+        for experiment in self.experiments:
+            participant(user=self.user).set_alternative(experiment.name, TEST_ALTERNATIVE)
+
+    def tearDown(self):
+        for experiment in self.experiments:
+            self.experiment_counter.delete(experiment)
+
+    def test_enrollments_loaded_once(self):
+        experiment_user = participant(user=self.user)
+        with self.assertNumQueries(1):
+            for experiment in self.experiments:
+                self.assertEqual(experiment_user.get_alternative(experiment.name), TEST_ALTERNATIVE)
+            experiment_user.goal(TEST_GOAL)
+            self.assertEqual(len(experiment_user._get_all_enrollments()), 3)
+
+    def test_visit_updates_enrollments_together(self):
+        experiment_user = participant(user=self.user)
+        with self.assertNumQueries(2):
+            experiment_user.visit()
+        for experiment in self.experiments:
+            self.assertEqual(self.experiment_counter.goal_count(experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+        self.assertEqual(Enrollment.objects.filter(user=self.user, last_seen__isnull=True).count(), 0)
+
+    def test_enrollments_kept_up_to_date(self):
+        experiment_user = participant(user=self.user)
+        experiment_user.set_alternative(self.experiments[0].name, 'red')
+        experiment_user.visit()
+        experiment_user._cancel_enrollment(self.experiments[1])
+
+        enrollments = dict((enrollment.experiment.name, enrollment) for enrollment in experiment_user._get_all_enrollments())
+        self.assertEqual(enrollments, dict((enrollment.experiment.name, enrollment) for enrollment in participant(user=self.user)._get_all_enrollments()))
+        self.assertEqual(enrollments[self.experiments[0].name].alternative, 'red')
+        self.assertNotIn(self.experiments[1].name, enrollments)
+        self.assertIsNotNone(enrollments[self.experiments[2].name].last_seen)
+
+
+class RetentionMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name='retention_experiment', state=ENABLED_STATE)
+        self.experiment_counter = ExperimentCounter()
+        self.request = request_factory.get('/')
+        self.request.session = DatabaseSession()
+        self.request.user = AnonymousUser()
+        self.middleware = ExperimentsRetentionMiddleware(lambda request: HttpResponse())
+
+        experiment_user = participant(self.request)
+        experiment_user.confirm_human()
+        experiment_user.set_alternative(self.experiment.name, TEST_ALTERNATIVE)
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    def _visit(self, request=None):
+        request = request or self.request
+        self.middleware.process_response(request, HttpResponse())
+
+    def _next_request(self):
+        request = request_factory.get('/')
+        request.session = self.request.session
+        request.user = AnonymousUser()
+        return request
+
+    def test_visits_within_session_are_skipped(self):
+        self._visit()
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+
+        with self.assertNumQueries(0):
+            self._visit(self._next_request())
+
+    def test_visit_checked_once_session_expires(self):
+        self._visit()
+        Enrollment.objects.update(last_seen=timezone.now() - timedelta(hours=7))
+        self.request.session[NEXT_VISIT_CHECK_SESSION_KEY] = 0
+
+        self._visit(self._next_request())
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_PRESENT_COUNT_GOAL), 1)
+
+    def test_new_enrollment_is_checked_immediately(self):
+        self._visit()
+        request = self._next_request()
+        other_experiment = Experiment.objects.create(name='retention_experiment_other', state=ENABLED_STATE)
+        try:
+            participant(request).set_alternative(other_experiment.name, TEST_ALTERNATIVE)
+            self._visit(request)
+            self.assertEqual(self.experiment_counter.goal_count(other_experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+        finally:
+            self.experiment_counter.delete(other_experiment)
+
+    @patch('experiments.conf.RETENTION_DEFERRED', True)
+    def test_deferred_visit_recorded_once_response_closed(self):
+        self.request.COOKIES['experiments_goal'] = TEST_GOAL
+        response = self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 0)
+        self.assertIn(NEXT_VISIT_CHECK_SESSION_KEY, self.request.session)
+
+        response.close()
+        response.close()
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, TEST_GOAL), 1)
+
+    def _async_request(self, request):
+        async def auser():
+            return request.user
+        request.auser = auser
+        return request
+
+    @skipUnless(django.VERSION >= (5, 1), "Async sessions need Django 5.1")
+    async def test_async_visit(self):
+        async def get_response(request):
+            return HttpResponse()
+        middleware = ExperimentsRetentionMiddleware(get_response)
+        request = self._async_request(self.request)
+        request.COOKIES['experiments_goal'] = TEST_GOAL
+
+        await middleware(request)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, TEST_GOAL), 1)
+        self.assertIn(NEXT_VISIT_CHECK_SESSION_KEY, request.session)
+
+        await middleware(self._async_request(self._next_request()))
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+
+    @skipUnless(django.VERSION >= (5, 1), "Async sessions need Django 5.1")
+    @patch('experiments.conf.RETENTION_DEFERRED', True)
+    async def test_async_deferred_visit(self):
+        async def get_response(request):
+            return HttpResponse()
+        response = await ExperimentsRetentionMiddleware(get_response)(self._async_request(self.request))
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 0)
+
+        await sync_to_async(response.close)()
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+
+    def test_async_visit_without_async_user(self):
+        # Before Django 5.1 requests have no auser, the visit is recorded synchronously in a thread
+        async def get_response(request):
+            return HttpResponse()
+        middleware = ExperimentsRetentionMiddleware(get_response)
+        self.request.COOKIES['experiments_goal'] = TEST_GOAL
+
+        with patch.object(ExperimentsRetentionMiddleware, 'process_response', wraps=middleware.process_response) as process_response:
+            async_to_sync(middleware)(self.request)
+        self.assertEqual(process_response.call_count, 1)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, TEST_GOAL), 1)
+
+class EnrollmentUpsertTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name='upsert_experiment', state=ENABLED_STATE)
+        self.experiment_counter = ExperimentCounter()
+        self.user = get_user_model().objects.create(username='brian')
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    def test_new_enrollment_inserted_once(self):
+        experiment_user = participant(user=self.user)
+        self.assertEqual(experiment_user.get_alternative(self.experiment.name), CONTROL_GROUP)
+        # The insert alone, its row count tells whether it was inserted
+        with self.assertNumQueries(1):
+            experiment_user._set_enrollment(self.experiment, TEST_ALTERNATIVE)
+        self.assertEqual(Enrollment.objects.get(user=self.user).alternative, TEST_ALTERNATIVE)
+
+    def test_concurrent_enrollment_keeps_first(self):
+        experiment_user = participant(user=self.user)
+        self.assertEqual(experiment_user.get_alternative(self.experiment.name), CONTROL_GROUP)
+        participant(user=self.user).enroll(self.experiment.name, ['red'], force_alternative='red')
+
+        self.assertEqual(experiment_user.enroll(self.experiment.name, [TEST_ALTERNATIVE], force_alternative=TEST_ALTERNATIVE), 'red')
+        self.assertEqual(Enrollment.objects.get(user=self.user).alternative, 'red')
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, 'red'), 1)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, TEST_ALTERNATIVE), 0)
+
+    def test_existing_enrollment_keeps_dates(self):
+        last_seen = timezone.now() - timedelta(hours=1)
+        participant(user=self.user)._set_enrollment(self.experiment, TEST_ALTERNATIVE, last_seen=last_seen)
+        enrollment_date = Enrollment.objects.get(user=self.user).enrollment_date
+
+        experiment_user = participant(user=self.user)
+        self.assertEqual(experiment_user.get_alternative(self.experiment.name), TEST_ALTERNATIVE)
+        experiment_user._set_enrollment(self.experiment, 'red')
+
+        enrollment = Enrollment.objects.get(user=self.user)
+        self.assertEqual((enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen), ('red', enrollment_date, last_seen))
+        self.assertEqual(experiment_user._get_all_enrollments()[0].last_seen, last_seen)
+
+    def test_session_enrollment(self):
+        experiment_user = participant(session=DatabaseSession())
+        experiment_user._set_enrollment(self.experiment, TEST_ALTERNATIVE)
+        experiment_user._set_enrollment(self.experiment, 'red')
+        self.assertEqual(Enrollment.objects.get(session_key=experiment_user._session_key).alternative, 'red')
+
+    def test_enrollment_added_with_the_same_date_is_not_ours(self):
+        experiment_user = participant(user=self.user)
+        self.assertEqual(experiment_user._get_all_enrollments(), [])
+        enrollment_date = Enrollment.objects.create(user=self.user, experiment=self.experiment, alternative=TEST_ALTERNATIVE).enrollment_date
+
+        with patch('django.utils.timezone.now', return_value=enrollment_date):
+            experiment_user._set_enrollment(self.experiment, TEST_ALTERNATIVE)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, TEST_ALTERNATIVE), 0)
+
+    def test_enrollment_not_visible_is_not_counted(self):
+        experiment_user = participant(user=self.user)
+        self.assertEqual(experiment_user._get_all_enrollments(), [])
+        Enrollment.objects.create(user=self.user, experiment=self.experiment, alternative='red')
+
+        with patch.object(Enrollment.objects, 'get', side_effect=Enrollment.DoesNotExist):
+            experiment_user._set_enrollment(self.experiment, TEST_ALTERNATIVE)
+        self.assertEqual(Enrollment.objects.get(user=self.user).alternative, 'red')
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, TEST_ALTERNATIVE), 0)
+
+    @patch('experiments.utils.WebUser._can_ignore_conflicts', False)
+    def test_fallback_without_ignore_conflicts(self):
+        experiment_user = participant(user=self.user)
+        experiment_user._set_enrollment(self.experiment, TEST_ALTERNATIVE)
+        experiment_user._set_enrollment(self.experiment, 'red')
+        self.assertEqual(Enrollment.objects.get(user=self.user).alternative, 'red')
+
+
+@skipUnless(django.VERSION >= (5, 1), "Async sessions need Django 5.1")
+class AsyncParticipantTestCase(TestCase):
+    def setUp(self):
+        self.experiment = Experiment.objects.create(name=EXPERIMENT_NAME, state=ENABLED_STATE)
+        self.experiment_counter = ExperimentCounter()
+        self.user = get_user_model().objects.create(username='wilma')
+
+    def tearDown(self):
+        self.experiment_counter.delete(self.experiment)
+
+    async def test_session_participant(self):
+        request = request_factory.get('/')
+        request.session = DatabaseSession()
+        experiment_user = await aparticipant(request)
+        self.assertIs(await aparticipant(request), experiment_user)
+        self.assertIsNotNone(request.session.session_key)
+
+        await sync_to_async(experiment_user.confirm_human)()
+        self.assertEqual(await experiment_user.aenroll(EXPERIMENT_NAME, [TEST_ALTERNATIVE], force_alternative=TEST_ALTERNATIVE), TEST_ALTERNATIVE)
+        self.assertEqual(await experiment_user.aenroll(EXPERIMENT_NAME, ['red']), TEST_ALTERNATIVE)
+        await experiment_user.agoal(TEST_GOAL)
+        await experiment_user.agoal(TEST_GOAL)
+
+        enrollment = await Enrollment.objects.aget(session_key=request.session['experiments_session_key'])
+        self.assertEqual(enrollment.alternative, TEST_ALTERNATIVE)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, TEST_ALTERNATIVE), 1)
+        self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, TEST_ALTERNATIVE, TEST_GOAL), {2: 1})
+
+    async def test_authenticated_participant(self):
+        request = request_factory.get('/')
+        request.session = DatabaseSession()
+
+        async def auser():
+            return self.user
+        request.auser = auser
+        experiment_user = await aparticipant(request)
+        self.assertEqual(experiment_user.user, self.user)
+
+        await experiment_user.aenroll(EXPERIMENT_NAME, [TEST_ALTERNATIVE], force_alternative=TEST_ALTERNATIVE)
+        self.assertEqual((await Enrollment.objects.aget(user=self.user)).alternative, TEST_ALTERNATIVE)
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, TEST_ALTERNATIVE), 1)
+
+        experiment_user = await aparticipant(user=self.user)
+        self.assertIsNotNone(await experiment_user.avisit())
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, VISIT_NOT_PRESENT_COUNT_GOAL), 1)
+        self.assertIsNotNone((await Enrollment.objects.aget(user=self.user)).last_seen)
+
+    async def test_unconfirmed_goals_are_counted_once_confirmed(self):
+        experiment_user = await aparticipant(session=DatabaseSession())
+        await experiment_user.aenroll(EXPERIMENT_NAME, [TEST_ALTERNATIVE], force_alternative=TEST_ALTERNATIVE)
+        await experiment_user.agoal(TEST_GOAL)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, TEST_GOAL), 0)
+
+        await sync_to_async(experiment_user.confirm_human)()
+        self.assertEqual(self.experiment_counter.participant_count(self.experiment, TEST_ALTERNATIVE), 1)
+        self.assertEqual(self.experiment_counter.goal_count(self.experiment, TEST_ALTERNATIVE, TEST_GOAL), 1)
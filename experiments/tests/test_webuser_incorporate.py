@@ -12,6 +12,7 @@ from experiments.utils import DummyUser, WebUser, participant
 from experiments.models import Experiment, ENABLED_STATE, Enrollment
 
 from django.contrib.auth import get_user_model
+from mock import patch
 
 TEST_ALTERNATIVE = 'blue'
 EXPERIMENT_NAME = 'backgroundcolor'
@@ -125,3 +126,19 @@ class IncorporateTestCase(TestCase):
         )
         self.assertEqual(self.experiment_counter.goal_count(self.experiment, alternative, conf.VISIT_NOT_PRESENT_COUNT_GOAL), 1)
         self.assertEqual(self.experiment_counter.participant_count(self.experiment, alternative), 1)
+
+    def test_approximate_counts_not_counted_again(self):
+        self.experiment.approximate_counts = True
+        self.experiment.relevant_mwu_goals = 'exact_goal'
+        self.experiment.save()
+        with patch.object(conf, 'ALL_GOALS', ('approximate_goal', 'exact_goal')):
+            experiment_user = participant(self.request)
+            alternative = experiment_user.enroll(self.experiment.name, ['alternative'])
+            experiment_user.goal('approximate_goal')
+            experiment_user.goal('exact_goal')
+            self._login()
+
+            self.assertEqual(Enrollment.objects.get(user=self.user).alternative, alternative)
+            self.assertEqual(self.experiment_counter.participant_count(self.experiment, alternative), 1)
+            self.assertEqual(self.experiment_counter.goal_count(self.experiment, alternative, 'approximate_goal'), 1)
+            self.assertEqual(self.experiment_counter.goal_distribution(self.experiment, alternative, 'exact_goal'), {1: 1})
@@ -1,15 +1,17 @@
-from django.db import IntegrityError
+from asgiref.sync import sync_to_async
+
+from django.db import IntegrityError, connections, router
 from django.utils.functional import cached_property
 
-from redis.exceptions import ConnectionError, ResponseError
+from redis.exceptions import ConnectionError, ResponseError, TimeoutError
 
 from experiments.models import Enrollment
 from experiments.manager import experiment_manager
 from experiments.dateutils import now, fix_awareness, datetime_from_timestamp, timestamp_from_datetime
 from experiments.signals import user_enrolled
 from experiments.experiment_counters import ExperimentCounter
-from experiments.redis_client import get_redis_client
-from experiments import conf
+from experiments.redis_client import get_async_redis_client, get_redis_client
+from experiments import conf, counters
 
 from collections import namedtuple
 from datetime import timedelta
@@ -33,6 +35,17 @@ logger = logging.getLogger('experiments')
 
 UNCONFIRMED_HUMAN_GOALS_REDIS_KEY = "experiments:goals:%s"
 
+# Inserts leaving an existing row as it is, by database vendor
+INSERT_IGNORING_CONFLICTS = {
+    'postgresql': 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT DO NOTHING',
+    'sqlite': 'INSERT OR IGNORE INTO %s (%s) VALUES (%s)',
+    'mysql': 'INSERT IGNORE INTO %s (%s) VALUES (%s)',
+}
+
+EXPOSURES_SESSION_KEY = 'experiments_exposures'
+
+NEXT_VISIT_CHECK_SESSION_KEY = 'experiments_next_visit_check'
+
 
 def participant(request=None, session=None, user=None):
     # This caches the experiment user on the request object because WebUser can involve database lookups that
@@ -46,9 +59,35 @@ def participant(request=None, session=None, user=None):
         return result
 
 
+async def aparticipant(request=None, session=None, user=None):
+    """The async counterpart of participant, for async views (needs Django 5.1 or later)
+
+    The user and the session are loaded without blocking, after which the participant's async
+    methods (aenroll, agoal and avisit) don't block either. Its other methods are synchronous."""
+    if request and hasattr(request, '_experiments_user'):
+        return request._experiments_user
+    if request and hasattr(request, 'auser') and not user:
+        user = await request.auser()
+    if request and hasattr(request, 'session') and not session:
+        session = request.session
+    if session is not None and hasattr(session, 'akeys'):
+        # Loaded and given a key up front, so that WebUser never reads or writes the session store
+        await session.akeys()
+        if 'experiments_session_key' not in session and not session.session_key:
+            await session.asave()
+    result = _get_participant(request, session, user)
+    if request:
+        request._experiments_user = result
+    return result
+
+
 def clear_participant_cache(request):
     if hasattr(request, '_experiments_user'):
         del request._experiments_user
+    # The next visit check was worked out for the previous participant
+    session = getattr(request, 'session', None)
+    if session is not None:
+        session.pop(NEXT_VISIT_CHECK_SESSION_KEY, None)
 
 
 def _get_participant(request, session, user):
@@ -91,30 +130,59 @@ class BaseUser(object):
 
         if experiment:
             if experiment.is_displaying_alternatives():
-                if isinstance(alternatives, Mapping):
-                    if conf.CONTROL_GROUP not in alternatives:
-                        experiment.ensure_alternative_exists(conf.CONTROL_GROUP, 1)
-                    for alternative, weight in alternatives.items():
-                        experiment.ensure_alternative_exists(alternative, weight)
-                else:
-                    alternatives_including_control = alternatives + [conf.CONTROL_GROUP]
-                    for alternative in alternatives_including_control:
-                        experiment.ensure_alternative_exists(alternative)
+                if not conf.STRICT_ALTERNATIVES:
+                    experiment.ensure_alternatives_exist(self._alternatives_including_control(alternatives))
 
                 assigned_alternative = self._get_enrollment(experiment)
                 if assigned_alternative:
                     chosen_alternative = assigned_alternative
                 elif experiment.is_accepting_new_users():
-                    if force_alternative:
-                        chosen_alternative = force_alternative
-                    else:
-                        chosen_alternative = experiment.random_alternative()
+                    chosen_alternative = self._new_alternative(experiment, force_alternative)
                     self._set_enrollment(experiment, chosen_alternative)
+                    # Another request may have enrolled the participant first
+                    chosen_alternative = self._get_enrollment(experiment) or chosen_alternative
+            else:
+                chosen_alternative = experiment.default_alternative
+
+        return chosen_alternative
+
+    async def aenroll(self, experiment_name, alternatives, force_alternative=None):
+        """The async counterpart of enroll"""
+        chosen_alternative = conf.CONTROL_GROUP
+
+        experiment = await experiment_manager.aget_experiment(experiment_name)
+
+        if experiment:
+            if experiment.is_displaying_alternatives():
+                if not conf.STRICT_ALTERNATIVES:
+                    await experiment.aensure_alternatives_exist(self._alternatives_including_control(alternatives))
+
+                assigned_alternative = await self._aget_enrollment(experiment)
+                if assigned_alternative:
+                    chosen_alternative = assigned_alternative
+                elif experiment.is_accepting_new_users():
+                    chosen_alternative = self._new_alternative(experiment, force_alternative)
+                    await self._aset_enrollment(experiment, chosen_alternative)
+                    chosen_alternative = await self._aget_enrollment(experiment) or chosen_alternative
             else:
                 chosen_alternative = experiment.default_alternative
 
         return chosen_alternative
 
+    def _new_alternative(self, experiment, force_alternative):
+        if force_alternative:
+            return force_alternative
+        if experiment.hashed_assignment:
+            return experiment.hashed_alternative(self._participant_identifier())
+        return experiment.random_alternative()
+
+    def _alternatives_including_control(self, alternatives):
+        if isinstance(alternatives, Mapping):
+            alternatives_including_control = dict(alternatives)
+            alternatives_including_control.setdefault(conf.CONTROL_GROUP, 1)
+            return alternatives_including_control
+        return list(alternatives) + [conf.CONTROL_GROUP]
+
     def get_alternative(self, experiment_name):
         """
         Get the alternative this user is enrolled in.
@@ -152,6 +220,12 @@ class BaseUser(object):
             if enrollment.experiment.is_displaying_alternatives():
                 self._experiment_goal(enrollment.experiment, enrollment.alternative, goal_name, count)
 
+    async def agoal(self, goal_name, count=1):
+        """The async counterpart of goal"""
+        for enrollment in await self._aget_all_enrollments():
+            if enrollment.experiment.is_displaying_alternatives():
+                await self._aexperiment_goal(enrollment.experiment, enrollment.alternative, goal_name, count)
+
     def confirm_human(self):
         """Mark that this is a real human being (not a bot) and thus results should be counted"""
         pass
@@ -167,15 +241,48 @@ class BaseUser(object):
         user is enrolled in."""
         for enrollment in other_user._get_all_enrollments():
             if not self._get_enrollment(enrollment.experiment):
-                self._set_enrollment(enrollment.experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen)
+                # Approximate counters can't forget the other user, who is still counted for this one
+                counted = not enrollment.experiment.approximate_counts
+                self._set_enrollment(enrollment.experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen, count=counted)
                 goals = self.experiment_counter.participant_goal_frequencies(enrollment.experiment, enrollment.alternative, other_user._participant_identifier())
                 for goal_name, count in goals:
                     self.experiment_counter.increment_goal_count(enrollment.experiment, enrollment.alternative, goal_name, self._participant_identifier(), count)
             other_user._cancel_enrollment(enrollment.experiment)
 
     def visit(self):
-        """Record that the user has visited the site for the purposes of retention tracking"""
-        for enrollment in self._get_all_enrollments():
+        """Record that the user has visited the site for the purposes of retention tracking
+
+        Returns the earliest time at which a further visit could be recorded, or None if
+        that is not known until the user is enrolled in an experiment."""
+        current_time = now()
+        due, next_visit = self._due_visits(self._get_all_enrollments(), current_time)
+        if due:
+            with counters.batch():
+                for enrollment, goal_names in due:
+                    for goal_name in goal_names:
+                        self._experiment_goal(enrollment.experiment, enrollment.alternative, goal_name, 1)
+            self._set_last_seen_many([enrollment.experiment for enrollment, goal_names in due], current_time)
+            next_visit = self._next_visit_after(next_visit, current_time)
+        return next_visit
+
+    async def avisit(self):
+        """The async counterpart of visit"""
+        current_time = now()
+        due, next_visit = self._due_visits(await self._aget_all_enrollments(), current_time)
+        if due:
+            for enrollment, goal_names in due:
+                for goal_name in goal_names:
+                    await self._aexperiment_goal(enrollment.experiment, enrollment.alternative, goal_name, 1)
+            await self._aset_last_seen_many([enrollment.experiment for enrollment, goal_names in due], current_time)
+            next_visit = self._next_visit_after(next_visit, current_time)
+        return next_visit
+
+    def _due_visits(self, enrollments, current_time):
+        """Return the (enrollment, goal names) due a visit, and the next visit of those that aren't due"""
+        next_visit = None
+        session_length = timedelta(hours=conf.SESSION_LENGTH)
+        due = []
+        for enrollment in enrollments:
             if enrollment.experiment.is_displaying_alternatives():
                 # We have two different goals, VISIT_NOT_PRESENT_COUNT_GOAL and VISIT_PRESENT_COUNT_GOAL.
                 # VISIT_PRESENT_COUNT_GOAL will avoid firing on the first time we set last_seen as it is assumed that the user is
@@ -185,12 +292,19 @@ class BaseUser(object):
                 # this is mainly useful for notification actions when the users isn't initially present.
 
                 if not enrollment.last_seen:
-                    self._experiment_goal(enrollment.experiment, enrollment.alternative, conf.VISIT_NOT_PRESENT_COUNT_GOAL, 1)
-                    self._set_last_seen(enrollment.experiment, now())
-                elif now() - enrollment.last_seen >= timedelta(hours=conf.SESSION_LENGTH):
-                    self._experiment_goal(enrollment.experiment, enrollment.alternative, conf.VISIT_NOT_PRESENT_COUNT_GOAL, 1)
-                    self._experiment_goal(enrollment.experiment, enrollment.alternative, conf.VISIT_PRESENT_COUNT_GOAL, 1)
-                    self._set_last_seen(enrollment.experiment, now())
+                    due.append((enrollment, (conf.VISIT_NOT_PRESENT_COUNT_GOAL,)))
+                elif current_time - enrollment.last_seen >= session_length:
+                    due.append((enrollment, (conf.VISIT_NOT_PRESENT_COUNT_GOAL, conf.VISIT_PRESENT_COUNT_GOAL)))
+                elif next_visit is None or enrollment.last_seen + session_length < next_visit:
+                    next_visit = enrollment.last_seen + session_length
+        return due, next_visit
+
+    def _next_visit_after(self, next_visit, current_time):
+        # The visits that were due have just been recorded
+        session_length = timedelta(hours=conf.SESSION_LENGTH)
+        if next_visit is None or current_time + session_length < next_visit:
+            return current_time + session_length
+        return next_visit
 
     def _get_enrollment(self, experiment):
         """Get the name of the alternative this user is enrolled in for the specified experiment
@@ -198,11 +312,11 @@ class BaseUser(object):
         `experiment` is an instance of Experiment. If the user is not currently enrolled returns None."""
         raise NotImplementedError
 
-    def _set_enrollment(self, experiment, alternative, enrollment_date=None, last_seen=None):
+    def _set_enrollment(self, experiment, alternative, enrollment_date=None, last_seen=None, count=True):
         """Explicitly set the alternative the user is enrolled in for the specified experiment.
 
         This allows you to change a user between alternatives. The user and goal counts for the new
-        alternative will be increment, but those for the old one will not be decremented."""
+        alternative will be increment (unless count is False), but those for the old one will not be decremented."""
         raise NotImplementedError
 
     def is_enrolled(self, experiment_name, alternative):
@@ -235,12 +349,35 @@ class BaseUser(object):
         "Set the last time the user was seen associated with this experiment"
         raise NotImplementedError
 
+    def _set_last_seen_many(self, experiments, last_seen):
+        "Set the last time the user was seen associated with each of the experiments"
+        for experiment in experiments:
+            self._set_last_seen(experiment, last_seen)
+
+    # The async counterparts of the methods above. These call the synchronous methods, which is
+    # fine for users that don't store anything, users that do override them.
+
+    async def _aget_enrollment(self, experiment):
+        return self._get_enrollment(experiment)
+
+    async def _aset_enrollment(self, experiment, alternative):
+        self._set_enrollment(experiment, alternative)
+
+    async def _aget_all_enrollments(self):
+        return self._get_all_enrollments()
+
+    async def _aexperiment_goal(self, experiment, alternative, goal_name, count):
+        self._experiment_goal(experiment, alternative, goal_name, count)
+
+    async def _aset_last_seen_many(self, experiments, last_seen):
+        self._set_last_seen_many(experiments, last_seen)
+
 
 class DummyUser(BaseUser):
     def _get_enrollment(self, experiment):
         return None
 
-    def _set_enrollment(self, experiment, alternative, enrollment_date=None, last_seen=None):
+    def _set_enrollment(self, experiment, alternative, enrollment_date=None, last_seen=None, count=True):
         pass
 
     def is_enrolled(self, experiment_name, alternative):
@@ -274,7 +411,7 @@ class DummyUser(BaseUser):
 
 class WebUser(BaseUser):
     def __init__(self, user=None, session=None, request=None):
-        self._enrollment_cache = {}
+        self._enrollment_cache = None
         self.user = user
         self.session = session
         self.request = request
@@ -292,44 +429,206 @@ class WebUser(BaseUser):
         else:
             return {"session_key": self._session_key}
 
+    @property
+    def _session_store(self):
+        if self.session is not None:
+            return self.session
+        return getattr(self.request, 'session', None)
+
+    def _remembered_exposure(self, experiment):
+        # Enrollments in experiments using hashed assignment are remembered in the session,
+        # with the participant and the run of the experiment they belong to, so they are only
+        # looked up once. An experiment that is recreated or restarted is enrolled in again.
+        store = self._session_store
+        if store is None or not experiment.hashed_assignment:
+            return None
+        exposure = store.get(EXPOSURES_SESSION_KEY, {}).get(experiment.name)
+        if exposure and exposure[:1] + exposure[2:] == self._exposure_of(experiment):
+            return exposure[1]
+        return None
+
+    def _exposure_of(self, experiment):
+        started = experiment.start_date.isoformat() if experiment.start_date else None
+        return [self._participant_identifier(), experiment.pk, started]
+
+    def _set_exposure(self, experiment, alternative):
+        """Remember the alternative the participant is enrolled in, None to forget it"""
+        store = self._session_store
+        if store is None or not experiment.hashed_assignment:
+            return
+        exposures = dict(store.get(EXPOSURES_SESSION_KEY, {}))
+        if alternative is not None:
+            participant_identifier, pk, started = self._exposure_of(experiment)
+            exposure = [participant_identifier, alternative, pk, started]
+            if exposures.get(experiment.name) == exposure:
+                return
+            exposures[experiment.name] = exposure
+        elif experiment.name in exposures:
+            del exposures[experiment.name]
+        else:
+            return
+        store[EXPOSURES_SESSION_KEY] = exposures
+
+    @property
+    def _enrollments(self):
+        """All of this user's enrollments by experiment name, loaded with a single query when first needed"""
+        if self._enrollment_cache is None:
+            enrollments = Enrollment.objects.filter(**self._qs_kwargs).select_related("experiment")
+            self._enrollment_cache = dict(
+                (enrollment.experiment.name, EnrollmentData(enrollment.experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen))
+                for enrollment in enrollments
+            )
+        return self._enrollment_cache
+
+    async def _aenrollments(self):
+        if self._enrollment_cache is None:
+            enrollments = Enrollment.objects.filter(**self._qs_kwargs).select_related("experiment")
+            self._enrollment_cache = dict([
+                (enrollment.experiment.name, EnrollmentData(enrollment.experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen))
+                async for enrollment in enrollments
+            ])
+        return self._enrollment_cache
+
     def _get_enrollment(self, experiment):
-        if experiment.name not in self._enrollment_cache:
-            try:
-                self._enrollment_cache[experiment.name] = Enrollment.objects.get(experiment=experiment, **self._qs_kwargs).alternative
-            except Enrollment.DoesNotExist:
-                self._enrollment_cache[experiment.name] = None
-        return self._enrollment_cache[experiment.name]
+        alternative = self._remembered_exposure(experiment)
+        if alternative is None:
+            enrollment = self._enrollments.get(experiment.name)
+            if enrollment:
+                alternative = enrollment.alternative
+                self._set_exposure(experiment, alternative)
+        return alternative
+
+    async def _aget_enrollment(self, experiment):
+        alternative = self._remembered_exposure(experiment)
+        if alternative is None:
+            enrollment = (await self._aenrollments()).get(experiment.name)
+            if enrollment:
+                alternative = enrollment.alternative
+                self._set_exposure(experiment, alternative)
+        return alternative
+
+    def _set_enrollment(self, experiment, alternative, enrollment_date=None, last_seen=None, count=True):
+        previous = self._enrollments.get(experiment.name)
+        if previous is None:
+            enrollment, inserted = self._insert_enrollment(experiment, alternative, last_seen)
+            if enrollment is None:
+                # Enrolled by another request, their alternative is read once visible
+                return
+            if inserted and enrollment_date:
+                # Can't be given to the insert, enrollment_date is set automatically when adding
+                Enrollment.objects.filter(experiment=experiment, **self._qs_kwargs).update(enrollment_date=enrollment_date)
+                enrollment.enrollment_date = enrollment_date
+            enrollment_data = EnrollmentData(experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen)
+        else:
+            enrollment_data = self._changed_enrollment_data(previous, alternative, enrollment_date, last_seen)
+            Enrollment.objects.filter(experiment=experiment, **self._qs_kwargs).update(**self._changed_fields(enrollment_data))
+            inserted = True
 
-    def _set_enrollment(self, experiment, alternative, enrollment_date=None, last_seen=None):
-        if experiment.name in self._enrollment_cache:
-            del self._enrollment_cache[experiment.name]
+        self._remember_enrollment(experiment, enrollment_data)
+        if not inserted:
+            # Another request enrolled the participant first, their alternative is kept and counted
+            return
 
-        try:
-            enrollment, _ = Enrollment.objects.get_or_create(experiment=experiment, defaults={'alternative': alternative}, **self._qs_kwargs)
-        except IntegrityError:
-            # Already registered (db race condition under high load)
+        if count:
+            if self._is_verified_human:
+                self.experiment_counter.increment_participant_count(experiment, alternative, self._participant_identifier())
+            else:
+                logger.info(json.dumps({'type':'participant_unconfirmed', 'experiment': experiment.name, 'alternative': alternative, 'participant': self._participant_identifier()}))
+
+        user_enrolled.send(self, experiment=experiment.name, alternative=alternative, user=self.user, session=self.session)
+
+    async def _aset_enrollment(self, experiment, alternative):
+        previous = (await self._aenrollments()).get(experiment.name)
+        if previous is None:
+            enrollment, inserted = await self._ainsert_enrollment(experiment, alternative)
+            if enrollment is None:
+                return
+            enrollment_data = EnrollmentData(experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen)
+        else:
+            enrollment_data = self._changed_enrollment_data(previous, alternative, None, None)
+            await Enrollment.objects.filter(experiment=experiment, **self._qs_kwargs).aupdate(**self._changed_fields(enrollment_data))
+            inserted = True
+
+        self._remember_enrollment(experiment, enrollment_data)
+        if not inserted:
+            # Another request enrolled the participant first, their alternative is kept and counted
             return
-        # Update alternative if it doesn't match
-        enrollment_changed = False
-        if enrollment.alternative != alternative:
-            enrollment.alternative = alternative
-            enrollment_changed = True
-        if enrollment_date:
-            enrollment.enrollment_date = enrollment_date
-            enrollment_changed = True
-        if last_seen:
-            enrollment.last_seen = last_seen
-            enrollment_changed = True
-
-        if enrollment_changed:
-            enrollment.save()
 
         if self._is_verified_human:
-            self.experiment_counter.increment_participant_count(experiment, alternative, self._participant_identifier())
+            await self.experiment_counter.aincrement_participant_count(experiment, alternative, self._participant_identifier())
         else:
             logger.info(json.dumps({'type':'participant_unconfirmed', 'experiment': experiment.name, 'alternative': alternative, 'participant': self._participant_identifier()}))
 
-        user_enrolled.send(self, experiment=experiment.name, alternative=alternative, user=self.user, session=self.session)
+        await user_enrolled.asend(self, experiment=experiment.name, alternative=alternative, user=self.user, session=self.session)
+
+    def _changed_enrollment_data(self, previous, alternative, enrollment_date, last_seen):
+        return previous._replace(alternative=alternative, enrollment_date=enrollment_date or previous.enrollment_date, last_seen=last_seen or previous.last_seen)
+
+    def _changed_fields(self, enrollment_data):
+        return {'alternative': enrollment_data.alternative, 'enrollment_date': enrollment_data.enrollment_date, 'last_seen': enrollment_data.last_seen}
+
+    def _remember_enrollment(self, experiment, enrollment_data):
+        if self._enrollment_cache is not None:
+            self._enrollment_cache[experiment.name] = enrollment_data
+
+        self._set_exposure(experiment, enrollment_data.alternative)
+
+        # The new enrollment may be due a visit before the retention middleware's next check
+        if self._session_store is not None:
+            self._session_store.pop(NEXT_VISIT_CHECK_SESSION_KEY, None)
+
+    @property
+    def _can_ignore_conflicts(self):
+        return connections[router.db_for_write(Enrollment)].vendor in INSERT_IGNORING_CONFLICTS
+
+    def _insert_enrollment(self, experiment, alternative, last_seen=None):
+        """Insert the enrollment unless there already is one, returns the stored enrollment and whether it was inserted
+
+        The first of several concurrent enrollments of a participant wins, the others leave it as it is.
+        The stored enrollment is None if it can't be read, e.g. added by a transaction this one doesn't see."""
+        enrollment = Enrollment(experiment=experiment, alternative=alternative, last_seen=last_seen, **self._qs_kwargs)
+        if not self._can_ignore_conflicts:
+            try:
+                return Enrollment.objects.get_or_create(experiment=experiment, defaults={'alternative': alternative, 'last_seen': last_seen}, **self._qs_kwargs)
+            except IntegrityError:
+                # Created and then deleted by other requests in the meantime
+                pass
+        elif self._insert_ignoring_conflicts(enrollment):
+            return enrollment, True
+        try:
+            return Enrollment.objects.get(experiment=experiment, **self._qs_kwargs), False
+        except Enrollment.DoesNotExist:
+            return None, False
+
+    async def _ainsert_enrollment(self, experiment, alternative):
+        enrollment = Enrollment(experiment=experiment, alternative=alternative, **self._qs_kwargs)
+        if not self._can_ignore_conflicts:
+            try:
+                return await Enrollment.objects.aget_or_create(experiment=experiment, defaults={'alternative': alternative}, **self._qs_kwargs)
+            except IntegrityError:
+                # Created and then deleted by other requests in the meantime
+                pass
+        elif await sync_to_async(self._insert_ignoring_conflicts)(enrollment):
+            return enrollment, True
+        try:
+            return await Enrollment.objects.aget(experiment=experiment, **self._qs_kwargs), False
+        except Enrollment.DoesNotExist:
+            return None, False
+
+    def _insert_ignoring_conflicts(self, enrollment):
+        # bulk_create(ignore_conflicts=True) doesn't tell whether the row was added, the row count does
+        connection = connections[router.db_for_write(Enrollment)]
+        meta = Enrollment._meta
+        fields = [field for field in meta.concrete_fields if field is not meta.pk]
+        values = [field.get_db_prep_save(field.pre_save(enrollment, True), connection) for field in fields]
+        sql = INSERT_IGNORING_CONFLICTS[connection.vendor] % (
+            connection.ops.quote_name(meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column) for field in fields),
+            ', '.join(['%s'] * len(fields)),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, values)
+            return cursor.rowcount == 1
 
     def _participant_identifier(self):
         if self.user:
@@ -338,19 +637,18 @@ class WebUser(BaseUser):
             return 'session:%s' % self._session_key
 
     def _get_all_enrollments(self):
-        enrollments = Enrollment.objects.filter(**self._qs_kwargs).select_related("experiment")
-        if enrollments:
-            for enrollment in enrollments:
-                yield EnrollmentData(enrollment.experiment, enrollment.alternative, enrollment.enrollment_date, enrollment.last_seen)
+        # A list rather than a view, callers may cancel enrollments while iterating
+        return list(self._enrollments.values())
+
+    async def _aget_all_enrollments(self):
+        return list((await self._aenrollments()).values())
 
     def _cancel_enrollment(self, experiment):
-        try:
-            enrollment = Enrollment.objects.get(experiment=experiment, **self._qs_kwargs)
-        except Enrollment.DoesNotExist:
-            pass
-        else:
+        enrollment = self._enrollments.pop(experiment.name, None)
+        if enrollment:
             self.experiment_counter.remove_participant(experiment, enrollment.alternative, self._participant_identifier())
-            enrollment.delete()
+            Enrollment.objects.filter(experiment=experiment, **self._qs_kwargs).delete()
+            self._set_exposure(experiment, None)
     
     def _experiment_goal(self, experiment, alternative, goal_name, count):
         if self._is_verified_human:
@@ -363,7 +661,21 @@ class WebUser(BaseUser):
                 # Human confirmation processes are generally quick so this defaults to a
                 # low value (but it can be configured via Django settings)
                 self._redis.expire(self._redis_goals_key, conf.REDIS_GOALS_TTL)
-            except (ConnectionError, ResponseError):
+            except (ConnectionError, ResponseError, TimeoutError):
+                # Handle Redis failures gracefully
+                pass
+            logger.info(json.dumps({'type': 'goal_hit_unconfirmed', 'goal': goal_name, 'goal_count': count, 'experiment': experiment.name, 'alternative': alternative, 'participant': self._participant_identifier()}))
+
+    async def _aexperiment_goal(self, experiment, alternative, goal_name, count):
+        if self._is_verified_human:
+            await self.experiment_counter.aincrement_goal_count(experiment, alternative, goal_name, self._participant_identifier(), count)
+        else:
+            try:
+                pipe = get_async_redis_client().pipeline(transaction=False)
+                pipe.lpush(self._redis_goals_key, json.dumps((experiment.name, alternative, goal_name, count)))
+                pipe.expire(self._redis_goals_key, conf.REDIS_GOALS_TTL)
+                await pipe.execute()
+            except (ConnectionError, ResponseError, TimeoutError):
                 # Handle Redis failures gracefully
                 pass
             logger.info(json.dumps({'type': 'goal_hit_unconfirmed', 'goal': goal_name, 'goal_count': count, 'experiment': experiment.name, 'alternative': alternative, 'participant': self._participant_identifier()}))
@@ -393,12 +705,26 @@ class WebUser(BaseUser):
                     pass  # Values from older version
                 finally:
                     self._redis.delete(self._redis_goals_key)
-        except (ConnectionError, ResponseError):
+        except (ConnectionError, ResponseError, TimeoutError):
             # Handle Redis failures gracefully
             pass
 
     def _set_last_seen(self, experiment, last_seen):
-        Enrollment.objects.filter(experiment=experiment, **self._qs_kwargs).update(last_seen=last_seen)
+        self._set_last_seen_many([experiment], last_seen)
+
+    def _set_last_seen_many(self, experiments, last_seen):
+        Enrollment.objects.filter(experiment__in=experiments, **self._qs_kwargs).update(last_seen=last_seen)
+        self._remember_last_seen(experiments, last_seen)
+
+    async def _aset_last_seen_many(self, experiments, last_seen):
+        await Enrollment.objects.filter(experiment__in=experiments, **self._qs_kwargs).aupdate(last_seen=last_seen)
+        self._remember_last_seen(experiments, last_seen)
+
+    def _remember_last_seen(self, experiments, last_seen):
+        if self._enrollment_cache is not None:
+            for experiment in experiments:
+                if experiment.name in self._enrollment_cache:
+                    self._enrollment_cache[experiment.name] = self._enrollment_cache[experiment.name]._replace(last_seen=last_seen)
     
     @property
     def _is_verified_human(self):
@@ -426,4 +752,4 @@ def grouper(iterable, n, fillvalue=None):
 
 
 
-__all__ = ['participant']
+__all__ = ['participant', 'aparticipant']
@@ -19,10 +19,12 @@ setup(
     packages=find_packages(exclude=["example_project"]),
     include_package_data=True,
     license='MIT',
+    python_requires='>=3.7',
     install_requires=[
-        'django>=1.11',
+        'asgiref>=3.2',
+        'django>=3.0',
         'django-modeldict-yplan>=1.5.0',
-        'redis>=2.4.9',
+        'redis>=4.2',
     ],
     tests_require=[
         'mock>=1.0.1',
@@ -35,12 +37,8 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Software Development :: Libraries',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Framework :: Django',
-        'Framework :: Django :: 1.11',
     ],
 )